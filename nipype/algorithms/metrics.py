@@ -21,8 +21,9 @@ import os.path as op
 import nibabel as nb
 import numpy as np
 from scipy.ndimage.morphology import binary_erosion
+from scipy.spatial import cKDTree
 from scipy.spatial.distance import cdist, euclidean, dice, jaccard
-from scipy.ndimage.measurements import center_of_mass, label
+from scipy.ndimage.measurements import center_of_mass, label, find_objects
 
 from .. import logging
 from ..utils.misc import package_check
@@ -32,6 +33,88 @@ from ..interfaces.base import (BaseInterface, traits, TraitedSpec, File,
                                BaseInterfaceInputSpec, isdefined)
 iflogger = logging.getLogger('interface')
 
+# largest number of point pairs compared with a full distance matrix, larger
+# sets of points are compared with a KD-tree
+_CDIST_MAX_PAIRS = 2 ** 22
+
+
+def _find_border(data):
+    eroded = binary_erosion(data)
+    border = np.logical_and(data, np.logical_not(eroded))
+    return border
+
+
+def _get_coordinates(data, affine, offset=None):
+    if len(data.shape) == 4:
+        data = data[:, :, :, 0]
+    indices = np.vstack(np.nonzero(data))
+    if offset is not None:
+        indices += np.asarray(offset).reshape(-1, 1)
+    indices = np.vstack((indices, np.ones(indices.shape[1])))
+    coordinates = np.dot(affine, indices)
+    return coordinates[:3, :]
+
+
+def _min_distances(set1_coordinates, set2_coordinates):
+    """Return the distance of each point of the second set to the closest
+    point of the first set, and the index of that point
+
+    The sets are given as ``(3 x points)`` arrays of coordinates. Small sets
+    are compared with a full distance matrix, larger ones with a KD-tree so
+    that the memory used is linear in the number of points.
+    """
+    if set1_coordinates.shape[1] * set2_coordinates.shape[1] <= \
+            _CDIST_MAX_PAIRS:
+        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
+        indices = np.argmin(dist_matrix, axis=0)
+        return dist_matrix[indices, np.arange(len(indices))], indices
+    return cKDTree(set1_coordinates.T).query(set2_coordinates.T)
+
+
+def _clean_labels(data):
+    """Set negative and nan labels to 0
+    """
+    return np.where(np.logical_or(data < 0, np.isnan(data)), 0, data)
+
+
+def _label_counts(data1, data2):
+    """Return the number of voxels of each label in ``data1``, in ``data2``
+    and in both, computed with one ``bincount`` per array
+    """
+    minlength = int(max(data1.max(), data2.max())) + 1
+    return (np.bincount(data1.ravel(), minlength=minlength),
+            np.bincount(data2.ravel(), minlength=minlength),
+            np.bincount(data1[data1 == data2], minlength=minlength))
+
+
+def _add_counts(total, counts):
+    """Return the sum of two label counts of different lengths
+    """
+    if len(counts) > len(total):
+        total, counts = counts, total
+    total = total.copy()
+    total[:len(counts)] += counts
+    return total
+
+
+def _jaccard_index(counts1, counts2, counts_both):
+    """Return the Jaccard index of labels from their voxel counts, 0 for the
+    labels absent from both volumes
+    """
+    union = counts1 + counts2 - counts_both
+    jaccard = np.zeros(len(union))
+    nonempty = union > 0
+    jaccard[nonempty] = 1 - (np.double(union - counts_both)[nonempty] /
+                             np.double(union[nonempty]))
+    return jaccard
+
+
+def _hausdorff(set1_coordinates, set2_coordinates):
+    """Return the Hausdorff distance between two sets of points
+    """
+    return max(np.max(_min_distances(set1_coordinates, set2_coordinates)[0]),
+               np.max(_min_distances(set2_coordinates, set1_coordinates)[0]))
+
 
 class DistanceInputSpec(BaseInterfaceInputSpec):
     volume1 = File(exists=True, mandatory=True,
@@ -73,17 +156,10 @@ class Distance(BaseInterface):
     _hist_filename = "hist.pdf"
 
     def _find_border(self, data):
-        eroded = binary_erosion(data)
-        border = np.logical_and(data, np.logical_not(eroded))
-        return border
+        return _find_border(data)
 
     def _get_coordinates(self, data, affine):
-        if len(data.shape) == 4:
-            data = data[:, :, :, 0]
-        indices = np.vstack(np.nonzero(data))
-        indices = np.vstack((indices, np.ones(indices.shape[1])))
-        coordinates = np.dot(affine, indices)
-        return coordinates[:3, :]
+        return _get_coordinates(data, affine)
 
     def _eucl_min(self, nii1, nii2):
         origdata1 = nii1.get_data().astype(np.bool)
@@ -96,9 +172,10 @@ class Distance(BaseInterface):
 
         set2_coordinates = self._get_coordinates(border2, nii2.affine)
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        (point1, point2) = np.unravel_index(
-            np.argmin(dist_matrix), dist_matrix.shape)
+        distances, indices = _min_distances(set1_coordinates,
+                                            set2_coordinates)
+        point2 = np.argmin(distances)
+        point1 = indices[point2]
         return (euclidean(set1_coordinates.T[point1, :],
                           set2_coordinates.T[point2, :]),
                 set1_coordinates.T[point1, :],
@@ -134,8 +211,8 @@ class Distance(BaseInterface):
         set1_coordinates = self._get_coordinates(border1, nii1.affine)
         set2_coordinates = self._get_coordinates(origdata2, nii2.affine)
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        min_dist_matrix = np.amin(dist_matrix, axis=0)
+        min_dist_matrix = _min_distances(set1_coordinates,
+                                         set2_coordinates)[0]
         import matplotlib.pyplot as plt
         plt.figure()
         plt.hist(min_dist_matrix, 50, normed=1, facecolor='green')
@@ -174,11 +251,7 @@ class Distance(BaseInterface):
 
         set1_coordinates = self._get_coordinates(border1, nii1.affine)
         set2_coordinates = self._get_coordinates(border2, nii2.affine)
-        distances = cdist(set1_coordinates.T, set2_coordinates.T)
-        mins = np.concatenate(
-            (np.amin(distances, axis=0), np.amin(distances, axis=1)))
-
-        return np.max(mins)
+        return _hausdorff(set1_coordinates, set2_coordinates)
 
     def _run_interface(self, runtime):
         # there is a bug in some scipy ndimage methods that gets tripped by memory mapped objects
@@ -232,6 +305,15 @@ class OverlapInputSpec(BaseInterfaceInputSpec):
                                   'the class'))
     vol_units = traits.Enum('voxel', 'mm', mandatory=True, usedefault=True,
                             desc='units for volumes')
+    chunk_size = traits.Int(desc=('read the volumes in slabs of this number '
+                                  'of slices along the last axis, for '
+                                  'volumes that do not fit in memory '
+                                  '(compute_hausdorff still reads the whole '
+                                  'volumes)'))
+    compute_hausdorff = traits.Bool(False, usedefault=True,
+                                    desc=('compute the Hausdorff distance '
+                                          '(mm) between the borders of each '
+                                          'ROI in both volumes'))
 
 
 class OverlapOutputSpec(TraitedSpec):
@@ -247,6 +329,12 @@ class OverlapOutputSpec(TraitedSpec):
                          desc=('detected labels'))
     diff_file = File(exists=True,
                      desc='error map of differences')
+    hausdorff = traits.Float(desc=('averaged Hausdorff distance (mm) over '
+                                   'the ROIs found in both volumes'))
+    roi_hausdorff = traits.List(traits.Float(),
+                                desc=('the Hausdorff distance (mm) per ROI, '
+                                      'NaN for the ROIs missing from '
+                                      'volume2'))
 
 
 class Overlap(BaseInterface):
@@ -277,45 +365,96 @@ class Overlap(BaseInterface):
             return 0
         return 1 - methods[method](booldata1.flat, booldata2.flat)
 
+    def _roi_hausdorff(self, data1, data2, roi, boxes, affine):
+        """Return the Hausdorff distance between the borders of a ROI in
+        both volumes, NaN if the ROI is missing from one of them
+
+        The borders are searched in the bounding boxes of the ROI returned by
+        ``find_objects`` for each volume, padded by one voxel.
+        """
+        if roi == 0:
+            box = tuple(slice(0, n) for n in data1.shape)
+        elif boxes[0][roi - 1] is None or boxes[1][roi - 1] is None:
+            return np.nan
+        else:
+            box = tuple(slice(max(0, min(s1.start, s2.start) - 1),
+                              min(n, max(s1.stop, s2.stop) + 1))
+                        for s1, s2, n in zip(boxes[0][roi - 1],
+                                             boxes[1][roi - 1],
+                                             data1.shape))
+        offset = [s.start for s in box]
+        borders = [_get_coordinates(_find_border(data[box] == roi), affine,
+                                    offset)
+                   for data in (data1, data2)]
+        if not (borders[0].shape[1] and borders[1].shape[1]):
+            return np.nan
+        return _hausdorff(*borders)
+
+    def _read_labels(self, nii1, nii2, maskimg, dtype, slab=Ellipsis):
+        """Read the labels of both volumes in a slab, cast to ``dtype``
+        """
+        data1 = _clean_labels(np.asarray(nii1.dataobj[slab]))
+        data1 = data1.astype(dtype)
+        data2 = np.asarray(nii2.dataobj[slab]).astype(dtype)
+        if maskimg is not None:
+            maskdata = np.asarray(maskimg.dataobj[slab])
+            maskdata = ~np.logical_or(maskdata == 0, np.isnan(maskdata))
+            data1[~maskdata] = 0
+            data2[~maskdata] = 0
+        return data1, data2
+
     def _run_interface(self, runtime):
         nii1 = nb.load(self.inputs.volume1)
         nii2 = nb.load(self.inputs.volume2)
+        maskimg = None
+        if isdefined(self.inputs.mask_volume):
+            maskimg = nb.load(self.inputs.mask_volume)
 
         scale = 1.0
 
         if self.inputs.vol_units == 'mm':
             voxvol = nii1.header.get_zooms()
-            for i in range(nii1.get_data().ndim - 1):
+            for i in range(len(nii1.shape) - 1):
                 scale = scale * voxvol[i]
 
-        data1 = nii1.get_data()
-        data1[np.logical_or(data1 < 0, np.isnan(data1))] = 0
-        max1 = int(data1.max())
-        data1 = data1.astype(np.min_scalar_type(max1))
-        data2 = nii2.get_data().astype(np.min_scalar_type(max1))
-        data2[np.logical_or(data1 < 0, np.isnan(data1))] = 0
-        max2 = data2.max()
-        maxlabel = max(max1, max2)
-
-        if isdefined(self.inputs.mask_volume):
-            maskdata = nb.load(self.inputs.mask_volume).get_data()
-            maskdata = ~np.logical_or(maskdata == 0, np.isnan(maskdata))
-            data1[~maskdata] = 0
-            data2[~maskdata] = 0
-
-        res = []
-        volumes1 = []
-        volumes2 = []
-
-        labels = np.unique(data1[data1 > 0].reshape(-1)).tolist()
+        slabs = [Ellipsis]
+        if isdefined(self.inputs.chunk_size):
+            slabs = [(Ellipsis, slice(i, i + self.inputs.chunk_size))
+                     for i in range(0, nii1.shape[-1],
+                                    self.inputs.chunk_size)]
+        max1 = max(int(_clean_labels(np.asarray(nii1.dataobj[slab])).max())
+                   for slab in slabs)
+        dtype = np.min_scalar_type(max1)
+
+        # count the voxels of each label in both volumes in a single pass
+        counts = [np.zeros(1, dtype=np.intp) for _ in range(3)]
+        both_data = np.zeros(nii1.shape, dtype=np.uint8)
+        for slab in slabs:
+            data1, data2 = self._read_labels(nii1, nii2, maskimg, dtype, slab)
+            both_data[slab] = data1 != data2
+            counts = [_add_counts(total, slab_counts) for total, slab_counts
+                      in zip(counts, _label_counts(data1, data2))]
+        counts1, counts2, counts_both = counts
+        maxlabel = len(counts1) - 1
+
+        labels = np.nonzero(counts1[1:])[0] + 1
+        labels = labels.tolist()
         if self.inputs.bg_overlap:
             labels.insert(0, 0)
 
-        for l in labels:
-            res.append(self._bool_vec_dissimilarity(data1 == l,
-                                                    data2 == l, method='jaccard'))
-            volumes1.append(scale * len(data1[data1 == l]))
-            volumes2.append(scale * len(data2[data2 == l]))
+        volumes1 = scale * counts1[labels]
+        volumes2 = scale * counts2[labels]
+        res = _jaccard_index(counts1[labels], counts2[labels],
+                             counts_both[labels])
+
+        if self.inputs.compute_hausdorff:
+            if len(slabs) > 1:
+                data1, data2 = self._read_labels(nii1, nii2, maskimg, dtype)
+            boxes = [find_objects(data1, int(maxlabel)),
+                     find_objects(data2, int(maxlabel))]
+            self._roi_hd = np.array([
+                self._roi_hausdorff(data1, data2, l, boxes, nii1.affine)
+                for l in labels])
 
         results = dict(jaccard=[], dice=[])
         results['jaccard'] = np.array(res)
@@ -328,9 +467,6 @@ class Overlap(BaseInterface):
                 weights = weights**2
         weights = weights / np.sum(weights)
 
-        both_data = np.zeros(data1.shape)
-        both_data[(data1 - data2) != 0] = 1
-
         nb.save(nb.Nifti1Image(both_data, nii1.affine, nii1.header),
                 self.inputs.out_file)
 
@@ -342,6 +478,14 @@ class Overlap(BaseInterface):
         self._dice = round(np.sum(weights * results['dice']), 5)
         self._jaccard = round(np.sum(weights * results['jaccard']), 5)
         self._volume = np.sum(weights * self._vol_rois)
+        if self.inputs.compute_hausdorff:
+            # average over the ROIs found in both volumes
+            found = np.isfinite(self._roi_hd)
+            self._hausdorff = np.nan
+            if np.any(found):
+                self._hausdorff = np.sum(weights[found] *
+                                         self._roi_hd[found]) / \
+                    np.sum(weights[found])
 
         return runtime
 
@@ -356,6 +500,9 @@ class Overlap(BaseInterface):
         outputs['roi_di'] = self._ove_rois['dice'].tolist()
         outputs['roi_voldiff'] = self._vol_rois.tolist()
         outputs['diff_file'] = os.path.abspath(self.inputs.out_file)
+        if self.inputs.compute_hausdorff:
+            outputs['hausdorff'] = self._hausdorff
+            outputs['roi_hausdorff'] = self._roi_hd.tolist()
         return outputs
 
 
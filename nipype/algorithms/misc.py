@@ -260,6 +260,43 @@ class CreateNifti(BaseInterface):
         return outputs
 
 
+def _create_nifti_memmap(filename, header, shape):
+    """Create a NIfTI file of the given shape and return its data as a
+    writable memory map, to be closed with :func:`_close_nifti_memmap`
+
+    Compressed files are written uncompressed first and compressed when
+    closed.
+    """
+    hdr = nb.Nifti1Header.from_header(header)
+    hdr.set_data_shape(shape)
+    hdr.set_slope_inter(1, 0)
+    hdr.extensions[:] = []
+    hdr['vox_offset'] = 352
+    rawname = filename
+    if filename.endswith('.gz'):
+        rawname = filename[:-3]
+    with open(rawname, 'wb') as fp:
+        hdr.write_to(fp)
+    data = np.memmap(rawname, dtype=hdr.get_data_dtype(), mode='r+',
+                     offset=352, shape=shape, order='F')
+    return data, rawname, filename
+
+
+def _close_nifti_memmap(data, rawname, filename):
+    """Flush a memory map created by :func:`_create_nifti_memmap` and
+    compress its file if needed
+    """
+    data.flush()
+    del data
+    if rawname != filename:
+        import gzip
+        import shutil
+        with open(rawname, 'rb') as fin:
+            with gzip.open(filename, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+        os.remove(rawname)
+
+
 class TSNRInputSpec(BaseInterfaceInputSpec):
     in_file = InputMultiPath(File(exists=True), mandatory=True,
                              desc='realigned 4D file or a list of 3D files')
@@ -271,7 +308,14 @@ class TSNRInputSpec(BaseInterfaceInputSpec):
     stddev_file = File('stdev.nii.gz', usedefault=True, hash_files=False,
                        desc='output tSNR file')
     detrended_file = File('detrend.nii.gz', usedefault=True, hash_files=False,
-                          desc='input file after detrending')
+                          desc=('input file after detrending, as float32 '
+                                'unless the input is floating point'))
+    max_memory_gb = traits.Float(desc=('process the data in blocks of slices '
+                                       'read from the memory mapped input '
+                                       'files, using at most about this '
+                                       'amount of memory. The detrended file '
+                                       'is written as the blocks are '
+                                       'processed'))
 
 
 class TSNROutputSpec(TraitedSpec):
@@ -297,37 +341,51 @@ class TSNR(BaseInterface):
     input_spec = TSNRInputSpec
     output_spec = TSNROutputSpec
 
-    def _run_interface(self, runtime):
-        img = nb.load(self.inputs.in_file[0])
-        header = img.header.copy()
-        vollist = [nb.load(filename) for filename in self.inputs.in_file]
-        data = np.concatenate([vol.get_data().reshape(
-            vol.get_shape()[:3] + (-1,)) for vol in vollist], axis=3)
+    def _detrend(self, data, X):
+        """Detrend a block of voxel time series and return it with its mean,
+        standard deviation and tSNR
+        """
         data = np.nan_to_num(data)
-
-        if data.dtype.kind == 'i':
-            header.set_data_dtype(np.float32)
+        if data.dtype.kind != 'f':
             data = data.astype(np.float32)
-
-        if isdefined(self.inputs.regress_poly):
-            timepoints = img.shape[-1]
-            X = np.ones((timepoints, 1))
-            for i in range(self.inputs.regress_poly):
-                X = np.hstack((X, legendre(
-                    i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
+        if X is not None:
             betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
             datahat = np.rollaxis(np.dot(X[:, 1:],
                                          np.rollaxis(
                                              betas[1:, :, :, :], 0, 3)),
                                   0, 4)
             data = data - datahat
-            img = nb.Nifti1Image(data, img.get_affine(), header)
-            nb.save(img, op.abspath(self.inputs.detrended_file))
-
         meanimg = np.mean(data, axis=3)
         stddevimg = np.std(data, axis=3)
         tsnr = np.zeros_like(meanimg)
         tsnr[stddevimg > 1.e-3] = meanimg[stddevimg > 1.e-3] / stddevimg[stddevimg > 1.e-3]
+        return data, meanimg, stddevimg, tsnr
+
+    def _run_interface(self, runtime):
+        img = nb.load(self.inputs.in_file[0])
+        header = img.header.copy()
+        vollist = [nb.load(filename) for filename in self.inputs.in_file]
+        timepoints = sum(int(np.prod(vol.shape[3:])) for vol in vollist)
+        if header.get_data_dtype().kind != 'f':
+            header.set_data_dtype(np.float32)
+
+        X = None
+        if isdefined(self.inputs.regress_poly):
+            X = np.ones((timepoints, 1))
+            for i in range(self.inputs.regress_poly):
+                X = np.hstack((X, legendre(
+                    i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
+
+        if isdefined(self.inputs.max_memory_gb):
+            meanimg, stddevimg, tsnr = self._run_blocks(vollist, header, X)
+        else:
+            data = np.concatenate([vol.get_data().reshape(
+                vol.get_shape()[:3] + (-1,)) for vol in vollist], axis=3)
+            data, meanimg, stddevimg, tsnr = self._detrend(data, X)
+            if X is not None:
+                img = nb.Nifti1Image(data, img.get_affine(), header)
+                nb.save(img, op.abspath(self.inputs.detrended_file))
+
         img = nb.Nifti1Image(tsnr, img.get_affine(), header)
         nb.save(img, op.abspath(self.inputs.tsnr_file))
         img = nb.Nifti1Image(meanimg, img.get_affine(), header)
@@ -336,6 +394,37 @@ class TSNR(BaseInterface):
         nb.save(img, op.abspath(self.inputs.stddev_file))
         return runtime
 
+    def _run_blocks(self, vollist, header, X):
+        """Compute the tSNR in blocks of slices read from the memory mapped
+        input files, writing the detrended data as the blocks are processed
+        """
+        shape = vollist[0].shape[:3]
+        timepoints = sum(int(np.prod(vol.shape[3:])) for vol in vollist)
+        # a block holds about 5 float64 copies of its time series
+        block_bytes = 5 * 8 * shape[0] * shape[1] * timepoints
+        nslices = max(1, int(self.inputs.max_memory_gb * 2 ** 30 //
+                             block_bytes))
+        detrended = None
+        if X is not None:
+            detrended = _create_nifti_memmap(
+                op.abspath(self.inputs.detrended_file), header,
+                shape + (timepoints,))
+        meanimg = np.zeros(shape)
+        stddevimg = np.zeros(shape)
+        tsnr = np.zeros(shape)
+        for z0 in range(0, shape[2], nslices):
+            block = slice(z0, z0 + nslices)
+            data = np.concatenate([np.asarray(vol.dataobj[:, :, block]).reshape(
+                (shape[0], shape[1], -1, int(np.prod(vol.shape[3:]))))
+                for vol in vollist], axis=3)
+            data, meanimg[:, :, block], stddevimg[:, :, block], \
+                tsnr[:, :, block] = self._detrend(data, X)
+            if detrended is not None:
+                detrended[0][:, :, block] = data
+        if detrended is not None:
+            _close_nifti_memmap(*detrended)
+        return meanimg, stddevimg, tsnr
+
     def _list_outputs(self):
         outputs = self._outputs().get()
         for k in ['tsnr_file', 'mean_file', 'stddev_file']:
@@ -1142,6 +1231,9 @@ class SplitROIsInputSpec(TraitedSpec):
     in_mask = File(exists=True, desc='only process files inside mask')
     roi_size = traits.Tuple(traits.Int, traits.Int, traits.Int,
                             desc='desired ROI size')
+    memmap = traits.Bool(False, usedefault=True,
+                         desc=('write all the ROIs in one uncompressed data '
+                               'file, ROIs being views of this file'))
 
 
 class SplitROIsOutputSpec(TraitedSpec):
@@ -1151,6 +1243,7 @@ class SplitROIsOutputSpec(TraitedSpec):
                                 desc='a mask indicating valid values')
     out_index = OutputMultiPath(File(exists=True),
                                 desc='arrays keeping original locations')
+    out_data = File(exists=True, desc='the data file shared by the ROIs')
 
 
 class SplitROIs(BaseInterface):
@@ -1163,6 +1256,14 @@ class SplitROIs(BaseInterface):
     >>> rois.inputs.in_mask = 'mask.nii'
     >>> rois.run() # doctest: +SKIP
 
+    With ``memmap``, the time series of the voxels in the mask are written
+    once in an uncompressed data file and each ROI is a small index file
+    giving its offset in this file (``out_files`` and ``out_index`` are
+    the same files). Use :func:`load_roi` to read a ROI as a memory map.
+
+    >>> rois.inputs.memmap = True
+    >>> rois.run() # doctest: +SKIP
+
     """
     input_spec = SplitROIsInputSpec
     output_spec = SplitROIsOutputSpec
@@ -1178,10 +1279,13 @@ class SplitROIs(BaseInterface):
             roisize = self.inputs.roi_size
 
         res = split_rois(self.inputs.in_file,
-                         mask, roisize)
+                         mask, roisize, memmap=self.inputs.memmap)
         self._outnames['out_files'] = res[0]
-        self._outnames['out_masks'] = res[1]
         self._outnames['out_index'] = res[2]
+        if self.inputs.memmap:
+            self._outnames['out_data'] = str(np.load(res[0][0])['data'])
+        else:
+            self._outnames['out_masks'] = res[1]
         return runtime
 
     def _list_outputs(self):
@@ -1197,6 +1301,9 @@ class MergeROIsInputSpec(TraitedSpec):
     in_index = InputMultiPath(File(exists=True, mandatory=True),
                               desc='array keeping original locations')
     in_reference = File(exists=True, desc='reference file')
+    memmap = traits.Bool(False, usedefault=True,
+                         desc=('write the ROIs directly in the merged file '
+                               'through a memory map'))
 
 
 class MergeROIsOutputSpec(TraitedSpec):
@@ -1218,6 +1325,10 @@ class MergeROIs(BaseInterface):
     >>> rois.inputs.in_index = ['roi%02d_idx.npz' % i for i in range(1, 6)]
     >>> rois.run() # doctest: +SKIP
 
+    The ROIs may also be indexed by the ``out_index`` of
+    :class:`SplitROIs` with ``memmap``, and be files written by
+    ``numpy.save`` with one row per voxel of the ROI.
+
     """
     input_spec = MergeROIsInputSpec
     output_spec = MergeROIsOutputSpec
@@ -1225,7 +1336,8 @@ class MergeROIs(BaseInterface):
     def _run_interface(self, runtime):
         res = merge_rois(self.inputs.in_files,
                          self.inputs.in_index,
-                         self.inputs.in_reference)
+                         self.inputs.in_reference,
+                         memmap=self.inputs.memmap)
         self._merged = res
         return runtime
 
@@ -1295,9 +1407,12 @@ def normalize_tpms(in_files, in_mask=None, out_files=[]):
     return out_files
 
 
-def split_rois(in_file, mask=None, roishape=None):
+def split_rois(in_file, mask=None, roishape=None, memmap=False):
     """
     Splits an image in ROIs for parallel processing
+
+    With ``memmap``, the ROIs are views of one shared data file, see
+    :func:`load_roi`.
     """
     import nibabel as nb
     import numpy as np
@@ -1307,6 +1422,9 @@ def split_rois(in_file, mask=None, roishape=None):
     if roishape is None:
         roishape = (10, 10, 1)
 
+    if memmap:
+        return _split_rois_memmap(in_file, mask, roishape)
+
     im = nb.load(in_file)
     imshape = im.shape
     dshape = imshape[:3]
@@ -1323,7 +1441,7 @@ def split_rois(in_file, mask=None, roishape=None):
 
     mask = mask.reshape(-1).astype(np.uint8)
     nzels = np.nonzero(mask)
-    els = np.sum(mask)
+    els = int(np.sum(mask))
     nrois = int(ceil(els / float(roisize)))
 
     data = im.get_data().reshape((mask.size, -1))
@@ -1371,9 +1489,12 @@ def split_rois(in_file, mask=None, roishape=None):
 
 
 def merge_rois(in_files, in_idxs, in_ref,
-               dtype=None, out_file=None):
+               dtype=None, out_file=None, memmap=False):
     """
     Re-builds an image resulting from a parallelized processing
+
+    With ``memmap``, or with 300 volumes or more, the ROIs are written
+    directly in the merged file through a memory map.
     """
     import nibabel as nb
     import numpy as np
@@ -1402,22 +1523,38 @@ def merge_rois(in_files, in_idxs, in_ref,
     rsh = ref.shape
     del ref
     npix = rsh[0] * rsh[1] * rsh[2]
-    fcdata = nb.load(in_files[0]).get_data()
+    fcdata = _load_roi_data(in_files[0])
 
-    if fcdata.ndim == 4:
+    if fcdata.ndim in (2, 4):
         ndirs = fcdata.shape[-1]
     else:
         ndirs = 1
+    del fcdata
     newshape = (rsh[0], rsh[1], rsh[2], ndirs)
     hdr.set_data_dtype(dtype)
     hdr.set_xyzt_units('mm', 'sec')
 
-    if ndirs < 300:
+    if memmap or ndirs >= 300:
+        # ROIs are written one after the other in the final file, voxels
+        # of the merged data being in Fortran order
+        data, rawname, out_file = _create_nifti_memmap(out_file, hdr,
+                                                       newshape)
+        voxels = data.reshape((npix, ndirs), order='F')
+        indices = {}
+        for cname, iname in zip(in_files, in_idxs):
+            idxs = _load_roi_index(iname, indices)
+            cdata = _load_roi_data(cname).reshape(-1, ndirs)
+            nels = len(idxs)
+            voxels[np.ravel_multi_index(np.unravel_index(idxs, rsh[:3]),
+                                        rsh[:3], order='F')] = cdata[:nels]
+        del voxels
+        _close_nifti_memmap(data, rawname, out_file)
+
+    else:
         data = np.zeros((npix, ndirs))
         for cname, iname in zip(in_files, in_idxs):
-            f = np.load(iname)
-            idxs = np.squeeze(f['arr_0'])
-            cdata = nb.load(cname).get_data().reshape(-1, ndirs)
+            idxs = _load_roi_index(iname)
+            cdata = _load_roi_data(cname).reshape(-1, ndirs)
             nels = len(idxs)
             idata = (idxs, )
             try:
@@ -1432,32 +1569,95 @@ def merge_rois(in_files, in_idxs, in_ref,
         nb.Nifti1Image(data.reshape(newshape).astype(dtype),
                        aff, hdr).to_filename(out_file)
 
+    return out_file
+
+
+def _split_rois_memmap(in_file, mask, roishape):
+    """
+    Writes the time series of the voxels inside the mask in one data file,
+    and the ROIs as offsets in this file
+    """
+    im = nb.load(in_file)
+    dshape = im.shape[:3]
+    nvols = im.shape[3] if len(im.shape) > 3 else 1
+    roisize = roishape[0] * roishape[1] * roishape[2]
+
+    if mask is not None:
+        mask = np.asarray(nb.load(mask).dataobj) > 0
     else:
-        hdr.set_data_shape(rsh[:3])
-        nii = []
-        for d in range(ndirs):
-            fname = op.abspath('vol%06d.nii' % d)
-            nb.Nifti1Image(np.zeros(rsh[:3]), aff, hdr).to_filename(fname)
-            nii.append(fname)
+        mask = np.ones(dshape, dtype=bool)
+    idxs = np.flatnonzero(mask)
+    els = len(idxs)
+    nrois = int(ceil(els / float(roisize)))
 
-        for cname, iname in zip(in_files, in_idxs):
-            f = np.load(iname)
-            idxs = np.squeeze(f['arr_0'])
-
-            for d, fname in enumerate(nii):
-                data = nb.load(fname).get_data().reshape(-1)
-                cdata = nb.load(cname).get_data().reshape(-1, ndirs)[:, d]
-                nels = len(idxs)
-                idata = (idxs, )
-                data[idata] = cdata[0:nels]
-                nb.Nifti1Image(data.reshape(rsh[:3]),
-                               aff, hdr).to_filename(fname)
-
-        imgs = [nb.load(im) for im in nii]
-        allim = nb.concat_images(imgs)
-        allim.to_filename(out_file)
+    dtype = np.promote_types(im.get_data_dtype(), np.float32)
+    datname = op.abspath('rois.dat')
+    idxname = op.abspath('rois_idx.npz')
+    np.savez(idxname, index=idxs, shape=dshape)
+    data = np.memmap(datname, dtype=dtype, mode='w+', shape=(els, nvols))
+    # the image is read a few volumes at a time, each one contiguous in
+    # the image file
+    step = max(1, int(2 ** 26 // (8 * mask.size)))
+    for t0 in range(0, nvols, step):
+        if len(im.shape) > 3:
+            vols = np.asarray(im.dataobj[..., t0:t0 + step])
+        else:
+            vols = np.asarray(im.dataobj)[..., None]
+        data[:, t0:t0 + vols.shape[-1]] = vols.reshape(
+            (mask.size, -1))[idxs]
+    data.flush()
+    del data
 
-    return out_file
+    out_files = []
+    rowsize = nvols * dtype.itemsize
+    for i in range(nrois):
+        first = i * roisize
+        last = min(els, (i + 1) * roisize)
+        fname = op.abspath('roi%010d.npz' % i)
+        np.savez(fname, data=datname, dtype=dtype.str,
+                 offset=first * rowsize, shape=(last - first, nvols),
+                 index=idxname, first=first, last=last)
+        out_files.append(fname)
+    return out_files, [], out_files
+
+
+def load_roi(in_file, mode='r'):
+    """
+    Returns the data of a ROI written by :func:`split_rois` with
+    ``memmap`` as a memory map of the shared data file, with one row per
+    voxel. With ``mode='r+'``, the ROI can be processed in place.
+    """
+    roi = np.load(in_file)
+    return np.memmap(str(roi['data']), dtype=str(roi['dtype']), mode=mode,
+                     offset=int(roi['offset']), shape=tuple(roi['shape']))
+
+
+def _load_roi_data(in_file):
+    """
+    Returns the data of a ROI, a ROI written by :func:`split_rois` with
+    ``memmap``, a numpy file or an image
+    """
+    if in_file.endswith('.npz'):
+        return load_roi(in_file)
+    if in_file.endswith('.npy'):
+        return np.load(in_file, mmap_mode='r')
+    return nb.load(in_file).get_data()
+
+
+def _load_roi_index(in_file, indices=None):
+    """
+    Returns the indices of the voxels of a ROI. The index files shared
+    by the ROIs written with ``memmap`` are cached in ``indices``
+    """
+    f = np.load(in_file)
+    if 'index' not in f.files:
+        return np.squeeze(f['arr_0'])
+    idxname = str(f['index'])
+    if indices is None:
+        indices = {}
+    if idxname not in indices:
+        indices[idxname] = np.load(idxname)['index']
+    return indices[idxname][int(f['first']):int(f['last'])]
 
 
 # Deprecated interfaces ------------------------------------------------------
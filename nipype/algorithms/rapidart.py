@@ -39,6 +39,10 @@ from .. import logging, config
 iflogger = logging.getLogger('interface')
 
 
+# size in bytes of the chunks of volumes read at once by _iter_volumes
+_CHUNK_BYTES = 2 ** 24
+
+
 def _get_affine_matrix(params, source):
     """Return affine matrix given a set of translation and rotation parameters
 
@@ -46,41 +50,63 @@ def _get_affine_matrix(params, source):
     source : the package that generated the parameters
              supports SPM, AFNI, FSFAST, FSL, NIPY
     """
+    return _get_affine_matrices(np.atleast_2d(params), source)[0]
+
+
+def _get_affine_matrices(params, source):
+    """Return the affine matrices of a series of translation and rotation
+    parameters
+
+    params : np.array (n x upto 12) in native package format
+    source : the package that generated the parameters
+             supports SPM, AFNI, FSFAST, FSL, NIPY
+    """
+    params = np.array(params, dtype=float, ndmin=2)
     if source == 'FSL':
-        params = params[[3, 4, 5, 0, 1, 2]]
+        params = params[:, [3, 4, 5, 0, 1, 2]]
     elif source in ('AFNI', 'FSFAST'):
-        params = params[np.asarray([4, 5, 3, 1, 2, 0]) + (len(params) > 6)]
-        params[3:] = params[3:] * np.pi / 180.
+        params = params[:, np.asarray([4, 5, 3, 1, 2, 0]) +
+                        (params.shape[1] > 6)]
+        params[:, 3:] = params[:, 3:] * np.pi / 180.
     if source == 'NIPY':
         # nipy does not store typical euler angles, use nipy to convert
         from nipy.algorithms.registration import to_matrix44
-        return to_matrix44(params)
+        return np.array([to_matrix44(p) for p in params])
     # process for FSL, SPM, AFNI and FSFAST
-    rotfunc = lambda x: np.array([[np.cos(x), np.sin(x)],
-                                  [-np.sin(x), np.cos(x)]])
+    n = params.shape[0]
     q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
-    if len(params) < 12:
-        params = np.hstack((params, q[len(params):]))
-    params.shape = (len(params),)
+    if params.shape[1] < 12:
+        params = np.hstack((params, np.tile(q[params.shape[1]:], (n, 1))))
+    cos = np.cos(params[:, 3:6])
+    sin = np.sin(params[:, 3:6])
+    eye = lambda: np.tile(np.eye(4), (n, 1, 1))
     # Translation
-    T = np.eye(4)
-    T[0:3, -1] = params[0:3]
+    T = eye()
+    T[:, 0:3, -1] = params[:, 0:3]
     # Rotation
-    Rx = np.eye(4)
-    Rx[1:3, 1:3] = rotfunc(params[3])
-    Ry = np.eye(4)
-    Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotfunc(params[4]).ravel()
-    Rz = np.eye(4)
-    Rz[0:2, 0:2] = rotfunc(params[5])
+    Rx = eye()
+    Rx[:, (1, 1, 2, 2), (1, 2, 1, 2)] = np.column_stack(
+        (cos[:, 0], sin[:, 0], -sin[:, 0], cos[:, 0]))
+    Ry = eye()
+    Ry[:, (0, 0, 2, 2), (0, 2, 0, 2)] = np.column_stack(
+        (cos[:, 1], sin[:, 1], -sin[:, 1], cos[:, 1]))
+    Rz = eye()
+    Rz[:, (0, 0, 1, 1), (0, 1, 0, 1)] = np.column_stack(
+        (cos[:, 2], sin[:, 2], -sin[:, 2], cos[:, 2]))
     # Scaling
-    S = np.eye(4)
-    S[0:3, 0:3] = np.diag(params[6:9])
+    S = eye()
+    S[:, (0, 1, 2), (0, 1, 2)] = params[:, 6:9]
     # Shear
-    Sh = np.eye(4)
-    Sh[(0, 0, 1), (1, 2, 2)] = params[9:12]
+    Sh = eye()
+    Sh[:, (0, 0, 1), (1, 2, 2)] = params[:, 9:12]
     if source in ('AFNI', 'FSFAST'):
-        return np.dot(T, np.dot(Ry, np.dot(Rx, np.dot(Rz, np.dot(S, Sh)))))
-    return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
+        matrices = (T, Ry, Rx, Rz, S, Sh)
+    else:
+        matrices = (T, Rx, Ry, Rz, S, Sh)
+    affines = matrices[-1]
+    for matrix in matrices[-2::-1]:
+        affines = np.einsum('nij,njk->nik', matrix, affines)
+    return affines
 
 
 def _calc_norm(mc, use_differences, source, brain_pts=None):
@@ -110,35 +136,86 @@ def _calc_norm(mc, use_differences, source, brain_pts=None):
     else:
         all_pts = brain_pts
     n_pts = all_pts.size - all_pts.shape[1]
-    newpos = np.zeros((mc.shape[0], n_pts))
+    # positions of the points at each time point, (time x 3 x points)
+    newpos = np.einsum('nij,jk->nik',
+                       _get_affine_matrices(mc, source)[:, 0:3, :], all_pts)
     if brain_pts is not None:
-        displacement = np.zeros((mc.shape[0], int(n_pts / 3)))
-    for i in range(mc.shape[0]):
-        affine = _get_affine_matrix(mc[i, :], source)
-        newpos[i, :] = np.dot(affine,
-                              all_pts)[0:3, :].ravel()
-        if brain_pts is not None:
-            displacement[i, :] = \
-                np.sqrt(np.sum(np.power(np.reshape(newpos[i, :],
-                                                   (3, all_pts.shape[1])) -
-                                        all_pts[0:3, :],
-                                        2),
-                               axis=0))
+        displacement = np.sqrt(np.sum(np.power(newpos - all_pts[0:3, :], 2),
+                                      axis=1))
+    newpos = newpos.reshape((mc.shape[0], n_pts))
     # np.savez('displacement.npz', newpos=newpos, pts=all_pts)
-    normdata = np.zeros(mc.shape[0])
     if use_differences:
         newpos = np.concatenate((np.zeros((1, n_pts)),
                                  np.diff(newpos, n=1, axis=0)), axis=0)
-        for i in range(newpos.shape[0]):
-            normdata[i] = \
-                np.max(np.sqrt(np.sum(np.reshape(np.power(np.abs(newpos[i, :]), 2),
-                                                 (3, all_pts.shape[1])), axis=0)))
+        normdata = np.max(np.sqrt(np.sum(np.reshape(
+            np.power(np.abs(newpos), 2),
+            (mc.shape[0], 3, all_pts.shape[1])), axis=1)), axis=1)
     else:
         newpos = np.abs(signal.detrend(newpos, axis=0, type='constant'))
         normdata = np.sqrt(np.mean(np.power(newpos, 2), axis=1))
     return normdata, displacement
 
 
+def _iter_volumes(nim, chunk_size=None):
+    """Iterate over the volumes of a 4D image
+
+    The volumes are read in chunks of consecutive volumes from the data
+    object of the image, which is memory mapped for uncompressed files, so
+    that only one chunk is in memory at a time. By default, chunks take up to
+    16 MB.
+    """
+    if chunk_size is None:
+        chunk_size = max(1, int(_CHUNK_BYTES // (8 * np.prod(nim.shape[:3]))))
+    for t0 in range(0, nim.shape[3], chunk_size):
+        chunk = np.asarray(nim.dataobj[..., t0:t0 + chunk_size])
+        for i in range(chunk.shape[3]):
+            yield t0 + i, chunk[:, :, :, i]
+
+
+def _global_signal(nim, mask_type, global_threshold=8., intersect_mask=True,
+                   mask=None, mask_threshold=None, chunk_size=None):
+    """Return the global intensity of each volume of a 4D image and the mask
+    it was computed in
+
+    mask_type : 'spm_global', 'file' (``mask`` is a boolean array) or
+                'thresh' (voxels above ``mask_threshold``)
+    chunk_size : number of volumes read at once, see :func:`_iter_volumes`
+    """
+    (x, y, z, timepoints) = nim.shape
+    g = np.zeros((timepoints, 1))
+    if mask_type == 'spm_global':  # spm_global like calculation
+        iflogger.debug('art: using spm global')
+        if intersect_mask:
+            mask = np.ones((x, y, z), dtype=bool)
+            for t0, vol in _iter_volumes(nim, chunk_size):
+                # Use an SPM like approach
+                mask &= vol > (_nanmean(vol) / global_threshold)
+            for t0, vol in _iter_volumes(nim, chunk_size):
+                g[t0] = _nanmean(vol[mask])
+            if np.sum(mask) < (np.prod((x, y, z)) / 10):
+                intersect_mask = False
+                g = np.zeros((timepoints, 1))
+        if not intersect_mask:
+            iflogger.info('not intersect_mask is True')
+            mask = np.zeros((x, y, z, timepoints), dtype=bool)
+            for t0, vol in _iter_volumes(nim, chunk_size):
+                mask_tmp = vol > (_nanmean(vol) / global_threshold)
+                mask[:, :, :, t0] = mask_tmp
+                g[t0] = np.nansum(vol * mask_tmp) / np.nansum(mask_tmp)
+    elif mask_type == 'file':  # uses a mask image to determine intensity
+        for t0, vol in _iter_volumes(nim, chunk_size):
+            g[t0] = _nanmean(vol[mask])
+    elif mask_type == 'thresh':  # uses a fixed signal threshold
+        for t0, vol in _iter_volumes(nim, chunk_size):
+            mask = vol > mask_threshold
+            g[t0] = _nanmean(vol[mask])
+    else:
+        mask = np.ones((x, y, z))
+        g = np.array([_nanmean(vol) for _, vol in _iter_volumes(nim,
+                                                                chunk_size)])
+    return g, mask
+
+
 def _nanmean(a, axis=None):
     """Return the mean excluding items that are nan
 
@@ -364,52 +441,17 @@ class ArtifactDetect(BaseInterface):
         # compute global intensity signal
         (x, y, z, timepoints) = nim.shape
 
-        data = nim.get_data()
         affine = nim.affine
-        g = np.zeros((timepoints, 1))
-        masktype = self.inputs.mask_type
-        if masktype == 'spm_global':  # spm_global like calculation
-            iflogger.debug('art: using spm global')
-            intersect_mask = self.inputs.intersect_mask
-            if intersect_mask:
-                mask = np.ones((x, y, z), dtype=bool)
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    # Use an SPM like approach
-                    mask_tmp = vol > \
-                        (_nanmean(vol) / self.inputs.global_threshold)
-                    mask = mask * mask_tmp
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    g[t0] = _nanmean(vol[mask])
-                if len(find_indices(mask)) < (np.prod((x, y, z)) / 10):
-                    intersect_mask = False
-                    g = np.zeros((timepoints, 1))
-            if not intersect_mask:
-                iflogger.info('not intersect_mask is True')
-                mask = np.zeros((x, y, z, timepoints))
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
-                    mask_tmp = vol > \
-                        (_nanmean(vol) / self.inputs.global_threshold)
-                    mask[:, :, :, t0] = mask_tmp
-                    g[t0] = np.nansum(vol * mask_tmp) / np.nansum(mask_tmp)
-        elif masktype == 'file':  # uses a mask image to determine intensity
+        mask = None
+        if self.inputs.mask_type == 'file':
             maskimg = load(self.inputs.mask_file)
-            mask = maskimg.get_data()
+            mask = maskimg.get_data() > 0.5
             affine = maskimg.affine
-            mask = mask > 0.5
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                g[t0] = _nanmean(vol[mask])
-        elif masktype == 'thresh':  # uses a fixed signal threshold
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
-                mask = vol > self.inputs.mask_threshold
-                g[t0] = _nanmean(vol[mask])
-        else:
-            mask = np.ones((x, y, z))
-            g = _nanmean(data[mask > 0, :], 1)
+        g, mask = _global_signal(nim, self.inputs.mask_type,
+                                 global_threshold=self.inputs.global_threshold,
+                                 intersect_mask=self.inputs.intersect_mask,
+                                 mask=mask,
+                                 mask_threshold=self.inputs.mask_threshold)
 
         # compute normalized intensity values
         gz = signal.detrend(g, axis=0)  # detrend the signal
@@ -447,10 +489,9 @@ class ArtifactDetect(BaseInterface):
             ridx = find_indices(normval < 0)
             if displacement is not None:
                 dmap = np.zeros((x, y, z, timepoints), dtype=np.float)
-                for i in range(timepoints):
-                    dmap[voxel_coords[0],
-                         voxel_coords[1],
-                         voxel_coords[2], i] = displacement[i, :]
+                dmap[voxel_coords[0],
+                     voxel_coords[1],
+                     voxel_coords[2]] = displacement.T
                 dimg = Nifti1Image(dmap, affine)
                 dimg.to_filename(displacementfile)
         else:
@@ -7,6 +7,8 @@ def test_MergeROIs_inputs():
     input_map = dict(in_files=dict(),
     in_index=dict(),
     in_reference=dict(),
+    memmap=dict(usedefault=True,
+    ),
     )
     inputs = MergeROIs.input_spec()
 
@@ -7,6 +7,8 @@ def test_SplitROIs_inputs():
     input_map = dict(in_file=dict(mandatory=True,
     ),
     in_mask=dict(),
+    memmap=dict(usedefault=True,
+    ),
     roi_size=dict(),
     )
     inputs = SplitROIs.input_spec()
@@ -17,7 +19,8 @@ def test_SplitROIs_inputs():
 
 
 def test_SplitROIs_outputs():
-    output_map = dict(out_files=dict(),
+    output_map = dict(out_data=dict(),
+    out_files=dict(),
     out_index=dict(),
     out_masks=dict(),
     )
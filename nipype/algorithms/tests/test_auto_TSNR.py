@@ -12,6 +12,7 @@ def test_TSNR_inputs():
     ),
     in_file=dict(mandatory=True,
     ),
+    max_memory_gb=dict(),
     mean_file=dict(hash_files=False,
     usedefault=True,
     ),
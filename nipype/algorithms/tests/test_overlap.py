@@ -3,6 +3,8 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 
+from __future__ import division
+
 import os
 from shutil import rmtree
 from tempfile import mkdtemp
@@ -49,3 +51,104 @@ def test_overlap():
 
     os.chdir(cwd)
     rmtree(tempdir)
+
+
+def test_min_distances():
+    from nipype.algorithms import metrics
+    from scipy.spatial.distance import cdist
+    import mock
+
+    rng = np.random.RandomState(0)
+    set1 = rng.uniform(-50, 50, (3, 200))
+    set2 = rng.uniform(-50, 50, (3, 300))
+    dist_matrix = cdist(set1.T, set2.T)
+    for max_pairs in (metrics._CDIST_MAX_PAIRS, 0):
+        # large sets are compared with a KD-tree
+        with mock.patch.object(metrics, '_CDIST_MAX_PAIRS', max_pairs):
+            distances, indices = metrics._min_distances(set1, set2)
+            hausdorff = metrics._hausdorff(set1, set2)
+        yield (np.testing.assert_almost_equal, distances,
+               dist_matrix.min(axis=0))
+        yield np.testing.assert_equal, indices, dist_matrix.argmin(axis=0)
+        yield (np.testing.assert_almost_equal, hausdorff,
+               max(dist_matrix.min(axis=0).max(),
+                   dist_matrix.min(axis=1).max()))
+
+
+def test_overlap_hausdorff():
+    from nipype.algorithms import metrics
+    import nibabel as nb
+
+    tempdir = mkdtemp()
+    in1 = example_data('segmentation0.nii.gz')
+    in2 = example_data('segmentation1.nii.gz')
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    res = metrics.Overlap(volume1=in1, volume2=in1,
+                          compute_hausdorff=True).run()
+    yield np.testing.assert_equal, res.outputs.roi_hausdorff, [0., 0., 0.]
+    res = metrics.Overlap(volume1=in1, volume2=in2,
+                          compute_hausdorff=True).run()
+    # the borders of each label in the whole volumes
+    nii1 = nb.load(in1)
+    data1 = nii1.get_data()
+    data2 = nb.load(in2).get_data()
+    expected = []
+    for label in res.outputs.labels:
+        expected.append(metrics._hausdorff(*[metrics._get_coordinates(
+            metrics._find_border(data == label), nii1.affine)
+            for data in (data1, data2)]))
+    yield (np.testing.assert_almost_equal, res.outputs.roi_hausdorff,
+           expected)
+    yield (np.testing.assert_almost_equal, res.outputs.hausdorff,
+           np.mean(expected))
+    # a label missing from volume2 is left out of the average
+    data2 = data2.copy()
+    data2[data2 == res.outputs.labels[-1]] = 0
+    nb.Nifti1Image(data2, nii1.affine, nii1.header).to_filename('missing.nii')
+    res = metrics.Overlap(volume1=in1, volume2='missing.nii',
+                          compute_hausdorff=True).run()
+    yield np.testing.assert_equal, np.isnan(res.outputs.roi_hausdorff), \
+        [False, False, True]
+    yield (np.testing.assert_almost_equal, res.outputs.roi_hausdorff[:2],
+           expected[:2])
+    yield (np.testing.assert_almost_equal, res.outputs.hausdorff,
+           np.mean(expected[:2]))
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+def test_overlap_many_labels():
+    from nipype.algorithms.metrics import Overlap
+    import nibabel as nb
+
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    data1 = rng.randint(0, 400, (20, 20, 20))
+    data2 = data1.copy()
+    data2[rng.uniform(size=data1.shape) < 0.2] = 7
+    nb.Nifti1Image(data1.astype(np.int16), np.eye(4)).to_filename('v1.nii')
+    nb.Nifti1Image(data2.astype(np.int16), np.eye(4)).to_filename('v2.nii')
+    labels = np.unique(data1[data1 > 0])
+    jaccard = [np.sum((data1 == l) & (data2 == l)) /
+               np.sum((data1 == l) | (data2 == l)) for l in labels]
+    voldiff = [(np.sum(data1 == l) - np.sum(data2 == l)) / np.sum(data1 == l)
+               for l in labels]
+    res = Overlap(volume1='v1.nii', volume2='v2.nii').run()
+    yield np.testing.assert_equal, res.outputs.labels, labels.tolist()
+    yield np.testing.assert_almost_equal, res.outputs.roi_ji, jaccard
+    yield np.testing.assert_almost_equal, res.outputs.roi_voldiff, voldiff
+    # volumes read in slabs give the same results
+    chunked = Overlap(volume1='v1.nii', volume2='v2.nii', chunk_size=3,
+                      out_file='chunked.nii').run()
+    for name in ('labels', 'jaccard', 'dice', 'volume_difference', 'roi_ji',
+                 'roi_di', 'roi_voldiff'):
+        yield (np.testing.assert_equal, getattr(chunked.outputs, name),
+               getattr(res.outputs, name))
+    yield (np.testing.assert_equal,
+           nb.load(chunked.outputs.diff_file).get_data(),
+           nb.load(res.outputs.diff_file).get_data())
+    os.chdir(cwd)
+    rmtree(tempdir)
@@ -0,0 +1,259 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Regression tests and benchmark of the ArtifactDetect core
+
+The reference functions below are the implementation that ArtifactDetect
+used before it streamed the images and batched the motion affines, the tests
+check that both give the same results on synthetic data. Run the module as
+a script to time both on a larger series, e.g.::
+
+    python test_rapidart_benchmark.py 64 64 40 1000
+"""
+from __future__ import division, print_function
+
+from builtins import range
+import os
+from shutil import rmtree
+import sys
+from tempfile import mkdtemp
+from time import time
+
+import numpy as np
+import nibabel as nb
+
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.algorithms import rapidart as ra
+
+
+def reference_affine_matrix(params, source):
+    params = np.array(params, dtype=float)
+    if source == 'FSL':
+        params = params[[3, 4, 5, 0, 1, 2]]
+    elif source in ('AFNI', 'FSFAST'):
+        params = params[np.asarray([4, 5, 3, 1, 2, 0]) + (len(params) > 6)]
+        params[3:] = params[3:] * np.pi / 180.
+    rotfunc = lambda x: np.array([[np.cos(x), np.sin(x)],
+                                  [-np.sin(x), np.cos(x)]])
+    q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
+    if len(params) < 12:
+        params = np.hstack((params, q[len(params):]))
+    T = np.eye(4)
+    T[0:3, -1] = params[0:3]
+    Rx = np.eye(4)
+    Rx[1:3, 1:3] = rotfunc(params[3])
+    Ry = np.eye(4)
+    Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotfunc(params[4]).ravel()
+    Rz = np.eye(4)
+    Rz[0:2, 0:2] = rotfunc(params[5])
+    S = np.eye(4)
+    S[0:3, 0:3] = np.diag(params[6:9])
+    Sh = np.eye(4)
+    Sh[(0, 0, 1), (1, 2, 2)] = params[9:12]
+    if source in ('AFNI', 'FSFAST'):
+        return np.dot(T, np.dot(Ry, np.dot(Rx, np.dot(Rz, np.dot(S, Sh)))))
+    return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
+
+
+def reference_calc_norm(mc, use_differences, source, brain_pts=None):
+    if brain_pts is None:
+        respos = np.diag([70, 70, 75])
+        resneg = np.diag([-70, -110, -45])
+        all_pts = np.vstack((np.hstack((respos, resneg)), np.ones((1, 6))))
+        displacement = None
+    else:
+        all_pts = brain_pts
+    n_pts = all_pts.size - all_pts.shape[1]
+    newpos = np.zeros((mc.shape[0], n_pts))
+    if brain_pts is not None:
+        displacement = np.zeros((mc.shape[0], int(n_pts / 3)))
+    for i in range(mc.shape[0]):
+        affine = reference_affine_matrix(mc[i, :], source)
+        newpos[i, :] = np.dot(affine, all_pts)[0:3, :].ravel()
+        if brain_pts is not None:
+            displacement[i, :] = np.sqrt(np.sum(np.power(
+                np.reshape(newpos[i, :], (3, all_pts.shape[1])) -
+                all_pts[0:3, :], 2), axis=0))
+    normdata = np.zeros(mc.shape[0])
+    if use_differences:
+        newpos = np.concatenate((np.zeros((1, n_pts)),
+                                 np.diff(newpos, n=1, axis=0)), axis=0)
+        for i in range(newpos.shape[0]):
+            normdata[i] = np.max(np.sqrt(np.sum(np.reshape(
+                np.power(np.abs(newpos[i, :]), 2),
+                (3, all_pts.shape[1])), axis=0)))
+    else:
+        newpos = np.abs(ra.signal.detrend(newpos, axis=0, type='constant'))
+        normdata = np.sqrt(np.mean(np.power(newpos, 2), axis=1))
+    return normdata, displacement
+
+
+def reference_global_signal(data, mask_type, global_threshold=8.,
+                            intersect_mask=True, mask=None,
+                            mask_threshold=None):
+    (x, y, z, timepoints) = data.shape
+    g = np.zeros((timepoints, 1))
+    if mask_type == 'spm_global':
+        if intersect_mask:
+            mask = np.ones((x, y, z), dtype=bool)
+            for t0 in range(timepoints):
+                vol = data[:, :, :, t0]
+                mask = mask * (vol > (ra._nanmean(vol) / global_threshold))
+            for t0 in range(timepoints):
+                vol = data[:, :, :, t0]
+                g[t0] = ra._nanmean(vol[mask])
+            if np.sum(mask) < (np.prod((x, y, z)) / 10):
+                intersect_mask = False
+                g = np.zeros((timepoints, 1))
+        if not intersect_mask:
+            mask = np.zeros((x, y, z, timepoints))
+            for t0 in range(timepoints):
+                vol = data[:, :, :, t0]
+                mask_tmp = vol > (ra._nanmean(vol) / global_threshold)
+                mask[:, :, :, t0] = mask_tmp
+                g[t0] = np.nansum(vol * mask_tmp) / np.nansum(mask_tmp)
+    elif mask_type == 'file':
+        for t0 in range(timepoints):
+            vol = data[:, :, :, t0]
+            g[t0] = ra._nanmean(vol[mask])
+    elif mask_type == 'thresh':
+        for t0 in range(timepoints):
+            vol = data[:, :, :, t0]
+            mask = vol > mask_threshold
+            g[t0] = ra._nanmean(vol[mask])
+    return g, mask
+
+
+def synthetic_series(shape, seed=0, scaled=False):
+    """Return a 4D image with a bright ellipsoid over a dark background, a
+    slow drift, a few spikes and a few nans, or a scaled int16 image without
+    nans
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.indices(shape[:3], dtype=float)
+    radius = np.sum([((g - n / 2.) / (n / 3.)) ** 2
+                     for g, n in zip(grid, shape[:3])], axis=0)
+    brain = np.where(radius < 1, 1000., 20.)
+    data = (brain[..., None] * (1 + 0.001 * np.arange(shape[3])) +
+            rng.normal(0, 10, shape)).astype(np.float32)
+    data[..., rng.randint(0, shape[3], 3)] *= 1.1
+    if scaled:
+        img = nb.Nifti1Image(np.round(data).astype(np.int16),
+                             np.diag([3., 3., 3., 1.]))
+        img.header.set_slope_inter(0.5, 10.)
+        return img
+    data[rng.randint(0, shape[0], 5), rng.randint(0, shape[1], 5),
+         rng.randint(0, shape[2], 5)] = np.nan
+    return nb.Nifti1Image(data, np.diag([3., 3., 3., 1.]))
+
+
+def time_global_signal(filename, **kwargs):
+    """Return the global signal computed by the reference and the streamed
+    implementations and their durations
+    """
+    t0 = time()
+    reference = reference_global_signal(nb.load(filename).get_data(),
+                                        'spm_global', **kwargs)
+    t1 = time()
+    streamed = ra._global_signal(nb.load(filename), 'spm_global', **kwargs)
+    return reference, streamed, t1 - t0, time() - t1
+
+
+def test_global_signal():
+    temp_dir = mkdtemp(prefix='test_rapidart_')
+    filename = os.path.join(temp_dir, 'func.nii')
+    for scaled in (False, True):
+        synthetic_series((12, 10, 8, 30), scaled=scaled).to_filename(filename)
+        data = nb.load(filename).get_data()
+        brain = data[..., 0] > 500
+        for mask_type, kwargs in [('spm_global', {}),
+                                  ('spm_global', dict(intersect_mask=False)),
+                                  ('spm_global', dict(global_threshold=1.)),
+                                  ('file', dict(mask=brain)),
+                                  ('thresh', dict(mask_threshold=500.))]:
+            g, mask = reference_global_signal(data, mask_type, **kwargs)
+            for chunk_size in (None, 1, 7):
+                # the image is memory mapped and read in chunks
+                vg, vmask = ra._global_signal(nb.load(filename), mask_type,
+                                              chunk_size=chunk_size, **kwargs)
+                yield assert_equal, vg, g
+                yield assert_equal, vmask.shape, mask.shape
+                yield assert_equal, np.sum(vmask != mask), 0
+    rmtree(temp_dir)
+
+
+def test_calc_norm():
+    rng = np.random.RandomState(0)
+    mc = np.hstack((rng.normal(0, 1, (40, 3)), rng.normal(0, 0.02, (40, 3))))
+    brain_pts = np.vstack((rng.uniform(-80, 80, (3, 50)), np.ones((1, 50))))
+    for source in ('SPM', 'FSL', 'AFNI'):
+        for use_differences in (True, False):
+            for pts in (None, brain_pts):
+                norm, disp = reference_calc_norm(mc, use_differences, source,
+                                                 brain_pts=pts)
+                vnorm, vdisp = ra._calc_norm(mc, use_differences, source,
+                                             brain_pts=pts)
+                yield assert_almost_equal, vnorm, norm, 10
+                if pts is not None:
+                    yield assert_almost_equal, vdisp, disp, 10
+
+
+def test_artifact_detect():
+    temp_dir = mkdtemp(prefix='test_rapidart_')
+    filename = os.path.join(temp_dir, 'func.nii')
+    img = synthetic_series((12, 10, 8, 30), scaled=True)
+    img.to_filename(filename)
+    motionfile = os.path.join(temp_dir, 'func.par')
+    mc = np.random.RandomState(0).normal(0, 0.01, (30, 6))
+    np.savetxt(motionfile, mc)
+    cwd = os.getcwd()
+    os.chdir(temp_dir)
+    ra.ArtifactDetect(realigned_files=filename,
+                      realignment_parameters=motionfile,
+                      parameter_source='SPM', norm_threshold=1,
+                      zintensity_threshold=3, mask_type='spm_global',
+                      intersect_mask=True, bound_by_brainmask=True,
+                      save_plot=False).run()
+    os.chdir(cwd)
+    g, mask = reference_global_signal(nb.load(filename).get_data(),
+                                      'spm_global')
+    yield assert_equal, np.loadtxt(os.path.join(
+        temp_dir, 'global_intensity.func.txt')), np.round(g.ravel(), 2)
+    coords = np.nonzero(mask)
+    brain_pts = np.dot(img.affine,
+                       np.vstack(coords + (np.ones(len(coords[0])),)))
+    norm, displacement = reference_calc_norm(mc, True, 'SPM', brain_pts)
+    dmap = nb.load(os.path.join(temp_dir, 'disp.func.nii')).get_data()
+    yield assert_almost_equal, dmap[coords], displacement.T, 10
+    yield assert_equal, np.sum(dmap[~mask]), 0
+    rmtree(temp_dir)
+
+
+def test_global_signal_benchmark():
+    # the timings are only printed when the module runs as a script
+    temp_dir = mkdtemp(prefix='test_rapidart_')
+    filename = os.path.join(temp_dir, 'func.nii')
+    synthetic_series((16, 16, 10, 40)).to_filename(filename)
+    (g, _), (vg, _), _, _ = time_global_signal(filename,
+                                               intersect_mask=False)
+    yield assert_equal, vg, g
+    rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    shape = tuple(int(arg) for arg in sys.argv[1:5]) or (64, 64, 40, 1000)
+    temp_dir = mkdtemp(prefix='test_rapidart_')
+    filename = os.path.join(temp_dir, 'func.nii')
+    synthetic_series(shape).to_filename(filename)
+    for intersect_mask in (True, False):
+        _, _, reference, streamed = time_global_signal(
+            filename, intersect_mask=intersect_mask)
+        print('intersect_mask=%s: %.3f s with the reference, %.3f s '
+              'streamed' % (intersect_mask, reference, streamed))
+    mc = np.random.RandomState(0).normal(0, 0.1, (shape[3], 6))
+    t0 = time()
+    reference_calc_norm(mc, True, 'SPM')
+    t1 = time()
+    ra._calc_norm(mc, True, 'SPM')
+    print('norm: %.3f s with the reference, %.3f s vectorized' % (
+        t1 - t0, time() - t1))
+    rmtree(temp_dir)
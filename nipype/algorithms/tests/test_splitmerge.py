@@ -36,3 +36,58 @@ def test_split_and_merge():
     rmtree(tmpdir)
 
     yield assert_equal, np.allclose(dwmasked, dwmerged), True
+
+
+def test_split_and_merge_memmap():
+    import numpy as np
+    import nibabel as nb
+    import os.path as op
+    import os
+    cwd = os.getcwd()
+
+    from nipype.algorithms.misc import (split_rois, merge_rois, load_roi,
+                                        SplitROIs, MergeROIs)
+    tmpdir = mkdtemp()
+
+    in_mask = example_data('tpms_msk.nii.gz')
+    dwfile = op.join(tmpdir, 'dwi.nii.gz')
+    mskdata = nb.load(in_mask).get_data()
+    aff = nb.load(in_mask).affine
+
+    dwshape = (mskdata.shape[0], mskdata.shape[1], mskdata.shape[2], 6)
+    dwdata = np.random.normal(size=dwshape).astype(np.float32)
+    os.chdir(tmpdir)
+    nb.Nifti1Image(dwdata, aff, None).to_filename(dwfile)
+    dwmasked = dwdata * mskdata[:, :, :, np.newaxis]
+
+    resdw, _, resid = split_rois(dwfile, in_mask, roishape=(20, 20, 2),
+                                 memmap=True)
+    # the ROIs are views of the time series of the voxels in the mask
+    inside = dwdata[mskdata > 0]
+    yield assert_equal, np.sum(np.vstack([load_roi(f) for f in resdw]) !=
+                               inside), 0
+
+    # the ROIs can be merged as they are, or processed and saved as arrays
+    for memmap in (False, True):
+        merged = merge_rois(resdw, resid, in_mask, memmap=memmap,
+                            out_file=op.abspath('merged%d.nii.gz' % memmap))
+        yield assert_equal, np.sum(nb.load(merged).get_data() != dwmasked), 0
+    processed = []
+    for i, fname in enumerate(resdw):
+        processed.append(op.abspath('processed%d.npy' % i))
+        np.save(processed[-1], 2 * load_roi(fname))
+    merged = merge_rois(processed, resid, in_mask, memmap=True)
+    yield assert_equal, np.allclose(nb.load(merged).get_data(),
+                                    2 * dwmasked), True
+
+    split = SplitROIs(in_file=dwfile, in_mask=in_mask, roi_size=(20, 20, 2),
+                      memmap=True).run()
+    yield assert_equal, split.outputs.out_files, resdw
+    yield assert_equal, op.getsize(split.outputs.out_data), inside.nbytes
+    merge = MergeROIs(in_files=split.outputs.out_files,
+                      in_index=split.outputs.out_index,
+                      in_reference=in_mask, memmap=True).run()
+    yield assert_equal, np.sum(nb.load(
+        merge.outputs.merged_file).get_data() != dwmasked), 0
+    os.chdir(cwd)
+    rmtree(tmpdir)
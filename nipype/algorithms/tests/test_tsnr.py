@@ -0,0 +1,53 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+
+from nipype.testing import assert_equal
+from nipype.algorithms.misc import TSNR
+
+
+def test_tsnr_blocks():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    shape = (10, 9, 8, 50)
+    for dtype in (np.float32, np.int16, np.uint16):
+        data = (1000 + rng.normal(0, 20, shape) +
+                2 * np.arange(shape[3])).astype(dtype)
+        data[0, 0, 0, 0] = 0
+        nb.Nifti1Image(data, np.eye(4)).to_filename('func.nii')
+        # whole data, and blocks of 3 slices read from memory mapped files
+        inputs = [('func.nii', {}),
+                  ('func.nii', dict(max_memory_gb=(5 * 8 * 10 * 9 * 50 * 3 /
+                                                   2. ** 30)))]
+        # a list of 3D files
+        volumes = []
+        for i in range(shape[3]):
+            volumes.append('vol%d.nii' % i)
+            nb.Nifti1Image(data[..., i], np.eye(4)).to_filename(volumes[-1])
+        inputs.append((volumes, dict(max_memory_gb=1e-5)))
+        results = []
+        for i, (in_file, kwargs) in enumerate(inputs):
+            res = TSNR(in_file=in_file, regress_poly=2,
+                       tsnr_file='tsnr%d.nii.gz' % i,
+                       mean_file='mean%d.nii.gz' % i,
+                       stddev_file='stdev%d.nii.gz' % i,
+                       detrended_file='detrend%d.nii.gz' % i, **kwargs).run()
+            results.append([nb.load(getattr(res.outputs, name)).get_data()
+                            for name in ('tsnr_file', 'mean_file',
+                                         'stddev_file', 'detrended_file')])
+            # integer inputs are detrended as float32
+            yield assert_equal, nb.load(
+                res.outputs.detrended_file).get_data_dtype(), np.float32
+        for result in results[1:]:
+            for expected, value in zip(results[0], result):
+                yield assert_equal, value.shape, expected.shape
+                yield assert_equal, np.sum(value != expected), 0
+    os.chdir(cwd)
+    rmtree(tempdir)
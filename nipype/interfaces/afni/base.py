@@ -10,7 +10,8 @@ from future.utils import raise_from
 from ... import logging
 from ...utils.filemanip import split_filename
 from ..base import (
-    CommandLine, traits, CommandLineInputSpec, isdefined, File, TraitedSpec)
+    CommandLine, traits, CommandLineInputSpec, isdefined, File, TraitedSpec,
+    get_version_cache)
 
 # Use nipype's logging system
 IFLOGGER = logging.getLogger('interface')
@@ -38,6 +39,15 @@ class Info(object):
            Version number as string or None if AFNI not found
 
         """
+        version = get_version_cache().get(
+            'afni', (os.getenv('PATH', ''),), Info._probe_version)
+        if isinstance(version, list):
+            # versions read back from the nipype data file
+            version = tuple(version)
+        return version
+
+    @staticmethod
+    def _probe_version():
         try:
             clout = CommandLine(command='afni_vcheck',
                                 terminal_output='allatonce').run()
@@ -29,8 +29,10 @@ import select
 import subprocess
 import sys
 import random
+import threading
 import time
 import fnmatch
+import json
 from textwrap import wrap
 from datetime import datetime as dt
 from dateutil.parser import parse as parseutc
@@ -43,9 +45,8 @@ from .traits_extension import (traits, Undefined, TraitDictObject,
                                has_metadata)
 from ..utils.filemanip import (md5, hash_infile, FileNotFoundError,
                                hash_timestamp, save_json,
-                               split_filename)
+                               split_filename, get_file_hashes)
 from ..utils.misc import is_container, trim, str2bool
-from ..utils.provenance import write_provenance
 from .. import config, logging, LooseVersion
 from .. import __version__
 from ..external.six import string_types, text_type
@@ -74,26 +75,124 @@ class NipypeInterfaceError(Exception):
     def __str__(self):
         return repr(self.value)
 
+# resolved executables, keyed on the command and the search path
+_executable_cache = {}
+
+
 def _exists_in_path(cmd, environ):
     '''
     Based on a code snippet from
      http://orip.org/2009/08/python-checking-if-executable-exists-in.html
+
+    Executables that are found are cached for the command and search path,
+    according to the ``executable_cache`` execution option: ``stat`` checks
+    that a cached executable still exists, ``true`` trusts the cache and
+    ``false`` searches the path every time.
     '''
 
     if 'PATH' in environ:
         input_environ = environ.get("PATH")
     else:
         input_environ = os.environ.get("PATH", "")
-    extensions = os.environ.get("PATHEXT", "").split(os.pathsep)
+    pathext = os.environ.get("PATHEXT", "")
+    mode = config.get('execution', 'executable_cache').lower()
+    key = (cmd, input_environ, pathext)
+    if mode != 'false' and key in _executable_cache:
+        filename = _executable_cache[key]
+        if mode != 'stat' or os.path.exists(filename):
+            return True, filename
+        del _executable_cache[key]
+    extensions = pathext.split(os.pathsep)
     for directory in input_environ.split(os.pathsep):
         base = os.path.join(directory, cmd)
         options = [base] + [(base + ext) for ext in extensions]
         for filename in options:
             if os.path.exists(filename):
+                if mode != 'false':
+                    _executable_cache[key] = filename
                 return True, filename
     return False, None
 
 
+class VersionCache(object):
+    """Cache of the versions reported by external tools
+
+    Finding the version of a tool may start a process (e.g., MATLAB for
+    SPM), hence the ``Info`` classes of the interfaces probe the version once
+    per tool and environment. Entries expire after ``version_cache_ttl``
+    seconds, and are shared across processes through the nipype data file
+    (see :meth:`NipypeConfig.save_data`) when ``version_cache_persist`` is
+    set. Failed probes, returning None, are not cached.
+    """
+
+    data_key = 'version_cache'
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(tool, environment):
+        return json.dumps([tool] + [str(value) for value in environment])
+
+    def get(self, tool, environment, probe):
+        """Return the version of a tool
+
+        Parameters
+        ----------
+        tool : str
+            name of the tool
+        environment : sequence
+            the settings that determine which installation of the tool is
+            used, e.g., the installation directory and search path
+        probe : callable
+            function returning the version when it is not cached
+        """
+        ttl = float(config.get('execution', 'version_cache_ttl'))
+        if ttl <= 0:
+            return probe()
+        persist = str2bool(config.get('execution', 'version_cache_persist'))
+        key = self._key(tool, environment)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None and persist:
+            entry = (config.get_data(self.data_key) or {}).get(key)
+        if entry is not None and now - entry[1] < ttl:
+            with self._lock:
+                self._entries[key] = entry
+            return entry[0]
+        version = probe()
+        if version is None:
+            # the tool may be found next time
+            return version
+        entry = (version, now)
+        with self._lock:
+            self._entries[key] = entry
+        if persist:
+            try:
+                json.dumps(version)
+            except TypeError:
+                return version
+            data = config.get_data(self.data_key) or {}
+            data[key] = entry
+            config.save_data(self.data_key, data)
+        return version
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_version_cache = VersionCache()
+
+
+def get_version_cache():
+    """Return the cache of the versions of external tools
+    """
+    return _version_cache
+
+
 def load_template(name):
     """Load a template from the script_templates directory
 
@@ -208,14 +307,7 @@ class Bunch(object):
         file_list = []
         for afile in stuff:
             if os.path.isfile(afile):
-                md5obj = md5()
-                with open(afile, 'rb') as fp:
-                    while True:
-                        data = fp.read(8192)
-                        if not data:
-                            break
-                        md5obj.update(data)
-                md5hex = md5obj.hexdigest()
+                md5hex = hash_infile(afile, crypto=md5)
             else:
                 md5hex = None
             file_list.append((afile, md5hex))
@@ -536,7 +628,7 @@ class BaseTraitedSpec(traits.HasTraits):
                     out = undefinedval
         return out
 
-    def get_hashval(self, hash_method=None):
+    def get_hashval(self, hash_method=None, hash_settings=None):
         """Return a dictionary of our items with hashes for each file.
 
         Searches through dictionary items and if an item is a file, it
@@ -547,6 +639,16 @@ class BaseTraitedSpec(traits.HasTraits):
         value of a file. The path and name of the file are not used in
         the overall hash calculation.
 
+        Parameters
+        ----------
+        hash_method : str
+            ``timestamp`` or ``content``, default to the global execution
+            option
+        hash_settings : dict
+            content hash configuration (see
+            :func:`~nipype.utils.filemanip.content_hash_settings`), default
+            to the global execution options
+
         Returns
         -------
         dict_withhash : dict
@@ -557,8 +659,9 @@ class BaseTraitedSpec(traits.HasTraits):
 
         """
 
-        dict_withhash = []
-        dict_nofilename = []
+        if hash_method is None:
+            hash_method = config.get('execution', 'hash_method')
+        items = []
         for name, val in sorted(self.get().items()):
             if isdefined(val):
                 trait = self.trait(name)
@@ -567,16 +670,46 @@ class BaseTraitedSpec(traits.HasTraits):
                 hash_files = (not has_metadata(trait.trait_type, "hash_files",
                                                False) and not
                               has_metadata(trait.trait_type, "name_source"))
-                dict_nofilename.append((name,
-                                        self._get_sorteddict(val, hash_method=hash_method,
-                                                             hash_files=hash_files)))
-                dict_withhash.append((name,
-                                      self._get_sorteddict(val, True, hash_method=hash_method,
-                                                           hash_files=hash_files)))
+                items.append((name, val, hash_files))
+        # hash all the files at once, so that they can be hashed in parallel
+        fnames = []
+        for _, val, hash_files in items:
+            if hash_files:
+                self._collect_strings(val, fnames)
+        file_hashes = get_file_hashes(
+            fnames, hash_method,
+            num_threads=int(config.get('execution', 'file_hash_threads')),
+            settings=hash_settings)
+        dict_withhash = []
+        dict_nofilename = []
+        for name, val, hash_files in items:
+            dict_nofilename.append((name,
+                                    self._get_sorteddict(val, hash_method=hash_method,
+                                                         hash_files=hash_files,
+                                                         file_hashes=file_hashes,
+                                                         hash_settings=hash_settings)))
+            dict_withhash.append((name,
+                                  self._get_sorteddict(val, True, hash_method=hash_method,
+                                                       hash_files=hash_files,
+                                                       file_hashes=file_hashes,
+                                                       hash_settings=hash_settings)))
         return dict_withhash, md5(str(dict_nofilename).encode()).hexdigest()
 
+    def _collect_strings(self, object, out):
+        """Append the defined strings (candidate file names) in object to out
+        """
+        if isinstance(object, dict):
+            for val in object.values():
+                self._collect_strings(val, out)
+        elif isinstance(object, (list, tuple)):
+            for val in object:
+                self._collect_strings(val, out)
+        elif isdefined(object) and isinstance(object, string_types):
+            out.append(object)
+
     def _get_sorteddict(self, object, dictwithhash=False, hash_method=None,
-                        hash_files=True):
+                        hash_files=True, file_hashes=None,
+                        hash_settings=None):
         if isinstance(object, dict):
             out = []
             for key, val in sorted(object.items()):
@@ -584,29 +717,45 @@ class BaseTraitedSpec(traits.HasTraits):
                     out.append((key,
                                 self._get_sorteddict(val, dictwithhash,
                                                      hash_method=hash_method,
-                                                     hash_files=hash_files)))
+                                                     hash_files=hash_files,
+                                                     file_hashes=file_hashes,
+                                                     hash_settings=hash_settings)))
         elif isinstance(object, (list, tuple)):
             out = []
             for val in object:
                 if isdefined(val):
                     out.append(self._get_sorteddict(val, dictwithhash,
                                                     hash_method=hash_method,
-                                                    hash_files=hash_files))
+                                                    hash_files=hash_files,
+                                                    file_hashes=file_hashes,
+                                                    hash_settings=hash_settings))
             if isinstance(object, tuple):
                 out = tuple(out)
         else:
             if isdefined(object):
                 if (hash_files and isinstance(object, string_types) and
-                        os.path.isfile(object)):
-                    if hash_method is None:
-                        hash_method = config.get('execution', 'hash_method')
-
-                    if hash_method.lower() == 'timestamp':
-                        hash = hash_timestamp(object)
-                    elif hash_method.lower() == 'content':
-                        hash = hash_infile(object)
-                    else:
-                        raise Exception("Unknown hash method: %s" % hash_method)
+                        file_hashes is not None and object in file_hashes):
+                    # precomputed, None if object is not a file
+                    hash = file_hashes[object]
+                    is_file = hash is not None
+                else:
+                    is_file = (hash_files and
+                               isinstance(object, string_types) and
+                               os.path.isfile(object))
+                    if is_file:
+                        if hash_method is None:
+                            hash_method = config.get('execution',
+                                                     'hash_method')
+
+                        if hash_method.lower() == 'timestamp':
+                            hash = hash_timestamp(object)
+                        elif hash_method.lower() == 'content':
+                            hash = hash_infile(object,
+                                               settings=hash_settings)
+                        else:
+                            raise Exception("Unknown hash method: %s" %
+                                            hash_method)
+                if is_file:
                     if dictwithhash:
                         out = (object, hash)
                     else:
@@ -1051,6 +1200,7 @@ class BaseInterface(Interface):
                                       outputs=outputs)
             prov_record = None
             if str2bool(config.get('execution', 'write_provenance')):
+                from ..utils.provenance import write_provenance
                 prov_record = write_provenance(results)
             results.provenance = prov_record
         except Exception as e:
@@ -1088,6 +1238,7 @@ class BaseInterface(Interface):
             results = InterfaceResult(interface, runtime, inputs=inputs)
             prov_record = None
             if str2bool(config.get('execution', 'write_provenance')):
+                from ..utils.provenance import write_provenance
                 try:
                     prov_record = write_provenance(results)
                 except Exception:
@@ -1179,8 +1330,15 @@ class Stream(object):
         "Read from the file descriptor"
         fd = self.fileno()
         buf = os.read(fd, 4096).decode(self.default_encoding)
-        if not buf and not self._buf:
-            return None
+        if not buf:
+            # end of file, flush any partial line left in the buffer
+            if not self._buf:
+                return None
+            drain = 1
+        return self._split(buf, drain)
+
+    def _split(self, buf, drain):
+        "Split the data read into lines, keeping a partial last line"
         if '\n' not in buf:
             if not drain:
                 self._buf += buf
@@ -1192,7 +1350,7 @@ class Stream(object):
             tmp, rest = buf.rsplit('\n', 1)
         else:
             tmp = buf
-            rest = None
+            rest = ''
         self._buf = rest
         now = datetime.datetime.now().isoformat()
         rows = tmp.split('\n')
@@ -1201,6 +1359,7 @@ class Stream(object):
         for idx in range(self._lastidx, len(self._rows)):
             iflogger.info(self._rows[idx][1])
         self._lastidx = len(self._rows)
+        return rows
 
 
 # Get number of threads for process
@@ -1350,15 +1509,73 @@ def get_max_resources_used(pid, mem_mb, num_threads, pyfunc=False):
     return mem_mb, num_threads
 
 
+class ResourceSampler(threading.Thread):
+    """Thread sampling the peak memory and threads used by a process
+
+    The process is sampled every ``interval`` seconds until :meth:`stop` is
+    called, independently of how the output of the process is collected.
+    """
+
+    def __init__(self, pid, interval=0.5, pyfunc=False):
+        super(ResourceSampler, self).__init__()
+        self.daemon = True
+        self.pid = pid
+        self.interval = interval
+        self.pyfunc = pyfunc
+        self.mem_mb = 0
+        self.num_threads = 1
+        self._done = threading.Event()
+
+    def run(self):
+        while not self._done.is_set():
+            self.mem_mb, self.num_threads = get_max_resources_used(
+                self.pid, self.mem_mb, self.num_threads, pyfunc=self.pyfunc)
+            self._done.wait(self.interval)
+
+    def stop(self):
+        """Stop sampling and return the peak memory (MB) and threads
+        """
+        self._done.set()
+        self.join()
+        return self.mem_mb, self.num_threads
+
+
+def _read_streams(streams, proc, interval=0.1):
+    """Read the streams as soon as data is available, until they are closed
+    or the process has exited and the data it wrote has been read
+
+    Streams kept open by children of the process (e.g. daemons) are
+    abandoned once the process has exited and they have been drained.
+    """
+    streams = list(streams)
+    while streams:
+        exited = proc.poll() is not None
+        try:
+            ready, _, _ = select.select(streams, [], [], interval)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        for stream in ready:
+            if stream._read(0) is None:
+                streams.remove(stream)
+        if exited and not ready:
+            break
+    for stream in streams:
+        if stream._buf:
+            stream._split('', 1)
+
+
 def run_command(runtime, output=None, timeout=0.01, redirect_x=False):
     """Run a command, read stdout and stderr, prefix with timestamp.
 
-    The returned runtime contains a merged stdout+stderr log with timestamps
+    The returned runtime contains a merged stdout+stderr log with timestamps.
+    Output is read as soon as it becomes available and the call returns as
+    soon as the command exits. When runtime profiling is enabled, resources
+    are sampled by a separate thread. ``timeout`` is unused and only kept
+    for backwards compatibility.
     """
 
-    # Init logger
-    logger = logging.getLogger('workflow')
-
     # Init variables
     PIPE = subprocess.PIPE
     cmdline = runtime.cmdline
@@ -1398,31 +1615,15 @@ def run_command(runtime, output=None, timeout=0.01, redirect_x=False):
     # Init variables for memory profiling
     mem_mb = 0
     num_threads = 1
-    interval = .5
+    sampler = None
+    if runtime_profile:
+        sampler = ResourceSampler(proc.pid)
+        sampler.start()
 
     if output == 'stream':
         streams = [Stream('stdout', proc.stdout), Stream('stderr', proc.stderr)]
-
-        def _process(drain=0):
-            try:
-                res = select.select(streams, [], [], timeout)
-            except select.error as e:
-                iflogger.info(str(e))
-                if e[0] == errno.EINTR:
-                    return
-                else:
-                    raise
-            else:
-                for stream in res[0]:
-                    stream.read(drain)
-        while proc.returncode is None:
-            if runtime_profile:
-                mem_mb, num_threads = \
-                    get_max_resources_used(proc.pid, mem_mb, num_threads)
-            proc.poll()
-            _process()
-            time.sleep(interval)
-        _process(drain=1)
+        _read_streams(streams, proc)
+        proc.wait()
 
         # collect results, merge and return
         result = {}
@@ -1435,12 +1636,6 @@ def run_command(runtime, output=None, timeout=0.01, redirect_x=False):
         result['merged'] = [r[1] for r in temp]
 
     if output == 'allatonce':
-        if runtime_profile:
-            while proc.returncode is None:
-                mem_mb, num_threads = \
-                    get_max_resources_used(proc.pid, mem_mb, num_threads)
-                proc.poll()
-                time.sleep(interval)
         stdout, stderr = proc.communicate()
         stdout = stdout.decode(default_encoding)
         stderr = stderr.decode(default_encoding)
@@ -1448,12 +1643,6 @@ def run_command(runtime, output=None, timeout=0.01, redirect_x=False):
         result['stderr'] = stderr.split('\n')
         result['merged'] = ''
     if output == 'file':
-        if runtime_profile:
-            while proc.returncode is None:
-                mem_mb, num_threads = \
-                    get_max_resources_used(proc.pid, mem_mb, num_threads)
-                proc.poll()
-                time.sleep(interval)
         ret_code = proc.wait()
         stderr.flush()
         stdout.flush()
@@ -1461,17 +1650,14 @@ def run_command(runtime, output=None, timeout=0.01, redirect_x=False):
         result['stderr'] = [line.decode(default_encoding).strip() for line in open(errfile, 'rb').readlines()]
         result['merged'] = ''
     if output == 'none':
-        if runtime_profile:
-            while proc.returncode is None:
-                mem_mb, num_threads = \
-                    get_max_resources_used(proc.pid, mem_mb, num_threads)
-                proc.poll()
-                time.sleep(interval)
         proc.communicate()
         result['stdout'] = []
         result['stderr'] = []
         result['merged'] = ''
 
+    if sampler is not None:
+        mem_mb, num_threads = sampler.stop()
+
     setattr(runtime, 'runtime_memory_gb', mem_mb/1024.0)
     setattr(runtime, 'runtime_threads', num_threads)
     runtime.stderr = '\n'.join(result['stderr'])
@@ -1481,29 +1667,53 @@ def run_command(runtime, output=None, timeout=0.01, redirect_x=False):
     return runtime
 
 
-def get_dependencies(name, environ):
+# library dependencies, keyed on the device, inode and modification time
+# of the executable
+_dependencies_cache = {}
+
+
+def get_dependencies(name, environ, path=None):
     """Return library dependencies of a dynamically linked executable
 
     Uses otool on darwin, ldd on linux. Currently doesn't support windows.
 
+    When the ``path`` of the executable is given, the dependencies are
+    cached until the executable is modified or replaced.
+
     """
+    key = None
+    if path is not None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            pass
+        else:
+            key = (path, stat.st_dev, stat.st_ino, stat.st_mtime)
+            if key in _dependencies_cache:
+                return _dependencies_cache[key]
     PIPE = subprocess.PIPE
     if sys.platform == 'darwin':
-        proc = subprocess.Popen('otool -L `which %s`' % name,
+        command = 'otool -L'
+    elif 'linux' in sys.platform:
+        command = 'ldd'
+    else:
+        return 'Platform %s not supported' % sys.platform
+    if key is None:
+        proc = subprocess.Popen('%s `which %s`' % (command, name),
                                 stdout=PIPE,
                                 stderr=PIPE,
                                 shell=True,
                                 env=environ)
-    elif 'linux' in sys.platform:
-        proc = subprocess.Popen('ldd `which %s`' % name,
+    else:
+        proc = subprocess.Popen(command.split() + [path],
                                 stdout=PIPE,
                                 stderr=PIPE,
-                                shell=True,
                                 env=environ)
-    else:
-        return 'Platform %s not supported' % sys.platform
     o, e = proc.communicate()
-    return o.rstrip()
+    dependencies = o.rstrip()
+    if key is not None:
+        _dependencies_cache[key] = dependencies
+    return dependencies
 
 
 class CommandLineInputSpec(BaseInterfaceInputSpec):
@@ -1644,17 +1854,23 @@ class CommandLine(BaseInterface):
     def version_from_command(self, flag='-v'):
         cmdname = self.cmd.split()[0]
         env = dict(os.environ)
-        if _exists_in_path(cmdname, env):
-            out_environ = self._get_environ()
-            env.update(out_environ)
-            proc = subprocess.Popen(' '.join((cmdname, flag)),
-                                    shell=True,
-                                    env=env,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    )
-            o, e = proc.communicate()
-            return o
+        out_environ = self._get_environ()
+        env.update(out_environ)
+
+        def _probe():
+            if _exists_in_path(cmdname, env)[0]:
+                proc = subprocess.Popen(' '.join((cmdname, flag)),
+                                        shell=True,
+                                        env=env,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE,
+                                        )
+                o, e = proc.communicate()
+                return o
+
+        return get_version_cache().get(
+            'command', (cmdname, flag, sorted(out_environ.items()),
+                        env.get('PATH', '')), _probe)
 
     def _run_wrapper(self, runtime):
         runtime = self._run_interface(runtime)
@@ -1686,7 +1902,8 @@ class CommandLine(BaseInterface):
                           (self.cmd.split()[0], runtime.hostname))
         setattr(runtime, 'command_path', cmd_path)
         setattr(runtime, 'dependencies', get_dependencies(executable_name,
-                                                          runtime.environ))
+                                                          runtime.environ,
+                                                          path=cmd_path))
         runtime = run_command(runtime, output=self.inputs.terminal_output,
                               redirect_x=self._redirect_x)
         if runtime.returncode is None or \
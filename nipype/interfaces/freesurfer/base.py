@@ -21,7 +21,7 @@ import os
 
 from ..base import (CommandLine, Directory,
                     CommandLineInputSpec, isdefined,
-                    traits, TraitedSpec, File)
+                    traits, TraitedSpec, File, get_version_cache)
 from ...utils.filemanip import fname_presuffix
 
 
@@ -55,13 +55,16 @@ class Info(object):
         fs_home = os.getenv('FREESURFER_HOME')
         if fs_home is None:
             return None
-        versionfile = os.path.join(fs_home, 'build-stamp.txt')
-        if not os.path.exists(versionfile):
-            return None
-        fid = open(versionfile, 'rt')
-        version = fid.readline()
-        fid.close()
-        return version
+
+        def _probe():
+            versionfile = os.path.join(fs_home, 'build-stamp.txt')
+            if not os.path.exists(versionfile):
+                return None
+            fid = open(versionfile, 'rt')
+            version = fid.readline()
+            fid.close()
+            return version
+        return get_version_cache().get('freesurfer', (fs_home,), _probe)
 
     @classmethod
     def subjectsdir(cls):
@@ -34,7 +34,8 @@ import warnings
 from ...utils.filemanip import fname_presuffix, split_filename, copyfile
 from ..base import (traits, isdefined,
                     CommandLine, CommandLineInputSpec, TraitedSpec,
-                    File, Directory, InputMultiPath, OutputMultiPath)
+                    File, Directory, InputMultiPath, OutputMultiPath,
+                    get_version_cache)
 
 warn = warnings.warn
 
@@ -74,8 +75,11 @@ class Info(object):
             basedir = os.environ['FSLDIR']
         except KeyError:
             return None
-        out = open('%s/etc/fslversion' % (basedir)).read()
-        return out.strip('\n')
+
+        def _probe():
+            out = open('%s/etc/fslversion' % (basedir)).read()
+            return out.strip('\n')
+        return get_version_cache().get('fsl', (basedir,), _probe)
 
     @classmethod
     def output_type_to_ext(cls, output_type):
@@ -1,11 +1,22 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """ General matlab interface code """
+import errno
 import os
+import select
+import subprocess
+import threading
+import time
+from multiprocessing import current_process, util
+from multiprocessing.managers import BaseManager
+from shutil import rmtree
+from tempfile import mkdtemp
 
 from .base import (CommandLineInputSpec, InputMultiPath, isdefined,
-                   CommandLine, traits, File, Directory)
-from .. import config
+                   CommandLine, traits, File, Directory, _exists_in_path)
+from .. import config, logging
+
+iflogger = logging.getLogger('interface')
 
 
 def get_matlab_command():
@@ -28,6 +39,283 @@ def get_matlab_command():
 no_matlab = get_matlab_command() is None
 
 
+# printed by an engine to stdout and stderr after each job
+ENGINE_DONE = 'NIPYPE_ENGINE_DONE'
+
+# m-code run by the engines: run the m-files whose paths are read from the
+# standard input, restoring the working directory and the matlab path
+# after each of them
+ENGINE_SCRIPT = """
+setappdata(0, 'nipype_engine', struct('path', path, 'cwd', pwd));
+while true,
+    try,
+        nipype_job = input('', 's');
+    catch,
+        break;
+    end;
+    if isempty(nipype_job) || strcmp(nipype_job, 'exit'),
+        break;
+    end;
+    try,
+        run(nipype_job);
+    catch ME,
+        fprintf(2, 'MATLAB code threw an exception:\\n%%s\\n', ME.message);
+    end;
+    nipype_engine = getappdata(0, 'nipype_engine');
+    path(nipype_engine.path);
+    cd(nipype_engine.cwd);
+    clear variables;
+    fprintf(1, '\\n%(done)s\\n');
+    fprintf(2, '\\n%(done)s\\n');
+end;
+exit;
+""" % dict(done=ENGINE_DONE)
+
+
+class MatlabEngine(object):
+    """A long-lived MATLAB (or MCR) process running m-files
+
+    The paths of the m-files to run are written to the standard input of the
+    engine, which reports the end of each job on its standard output and
+    error. ``command`` is the command line starting the engine, where ``%s``
+    is replaced by the path of the m-file with the engine loop.
+    """
+
+    def __init__(self, command, environ=None):
+        self.command = command
+        self._dir = mkdtemp(prefix='nipype_engine_')
+        server = os.path.join(self._dir, 'nipype_engine.m')
+        with open(server, 'wt') as fp:
+            fp.write(ENGINE_SCRIPT)
+        self.proc = subprocess.Popen(command % server, shell=True,
+                                     cwd=self._dir, env=environ,
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE)
+        iflogger.debug('Started MATLAB engine %d: %s', self.proc.pid,
+                       command % server)
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def run(self, mfile):
+        """Run an m-file and return its return code, stdout and stderr
+
+        The return code is that of the engine when it exits while running
+        the m-file, e.g. when the m-file calls ``exit``, and 0 otherwise.
+        The engine is not reused once it exited.
+        """
+        try:
+            self.proc.stdin.write(('%s\n' % mfile).encode())
+            self.proc.stdin.flush()
+        except (IOError, OSError):
+            pass
+        done = ('\n%s\n' % ENGINE_DONE).encode()
+        output = {self.proc.stdout.fileno(): b'',
+                  self.proc.stderr.fileno(): b''}
+        pending = list(output)
+        while pending:
+            try:
+                ready, _, _ = select.select(pending, [], [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in ready:
+                data = os.read(fd, 4096)
+                output[fd] += data
+                if not data or output[fd].endswith(done):
+                    pending.remove(fd)
+        returncode = 0
+        if not all(value.endswith(done) for value in output.values()):
+            returncode = self.proc.wait()
+        stdout, stderr = [output[stream.fileno()].split(done)[0].decode()
+                          for stream in (self.proc.stdout, self.proc.stderr)]
+        return returncode, stdout, stderr
+
+    def close(self, timeout=5):
+        """Ask the engine to exit, kill it after ``timeout`` seconds"""
+        try:
+            self.proc.stdin.write(b'exit\n')
+            self.proc.stdin.close()
+        except (IOError, OSError, ValueError):
+            pass
+        start = time.time()
+        while self.alive and time.time() - start < timeout:
+            time.sleep(0.05)
+        if self.alive:
+            self.proc.kill()
+            self.proc.wait()
+        self.proc.stdout.close()
+        self.proc.stderr.close()
+        rmtree(self._dir, ignore_errors=True)
+
+
+class MatlabEnginePool(object):
+    """Pool of at most ``maxsize`` MATLAB engines
+
+    Engines are kept running between jobs and reused by the jobs using the
+    same command and environment. When the pool is full, an idle engine of
+    another command is closed to make room, otherwise jobs wait for an
+    engine to become idle.
+    """
+
+    def __init__(self, maxsize=1):
+        self.maxsize = maxsize
+        self._idle = {}
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self, key, command, environ):
+        with self._cond:
+            while True:
+                if self._idle.get(key):
+                    return self._idle[key].pop()
+                if self._count < self.maxsize:
+                    self._count += 1
+                    break
+                others = [engines for engines in self._idle.values()
+                          if engines]
+                if others:
+                    others[0].pop().close()
+                    self._count -= 1
+                    continue
+                self._cond.wait()
+        try:
+            return MatlabEngine(command, environ=environ)
+        except Exception:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, key, engine):
+        with self._cond:
+            if engine.alive:
+                self._idle.setdefault(key, []).append(engine)
+            else:
+                engine.close()
+                self._count -= 1
+            self._cond.notify()
+
+    def run(self, command, mfile, environ=None):
+        """Run an m-file on an engine started with ``command``
+
+        Returns the return code, stdout and stderr of the job.
+        """
+        key = (command, tuple(sorted((environ or {}).items())))
+        engine = self._acquire(key, command, environ)
+        try:
+            result = engine.run(mfile)
+        except Exception:
+            # the state of the engine is unknown
+            engine.close(timeout=0)
+            self._release(key, engine)
+            raise
+        self._release(key, engine)
+        return result
+
+    def close(self):
+        """Close the idle engines"""
+        with self._cond:
+            for engines in self._idle.values():
+                for engine in engines:
+                    engine.close()
+                    self._count -= 1
+            self._idle.clear()
+
+
+class MatlabEngineManager(BaseManager):
+    """Shares the MATLAB engines of a process with its worker processes"""
+
+
+_engine_pool = None
+_engine_manager = None
+# address of the engine server _engine_pool is connected to
+_engine_address = None
+
+
+def _get_engine_pool():
+    return _engine_pool
+
+
+def _init_engine_server(maxsize):
+    global _engine_pool
+    _engine_pool = MatlabEnginePool(maxsize)
+    util.Finalize(_engine_pool, _engine_pool.close, exitpriority=10)
+
+
+MatlabEngineManager.register('get_pool', callable=_get_engine_pool)
+
+
+def start_matlab_engine_server(maxsize):
+    """Start a process holding a pool of ``maxsize`` MATLAB engines
+
+    The processes forked afterwards use these engines instead of their own,
+    so that their total number does not exceed ``maxsize``. Other processes
+    use them once the address of the server is in their
+    ``NIPYPE_MATLAB_ENGINES`` environment variable. The server is kept
+    running, with its engines, until :func:`stop_matlab_engine_server` is
+    called, it is started again with another size or the process exits.
+    Returns the manager of the server process.
+    """
+    global _engine_pool, _engine_manager
+    if _engine_manager is not None:
+        if _engine_manager.maxsize == maxsize:
+            return _engine_manager
+        _engine_manager.shutdown()
+    _engine_manager = MatlabEngineManager()
+    _engine_manager.start(_init_engine_server, (maxsize,))
+    _engine_manager.maxsize = maxsize
+    os.environ['NIPYPE_MATLAB_ENGINES'] = _engine_manager.address
+    _engine_pool = None
+    return _engine_manager
+
+
+def stop_matlab_engine_server():
+    """Stop the engine server started by :func:`start_matlab_engine_server`
+    and its engines
+    """
+    global _engine_manager
+    if _engine_manager is not None:
+        if os.environ.get('NIPYPE_MATLAB_ENGINES') == _engine_manager.address:
+            del os.environ['NIPYPE_MATLAB_ENGINES']
+        _engine_manager.shutdown()
+        _engine_manager = None
+
+
+def get_matlab_engine_pool():
+    """Return the pool of MATLAB engines used by this process
+
+    The pool is the one of the engine server whose address is in the
+    ``NIPYPE_MATLAB_ENGINES`` environment variable (see
+    :func:`start_matlab_engine_server`) if there is one, and is otherwise
+    local to this process. Returns None when there is no server and the
+    ``matlab_engine_pool`` execution option is 0.
+    """
+    global _engine_pool, _engine_address
+    address = os.environ.get('NIPYPE_MATLAB_ENGINES')
+    if address:
+        if address != _engine_address:
+            manager = MatlabEngineManager(
+                address=address, authkey=current_process().authkey)
+            manager.connect()
+            _engine_pool = manager.get_pool()
+            _engine_address = address
+        return _engine_pool
+    if _engine_address is not None:
+        # the engine server is gone
+        _engine_pool = _engine_address = None
+    maxsize = int(config.get('execution', 'matlab_engine_pool'))
+    if maxsize <= 0:
+        return None
+    if _engine_pool is None:
+        _engine_pool = MatlabEnginePool(maxsize)
+        util.Finalize(_engine_pool, _engine_pool.close, exitpriority=10)
+    return _engine_pool
+
+
 class MatlabInputSpec(CommandLineInputSpec):
     """ Basic expected inputs to Matlab interface """
 
@@ -74,6 +362,7 @@ class MatlabCommand(CommandLine):
     """
 
     _cmd = 'matlab'
+    _uses_matlab = True
     _default_matlab_cmd = None
     _default_mfile = None
     _default_paths = None
@@ -138,7 +427,11 @@ class MatlabCommand(CommandLine):
 
     def _run_interface(self, runtime):
         self.inputs.terminal_output = 'allatonce'
-        runtime = super(MatlabCommand, self)._run_interface(runtime)
+        pool = get_matlab_engine_pool()
+        if pool is not None and (self.inputs.mfile or self.inputs.uses_mcr):
+            runtime = self._run_engine(runtime, pool)
+        else:
+            runtime = super(MatlabCommand, self)._run_interface(runtime)
         try:
             # Matlab can leave the terminal in a barbbled state
             os.system('stty sane')
@@ -149,6 +442,36 @@ class MatlabCommand(CommandLine):
             self.raise_exception(runtime)
         return runtime
 
+    def _engine_command(self):
+        """Command line starting a MATLAB engine for this interface"""
+        if self.inputs.uses_mcr:
+            return '%s %%s' % self.cmd
+        args = [self.cmd]
+        for name in ['nodesktop', 'nosplash', 'single_comp_thread']:
+            if getattr(self.inputs, name):
+                args.append(self.inputs.trait(name).argstr)
+        args.append('-r "run(\'%s\');exit"')
+        return ' '.join(args)
+
+    def _run_engine(self, runtime, pool):
+        """Run the m-file of the script on a MATLAB engine of the pool"""
+        runtime.environ.update(self._get_environ())
+        runtime.cmdline = self.cmdline
+        executable_name = self.cmd.split()[0]
+        exist_val, cmd_path = _exists_in_path(executable_name,
+                                              runtime.environ)
+        if not exist_val:
+            raise IOError("command '%s' could not be found on host %s" %
+                          (executable_name, runtime.hostname))
+        runtime.command_path = cmd_path
+        mfile = os.path.join(os.getcwd(), self.inputs.script_file)
+        runtime.returncode, runtime.stdout, runtime.stderr = pool.run(
+            self._engine_command(), mfile, environ=runtime.environ)
+        runtime.merged = ''
+        if runtime.returncode != 0:
+            self.raise_exception(runtime)
+        return runtime
+
     def _format_arg(self, name, trait_spec, value):
         if name in ['script']:
             argstr = trait_spec.argstr
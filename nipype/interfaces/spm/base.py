@@ -31,7 +31,8 @@ from scipy.io import savemat
 
 # Local imports
 from ..base import (BaseInterface, traits, isdefined, InputMultiPath,
-                    BaseInterfaceInputSpec, Directory, Undefined)
+                    BaseInterfaceInputSpec, Directory, Undefined,
+                    get_version_cache)
 from ..matlab import MatlabCommand
 from ...utils import spm_docs as sd
 from ...external.six import string_types
@@ -163,6 +164,14 @@ class Info(object):
                 matlab_cmd = os.environ['MATLABCMD']
             except KeyError:
                 matlab_cmd = 'matlab -nodesktop -nosplash'
+        if not isdefined(paths):
+            paths = None
+        return get_version_cache().get(
+            'spm', (matlab_cmd, paths, bool(use_mcr), os.getenv('PATH', '')),
+            lambda: Info._probe_version(matlab_cmd, paths, use_mcr))
+
+    @staticmethod
+    def _probe_version(matlab_cmd, paths, use_mcr):
         mlab = MatlabCommand(matlab_cmd=matlab_cmd)
         mlab.inputs.mfile = False
         if paths:
@@ -230,6 +239,7 @@ class SPMCommand(BaseInterface):
 
     _jobtype = 'basetype'
     _jobname = 'basename'
+    _uses_matlab = True
 
     _matlab_cmd = None
     _paths = None
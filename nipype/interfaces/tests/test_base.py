@@ -5,8 +5,10 @@ from future import standard_library
 standard_library.install_aliases()
 
 import os
+import sys
 import tempfile
 import shutil
+from time import time
 import warnings
 
 from nipype.testing import (assert_equal, assert_not_equal, assert_raises,
@@ -391,6 +393,37 @@ def test_TraitedSpec_withNoFileHashing():
     teardown_file(tmpd)
 
 
+def test_TraitedSpec_parallel_hashing():
+    tmp_infile = setup_file()
+    tmpd, nme = os.path.split(tmp_infile)
+    infiles = []
+    for i in range(10):
+        infile = os.path.join(tmpd, 'foo%d.txt' % i)
+        with open(infile, 'w') as fp:
+            fp.writelines(['%d' % i])
+        infiles.append(infile)
+
+    class spec2(nib.TraitedSpec):
+        moo = nib.File(exists=True)
+        doo = nib.traits.List(nib.File(exists=True))
+        goo = nib.traits.Dict(nib.traits.Str, nib.traits.List(nib.traits.Str))
+    infields = spec2(moo=tmp_infile, doo=infiles,
+                     goo={'a': infiles[:3], 'b': ['not_a_file']})
+    old_threads = config.get('execution', 'file_hash_threads')
+    hashvals = []
+    try:
+        for threads in ['1', '4']:
+            config.set('execution', 'file_hash_threads', threads)
+            hashvals.append(infields.get_hashval(hash_method='content'))
+    finally:
+        config.set('execution', 'file_hash_threads', old_threads)
+    yield assert_equal, hashvals[0], hashvals[1]
+    yield assert_equal, hashvals[1][0][0][1][2], (infiles[2],
+                                                  nib.hash_infile(infiles[2]))
+    yield assert_equal, hashvals[1][0][1][1][1], ('b', ['not_a_file'])
+    teardown_file(tmpd)
+
+
 def test_Interface():
     yield assert_equal, nib.Interface.input_spec, None
     yield assert_equal, nib.Interface.output_spec, None
@@ -673,6 +706,60 @@ def test_CommandLine_output():
     teardown_file(tmpd)
 
 
+def test_CommandLine_stream():
+    tmpd = tempfile.mkdtemp()
+    pwd = os.getcwd()
+    os.chdir(tmpd)
+    # interleaved output without a trailing newline, the command returns
+    # as soon as it exits rather than after a polling interval
+    ci = nib.CommandLine(command='printf',
+                         args="'a\\nb' && printf 'c' 1>&2")
+    ci.inputs.terminal_output = 'stream'
+    res = ci.run()
+    yield assert_equal, res.runtime.stdout, 'a\nb'
+    yield assert_equal, res.runtime.stderr, 'c'
+    yield assert_equal, len(res.runtime.merged), 3
+    yield assert_true, res.runtime.duration < 0.4
+    # a daemon started by the command keeps the pipes open after it exits
+    ci = nib.CommandLine(command='printf',
+                         args="'a\nb' && (sleep 10 &) && printf 'c' 1>&2")
+    ci.inputs.terminal_output = 'stream'
+    t0 = time()
+    res = ci.run()
+    yield assert_true, time() - t0 < 5
+    yield assert_equal, res.runtime.stdout, 'a\nb'
+    yield assert_equal, res.runtime.stderr, 'c'
+    os.chdir(pwd)
+    teardown_file(tmpd)
+
+
+def test_exists_in_path_cache():
+    tmpd = tempfile.mkdtemp()
+    exe = os.path.join(tmpd, 'nipype_fake_cmd')
+    open(exe, 'w').close()
+    env = {'PATH': tmpd}
+    yield assert_equal, nib._exists_in_path('nipype_fake_cmd', env), \
+        (True, exe)
+    yield assert_true, ('nipype_fake_cmd', tmpd, os.environ.get('PATHEXT', '')) \
+        in nib._executable_cache
+    # the cached path is checked before it is returned
+    os.remove(exe)
+    yield assert_equal, nib._exists_in_path('nipype_fake_cmd', env), \
+        (False, None)
+    teardown_file(tmpd)
+
+
+@skipif(not sys.platform.startswith('linux'))
+def test_get_dependencies_cache():
+    path = nib._exists_in_path('ls', os.environ)[1]
+    deps = nib.get_dependencies('ls', os.environ, path=path)
+    stat = os.stat(path)
+    key = (path, stat.st_dev, stat.st_ino, stat.st_mtime)
+    yield assert_equal, nib._dependencies_cache[key], deps
+    yield assert_equal, nib.get_dependencies('ls', os.environ, path=path), \
+        deps
+
+
 def test_global_CommandLine_output():
     tmp_infile = setup_file()
     tmpd, name = os.path.split(tmp_infile)
@@ -697,3 +784,44 @@ def test_global_CommandLine_output():
     yield assert_equal, res.runtime.stdout, ''
     os.chdir(pwd)
     teardown_file(tmpd)
+
+
+def test_version_cache():
+    cache = nib.VersionCache()
+    calls = []
+
+    def probe():
+        calls.append(1)
+        return '1.0'
+    yield assert_equal, cache.get('tool', ('/opt/tool',), probe), '1.0'
+    yield assert_equal, cache.get('tool', ('/opt/tool',), probe), '1.0'
+    yield assert_equal, len(calls), 1
+    # another installation of the tool is probed again
+    yield assert_equal, cache.get('tool', ('/opt/other',), probe), '1.0'
+    yield assert_equal, len(calls), 2
+    # failed probes are not cached
+    yield assert_equal, cache.get('tool', ('/opt/none',), lambda: None), None
+    yield assert_equal, cache.get('tool', ('/opt/none',), probe), '1.0'
+    yield assert_equal, len(calls), 3
+    config.set('execution', 'version_cache_ttl', '0')
+    cache.get('tool', ('/opt/tool',), probe)
+    yield assert_equal, len(calls), 4
+    config.set_default_config()
+
+
+def test_version_cache_persist():
+    tmpd = tempfile.mkdtemp()
+    old_data_file = config.data_file
+    config.data_file = os.path.join(tmpd, 'nipype.json')
+    config.set('execution', 'version_cache_persist', 'true')
+    nib.VersionCache().get('tool', ('/opt/tool',), lambda: {'release': '2'})
+    # a new process reads the version stored by the first one
+    version = nib.VersionCache().get('tool', ('/opt/tool',), lambda: None)
+    yield assert_equal, version, {'release': '2'}
+    # failed probes are not stored
+    nib.VersionCache().get('tool', ('/opt/other',), lambda: None)
+    version = nib.VersionCache().get('tool', ('/opt/other',), lambda: '3')
+    yield assert_equal, version, '3'
+    config.data_file = old_data_file
+    config.set_default_config()
+    teardown_file(tmpd)
@@ -1,12 +1,14 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
+import sys
 from tempfile import mkdtemp
 from shutil import rmtree
 
 from nipype.testing import (assert_equal, assert_true, assert_false,
                             assert_raises, skipif)
 import nipype.interfaces.matlab as mlab
+from nipype.interfaces.base import Undefined
 
 matlab_cmd = mlab.get_matlab_command()
 no_matlab = matlab_cmd is None
@@ -116,3 +118,103 @@ def test_set_matlabcmd():
     yield assert_false, os.path.exists(default_script_file), 'scriptfile should not exist.'
     yield assert_equal, mi._default_matlab_cmd, 'foo'
     mi.set_default_matlab_cmd(matlab_cmd)
+
+
+FAKE_ENGINE = """
+import os
+import re
+import sys
+
+# stands in for MATLAB running the engine loop: runs the m-files read from
+# stdin by printing the arguments of their disp and error calls, and by
+# exiting if they call exit
+home = os.getcwd()
+for line in iter(sys.stdin.readline, ''):
+    mfile = line.strip()
+    if mfile == 'exit':
+        break
+    os.chdir(os.path.dirname(mfile))
+    code = open(mfile).read()
+    sys.stdout.write('engine %d in %s\\n' % (os.getpid(), os.getcwd()))
+    for message in re.findall(r"disp\\('(.*?)'\\)", code):
+        sys.stdout.write(message + '\\n')
+    for message in re.findall(r"error\\('(.*?)'\\)", code):
+        sys.stderr.write('MATLAB code threw an exception:\\n%s\\n' % message)
+    exit_call = re.search(r"\\bexit(?:\\((\\d+)\\))?;", code)
+    if exit_call:
+        sys.stdout.flush()
+        sys.exit(int(exit_call.group(1) or 0))
+    os.chdir(home)
+    for stream in (sys.stdout, sys.stderr):
+        stream.write('\\n%s\\n' % sys.argv[1])
+        stream.flush()
+"""
+
+
+def mcr_command(matlab_cmd, script):
+    mc = mlab.MatlabCommand(matlab_cmd=matlab_cmd, script=script)
+    mc.inputs.nodesktop = Undefined
+    mc.inputs.nosplash = Undefined
+    mc.inputs.single_comp_thread = Undefined
+    mc.inputs.uses_mcr = True
+    return mc
+
+
+def test_matlab_engine_pool():
+    cwd = os.getcwd()
+    basedir = mkdtemp()
+    engine = os.path.join(basedir, 'fake_engine.py')
+    with open(engine, 'wt') as fp:
+        fp.write(FAKE_ENGINE)
+    matlab_cmd = '%s %s %s' % (sys.executable, engine, mlab.ENGINE_DONE)
+    mlab.config.set('execution', 'matlab_engine_pool', '1')
+
+    stdout = []
+    returncodes = []
+    try:
+        for job in ['job1', 'job2']:
+            os.makedirs(os.path.join(basedir, job))
+            os.chdir(os.path.join(basedir, job))
+            res = mcr_command(matlab_cmd, "disp('%s')" % job).run()
+            stdout.append(res.runtime.stdout.split('\n'))
+            returncodes.append(res.runtime.returncode)
+        mc = mcr_command(matlab_cmd, "error('engine failure')")
+        try:
+            mc.run()
+        except RuntimeError as e:
+            error = str(e)
+        else:
+            error = None
+        # scripts ending with exit succeed, on an engine used only once
+        os.chdir(basedir)
+        res = mcr_command(matlab_cmd, "disp('last');\nexit;").run()
+        exit_stdout = res.runtime.stdout.split('\n')
+        returncodes.append(res.runtime.returncode)
+        res = mcr_command(matlab_cmd, "disp('next')").run()
+        next_stdout = res.runtime.stdout.split('\n')
+        mc = mcr_command(matlab_cmd, "exit(3);")
+        try:
+            mc.run()
+        except RuntimeError:
+            exit_failed = True
+        else:
+            exit_failed = False
+    finally:
+        mlab.get_matlab_engine_pool().close()
+        mlab._engine_pool = None
+        mlab.config.set_default_config()
+        os.chdir(cwd)
+    yield assert_equal, returncodes, [0, 0, 0]
+    for job, job_stdout in zip(['job1', 'job2'], stdout):
+        yield assert_equal, job_stdout[1], job
+    # both jobs ran on the same engine, in their own working directory
+    yield assert_equal, stdout[0][0].split()[1], stdout[1][0].split()[1]
+    yield assert_true, stdout[0][0].endswith('job1')
+    yield assert_true, stdout[1][0].endswith('job2')
+    # errors are reported in stderr
+    yield assert_true, error is not None and 'engine failure' in error
+    yield assert_equal, exit_stdout[1], 'last'
+    yield assert_equal, next_stdout[1], 'next'
+    yield assert_false, next_stdout[0].split()[1] == exit_stdout[0].split()[1]
+    yield assert_true, exit_failed
+    rmtree(basedir)
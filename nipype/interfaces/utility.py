@@ -19,14 +19,12 @@ import re
 from pickle import dumps
 from textwrap import dedent
 import numpy as np
-import nibabel as nb
 
 from .base import (traits, TraitedSpec, DynamicTraitedSpec, File,
                    Undefined, isdefined, OutputMultiPath, runtime_profile,
                    InputMultiPath, BaseInterface, BaseInterfaceInputSpec)
 from .io import IOBase, add_traits
 from ..external.six import string_types
-from ..testing import assert_equal
 from ..utils.filemanip import (filename_to_list, copyfile, split_filename)
 from ..utils.misc import getsource, create_function_from_source
 
@@ -538,6 +536,8 @@ class AssertEqual(BaseInterface):
     input_spec = AssertEqualInputSpec
 
     def _run_interface(self, runtime):
+        import nibabel as nb
+        from ..testing import assert_equal
 
         data1 = nb.load(self.inputs.volume1).get_data()
         data2 = nb.load(self.inputs.volume2).get_data()
@@ -30,9 +30,7 @@ except ImportError:
     from ordereddict import OrderedDict
 
 from copy import deepcopy
-import pickle
 from glob import glob
-import gzip
 import inspect
 import os
 import os.path as op
@@ -60,17 +58,20 @@ from ...interfaces.base import (traits, InputMultiPath, CommandLine,
                                 TraitDictObject, TraitListObject, isdefined)
 from ...utils.misc import (getsource, create_function_from_source,
                            flatten, unflatten)
+from ...utils.config import ConfigSnapshot
 from ...utils.filemanip import (save_json, FileNotFoundError,
                                 filename_to_list, list_to_filename,
                                 copyfiles, fnames_presuffix, loadpkl,
                                 split_filename, load_json, savepkl,
                                 write_rst_header, write_rst_dict,
-                                write_rst_list)
+                                write_rst_list, content_hash_settings,
+                                content_hash_tag)
 from ...external.six import string_types
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir, write_workflow_prov,
                     clean_working_directory, format_dot, topological_sort,
-                    get_print_name, merge_dict, evaluate_connect_function)
+                    get_print_name, evaluate_connect_function,
+                    get_result_cache)
 from .base import EngineBase
 
 
@@ -286,11 +287,18 @@ class Node(EngineBase):
         updatehash: boolean
             Update the hash stored in the output directory
         """
+        node_config = self.config
+        self.config = config.snapshot().override(node_config)
+        try:
+            return self._run_node(updatehash)
+        finally:
+            if not isinstance(node_config, ConfigSnapshot):
+                # nodes run outside of a workflow keep an editable
+                # configuration
+                self.config = self.config.thaw()
+
+    def _run_node(self, updatehash):
         # check to see if output directory and hash exist
-        if self.config is None:
-            self.config = deepcopy(config._sections)
-        else:
-            self.config = merge_dict(deepcopy(config._sections), self.config)
         if not self._got_inputs:
             self._get_inputs()
             self._got_inputs = True
@@ -429,7 +437,8 @@ class Node(EngineBase):
             self._get_inputs()
             self._got_inputs = True
         hashed_inputs, hashvalue = self.inputs.get_hashval(
-            hash_method=self.config['execution']['hash_method'])
+            hash_method=self.config['execution']['hash_method'],
+            hash_settings=content_hash_settings(self.config['execution']))
         rm_extra = self.config['execution']['remove_unnecessary_outputs']
         if str2bool(rm_extra) and self.needed_outputs:
             hashobject = md5()
@@ -438,7 +447,20 @@ class Node(EngineBase):
             hashobject.update(str(sorted_outputs).encode())
             hashvalue = hashobject.hexdigest()
             hashed_inputs.append(('needed_outputs', sorted_outputs))
-        return hashed_inputs, hashvalue
+        return hashed_inputs, self._tag_hashvalue(hashvalue)
+
+    def _tag_hashvalue(self, hashvalue):
+        """Append the content hash algorithm to the hash value
+
+        Hashfiles created with different content hash settings never match
+        each other. The default md5 hash is not tagged.
+        """
+        if self.config['execution']['hash_method'].lower() == 'content':
+            tag = content_hash_tag(
+                content_hash_settings(self.config['execution']))
+            if tag:
+                hashvalue = '%s_%s' % (hashvalue, tag)
+        return hashvalue
 
     def _save_hashfile(self, hashfile, hashed_inputs):
         try:
@@ -469,11 +491,11 @@ class Node(EngineBase):
             logger.debug('input: %s' % key)
             results_file = info[0]
             logger.debug('results file: %s' % results_file)
-            results = loadpkl(results_file)
+            outputs = get_result_cache().get_outputs(results_file)
             output_value = Undefined
             if isinstance(info[1], tuple):
                 output_name = info[1][0]
-                value = getattr(results.outputs, output_name)
+                value = getattr(outputs, output_name)
                 if isdefined(value):
                     output_value = evaluate_connect_function(info[1][1],
                                                              info[1][2],
@@ -481,9 +503,9 @@ class Node(EngineBase):
             else:
                 output_name = info[1]
                 try:
-                    output_value = results.outputs.get()[output_name]
+                    output_value = outputs.get()[output_name]
                 except TypeError:
-                    output_value = results.outputs.dictcopy()[output_name]
+                    output_value = outputs.dictcopy()[output_name]
             logger.debug('output: %s' % output_name)
             try:
                 self.set_input(key, deepcopy(output_value))
@@ -514,7 +536,9 @@ class Node(EngineBase):
             result.outputs.set(**modify_paths(outputs, relative=True,
                                               basedir=cwd))
 
-        savepkl(resultsfile, result)
+        # outputs get their own section so that downstream nodes can load
+        # them without unpickling the runtime information
+        savepkl(resultsfile, result, sections=['outputs'])
         logger.debug('saved results in %s' % resultsfile)
 
         if result.outputs:
@@ -542,9 +566,8 @@ class Node(EngineBase):
         result = None
         attribute_error = False
         if op.exists(resultsoutputfile):
-            pkl_file = gzip.open(resultsoutputfile, 'rb')
             try:
-                result = pickle.load(pkl_file)
+                result = loadpkl(resultsoutputfile)
             except (traits.TraitError, AttributeError, ImportError) as err:
                 if isinstance(err, (AttributeError, ImportError)):
                     attribute_error = True
@@ -567,7 +590,6 @@ class Node(EngineBase):
                         logger.debug(('conversion to full path results in '
                                       'non existent file'))
                 aggregate = False
-            pkl_file.close()
         logger.debug('Aggregate: %s', aggregate)
         return result, aggregate, attribute_error
 
@@ -1099,7 +1121,8 @@ class MapNode(Node):
             else:
                 setattr(hashinputs, name, getattr(self._inputs, name))
         hashed_inputs, hashvalue = hashinputs.get_hashval(
-            hash_method=self.config['execution']['hash_method'])
+            hash_method=self.config['execution']['hash_method'],
+            hash_settings=content_hash_settings(self.config['execution']))
         rm_extra = self.config['execution']['remove_unnecessary_outputs']
         if str2bool(rm_extra) and self.needed_outputs:
             hashobject = md5()
@@ -1108,7 +1131,7 @@ class MapNode(Node):
             hashobject.update(str(sorted_outputs).encode())
             hashvalue = hashobject.hexdigest()
             hashed_inputs.append(('needed_outputs', sorted_outputs))
-        return hashed_inputs, hashvalue
+        return hashed_inputs, self._tag_hashvalue(hashvalue)
 
     @property
     def inputs(self):
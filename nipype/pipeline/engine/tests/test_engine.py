@@ -746,3 +746,99 @@ def test_serial_input():
 
     os.chdir(cwd)
     rmtree(wd)
+
+
+def test_content_hash_tag():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype.interfaces.utility import Function
+    from nipype.utils.filemanip import load_json
+
+    def func1(in_file):
+        return in_file
+    with open('data.txt', 'wt') as fp:
+        fp.write('some data')
+    n1 = pe.Node(Function(input_names=['in_file'],
+                          output_names=['out_file'],
+                          function=func1),
+                 name='n1')
+    n1.inputs.in_file = os.path.join(wd, 'data.txt')
+    w1 = pe.Workflow(name='test')
+    w1.base_dir = wd
+    w1.config['execution']['hash_method'] = 'content'
+    w1.add_nodes([n1])
+    eg = w1.run()
+    outdir = eg.nodes()[0].output_dir()
+    hashfiles = glob(os.path.join(outdir, '_0x*.json'))
+    yield assert_equal, len(hashfiles), 1
+    yield assert_equal, len(os.path.basename(hashfiles[0])), 40
+    # the setting of the workflow applies to its nodes
+    w1.config['execution']['content_hash_algorithm'] = 'sha1'
+    for plugin in ('Linear', 'MultiProc'):
+        eg = w1.run(plugin=plugin)
+        hashfiles = glob(os.path.join(outdir, '_0x*.json'))
+        yield assert_equal, len(hashfiles), 1
+        yield assert_true, hashfiles[0].endswith('_sha1.json')
+        # the file was hashed with sha1 too
+        hashed_inputs = dict(load_json(hashfiles[0]))
+        yield assert_equal, len(hashed_inputs['in_file'][1]), 40
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+def test_exec_node_config():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype.interfaces.utility import Function
+
+    def func1():
+        return 1
+
+    def func2(a):
+        return a + 1
+    n1 = pe.Node(Function(input_names=[], output_names=['a'],
+                          function=func1), name='n1')
+    n2 = pe.Node(Function(input_names=['a'], output_names=['b'],
+                          function=func2), name='n2')
+    n2.config = {'execution': {'remove_unnecessary_outputs': 'false'}}
+    w1 = pe.Workflow(name='test')
+    w1.base_dir = wd
+    w1.connect(n1, 'a', n2, 'a')
+    eg = w1.run(plugin='Linear')
+    nodes = dict((node.name, node) for node in eg.nodes())
+    # node overrides do not leak into the configuration shared by the nodes
+    yield assert_equal, nodes['n2'].config['execution'][
+        'remove_unnecessary_outputs'], 'false'
+    yield assert_equal, nodes['n1'].config['execution'][
+        'remove_unnecessary_outputs'], 'true'
+    yield assert_equal, w1.config['execution'][
+        'remove_unnecessary_outputs'], 'true'
+    yield assert_equal, nodes['n2'].result.outputs.b, 2
+    os.chdir(cwd)
+    rmtree(wd)
+
+
+def test_node_config_editable():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype.interfaces.utility import Function
+
+    def func1():
+        return 1
+    n1 = pe.Node(Function(input_names=[], output_names=['a'],
+                          function=func1), name='n1')
+    n1.base_dir = wd
+    n1.config = {'execution': {'remove_unnecessary_outputs': 'false'}}
+    n1.run()
+    # the configuration of a node run on its own can be changed afterwards
+    yield assert_equal, n1.config['execution'][
+        'remove_unnecessary_outputs'], 'false'
+    n1.config['execution']['stop_on_first_crash'] = 'true'
+    n1.run()
+    yield assert_equal, n1.config['execution']['stop_on_first_crash'], 'true'
+    yield assert_equal, n1.result.outputs.a, 1
+    os.chdir(cwd)
+    rmtree(wd)
@@ -0,0 +1,78 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Benchmark of the iterable expansion of workflow graphs
+
+The test checks the expansion of synthetic graphs of increasing size. Run
+the module as a script to time the expansion of larger graphs, e.g.::
+
+    python test_expansion_benchmark.py 1000 4 60
+"""
+from __future__ import print_function
+
+from builtins import range
+from copy import deepcopy
+import sys
+from time import time
+
+from nipype.testing import assert_equal
+from nipype.pipeline import engine as pe
+from nipype.interfaces import utility as niu
+from nipype.pipeline.engine.utils import generate_expanded_graph
+
+
+def add_values(a, b=1):
+    return a + b
+
+
+def create_benchmark_workflow(n_subjects, n_sessions, n_nodes):
+    """Create a workflow that iterates over subjects and sessions, with a
+    chain of ``n_nodes`` nodes per subject and session and a join node over
+    the sessions of each subject
+    """
+    wf = pe.Workflow(name='benchmark')
+    subjects = pe.Node(niu.IdentityInterface(fields=['subject']),
+                       name='subjects')
+    subjects.iterables = ('subject', list(range(n_subjects)))
+    sessions = pe.Node(niu.IdentityInterface(fields=['session']),
+                       name='sessions')
+    sessions.iterables = ('session', list(range(n_sessions)))
+    prev = None
+    for i in range(n_nodes):
+        node = pe.Node(niu.Function(input_names=['a', 'b'],
+                                    output_names=['out'],
+                                    function=add_values),
+                       name='node%d' % i)
+        if prev is None:
+            wf.connect(subjects, 'subject', node, 'a')
+            wf.connect(sessions, 'session', node, 'b')
+        else:
+            wf.connect(prev, 'out', node, 'a')
+        prev = node
+    join = pe.JoinNode(niu.IdentityInterface(fields=['out']),
+                       joinsource='sessions', joinfield='out', name='join')
+    wf.connect(prev, 'out', join, 'out')
+    return wf
+
+
+def time_expansion(n_subjects, n_sessions, n_nodes):
+    """Return the number of expanded nodes and the expansion time
+    """
+    flatgraph = create_benchmark_workflow(n_subjects, n_sessions,
+                                          n_nodes)._create_flat_graph()
+    t0 = time()
+    execgraph = generate_expanded_graph(deepcopy(flatgraph))
+    return len(execgraph), time() - t0
+
+
+def test_expansion_benchmark():
+    n_sessions, n_nodes = 4, 10
+    for n_subjects in (5, 20, 80):
+        size, _ = time_expansion(n_subjects, n_sessions, n_nodes)
+        yield assert_equal, size, n_subjects * (n_sessions * n_nodes + 1)
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:4]] or [1000, 4, 60]
+    size, elapsed = time_expansion(*args)
+    print('%d subjects x %d sessions x %d nodes: %d nodes expanded in '
+          '%.3f s' % tuple(args + [size, elapsed]))
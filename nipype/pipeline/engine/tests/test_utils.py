@@ -14,7 +14,8 @@ from ... import engine as pe
 from ....interfaces import base as nib
 from ....interfaces import utility as niu
 from .... import config
-from ..utils import merge_dict, clean_working_directory, write_workflow_prov
+from ..utils import (merge_dict, clean_working_directory, write_workflow_prov,
+                     ResultCache, clone_nodes)
 
 
 def test_identitynode_removal():
@@ -343,3 +344,86 @@ def test_provenance():
     yield assert_equal, len(psg.bundles), 2
     yield assert_equal, len(psg.get_records()), 7
     rmtree(out_dir)
+
+
+def _double(a):
+    return 2 * a
+
+
+def test_result_cache():
+    out_dir = mkdtemp()
+    node = pe.Node(niu.Function(input_names=['a'], output_names=['out'],
+                                function=_double), name='double')
+    node.base_dir = out_dir
+    node.inputs.a = 2
+    result = node.run()
+    resultsfile = os.path.join(node.output_dir(), 'result_double.pklz')
+    cache = ResultCache(maxsize=1)
+    yield assert_equal, cache.get_outputs(resultsfile).out, 4
+    yield assert_equal, cache.get_outputs(resultsfile).out, 4
+    yield assert_equal, cache.stats(), dict(hits=1, misses=1, entries=1)
+    # a rewritten result file is loaded again
+    mtime = os.stat(resultsfile).st_mtime + 10
+    os.utime(resultsfile, (mtime, mtime))
+    yield assert_equal, cache.get_outputs(resultsfile).out, 4
+    yield assert_equal, cache.stats()['misses'], 2
+    yield assert_equal, cache.stats()['entries'], 1
+    cache.clear()
+    cache.put(resultsfile, result.outputs)
+    yield assert_equal, cache.get_outputs(resultsfile).out, 4
+    yield assert_equal, cache.stats(), dict(hits=1, misses=0, entries=1)
+    cache = ResultCache(maxsize=0)
+    cache.put(resultsfile, result.outputs)
+    yield assert_equal, cache.stats()['entries'], 0
+    rmtree(out_dir)
+
+
+def test_result_cache_workflow():
+    out_dir = mkdtemp()
+    wf = pe.Workflow(name='cachewf', base_dir=out_dir)
+    n1 = pe.Node(niu.Function(input_names=['a'], output_names=['out'],
+                              function=_double), name='n1')
+    n1.inputs.a = 1
+    n2 = pe.Node(niu.Merge(3), name='n2')
+    for i in range(3):
+        wf.connect(n1, 'out', n2, 'in%d' % (i + 1))
+    seen = []
+    get_outputs = ResultCache.get_outputs
+
+    def counting_get_outputs(self, resultsfile):
+        outputs = get_outputs(self, resultsfile)
+        seen.append(self.stats())
+        return outputs
+
+    ResultCache.get_outputs = counting_get_outputs
+    try:
+        eg = wf.run(plugin='Linear')
+    finally:
+        ResultCache.get_outputs = get_outputs
+    node = [n for n in eg.nodes() if n.name == 'n2'][0]
+    yield assert_equal, node.result.outputs.out, [2, 2, 2]
+    # the plugin cached the upstream outputs, the result file is never loaded
+    yield assert_equal, len(seen), 3
+    yield assert_equal, seen[-1]['misses'], 0
+    rmtree(out_dir)
+
+
+def test_clone_nodes():
+    node = pe.Node(niu.IdentityInterface(fields=['a', 'b']), name='node')
+    node.iterables = ('a', list(range(10)))
+    node.inputs.b = [1, 2]
+    wf = pe.Workflow(name='clonewf')
+    wf.add_nodes([node])
+    wfcopy = clone_nodes(wf, nodes=[node])
+    nodecopy = wfcopy._graph.nodes()[0]
+    yield assert_false, nodecopy is node
+    # the iterables are shared, the inputs are copied
+    yield assert_true, nodecopy.iterables is node.iterables
+    yield assert_equal, nodecopy.inputs.b, [1, 2]
+    nodecopy.inputs.b = [3]
+    yield assert_equal, node.inputs.b, [1, 2]
+    # objects that cannot be pickled are deep copied
+    node.inputs.b = lambda x: x
+    nodecopy = clone_nodes(node, nodes=[node])
+    yield assert_true, nodecopy.iterables is node.iterables
+    yield assert_false, nodecopy.inputs is node.inputs
@@ -24,6 +24,7 @@ from collections import OrderedDict
 from copy import deepcopy
 from glob import glob
 from collections import defaultdict
+from bisect import bisect_left
 try:
     from inspect import signature
 except ImportError:
@@ -31,6 +32,8 @@ except ImportError:
 import os
 import re
 import pickle
+import threading
+from io import BytesIO
 import numpy as np
 from nipype.utils.misc import package_check
 from functools import reduce
@@ -41,12 +44,11 @@ import networkx as nx
 
 from ...external.six import string_types
 from ...utils.filemanip import (fname_presuffix, FileNotFoundError,
-                                filename_to_list, get_related_files)
+                                filename_to_list, get_related_files, loadpkl)
 from ...utils.misc import create_function_from_source, str2bool
 from ...interfaces.base import (CommandLine, isdefined, Undefined,
                                 InterfaceResult)
 from ...interfaces.utility import IdentityInterface
-from ...utils.provenance import ProvStore, pm, nipype_ns, get_id
 
 from ... import logging, config
 logger = logging.getLogger('workflow')
@@ -209,6 +211,97 @@ def modify_paths(object, relative=True, basedir=None):
     return out
 
 
+class ResultCache(object):
+    """Size-bounded LRU cache of the outputs stored in node result files
+
+    Entries are keyed on the path and the modification time of the result
+    file, hence a result file that is written again is never served from the
+    cache. A ``maxsize`` of 0 disables caching.
+    """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, resultsfile):
+        resultsfile = os.path.abspath(resultsfile)
+        return resultsfile, os.stat(resultsfile).st_mtime
+
+    def _store(self, key, outputs):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = outputs
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_outputs(self, resultsfile):
+        """Return the outputs stored in a result file
+        """
+        key = self._key(resultsfile)
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                outputs = self._entries.pop(key)
+                self._entries[key] = outputs
+                return outputs
+            self.misses += 1
+        outputs = loadpkl(resultsfile, section='outputs')
+        if self.maxsize > 0:
+            self._store(key, outputs)
+        return outputs
+
+    def put(self, resultsfile, outputs):
+        """Add the outputs that were saved to a result file
+        """
+        if self.maxsize > 0:
+            self._store(self._key(resultsfile), outputs)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses,
+                        entries=len(self._entries))
+
+
+_result_cache = ResultCache(
+    maxsize=int(config.get('execution', 'result_cache_size')))
+
+
+def get_result_cache():
+    """Return the cache of node outputs used while running a workflow
+    """
+    return _result_cache
+
+
+def cache_node_result(node, result):
+    """Add the outputs of a node that finished running to the result cache
+
+    Plugins call this with the results they receive from their workers, so
+    that dependent nodes do not load them again from the result file.
+    """
+    if result is None or getattr(result, 'outputs', None) is None:
+        return
+    if node.config and str2bool(node.config['execution']
+                                ['use_relative_paths']):
+        # the result file holds relative paths, unlike the result in memory
+        return
+    resultsfile = os.path.join(node.output_dir(),
+                               'result_%s.pklz' % node.name)
+    try:
+        _result_cache.put(resultsfile, result.outputs)
+    except OSError:
+        logger.debug('Result file %s not found, not caching its outputs' %
+                     resultsfile)
+
+
 def get_print_name(node, simple_form=True):
     """Get the name of the node
 
@@ -457,6 +550,75 @@ def get_levels(G):
     return levels
 
 
+class _NodePickler(pickle.Pickler):
+    """Pickler that leaves the given objects to be shared by the copies"""
+
+    def __init__(self, file, shared):
+        pickle.Pickler.__init__(self, file, pickle.HIGHEST_PROTOCOL)
+        self._shared = shared
+
+    def persistent_id(self, obj):
+        return self._shared.get(id(obj))
+
+
+class _NodeUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, shared):
+        pickle.Unpickler.__init__(self, file)
+        self._shared = shared
+
+    def persistent_load(self, pid):
+        return self._shared[pid]
+
+
+class NodeTemplate(object):
+    """A frozen copy of an object holding workflow nodes, e.g., a graph or a
+    workflow, from which any number of deep copies can be made
+
+    The object is pickled once and every copy is unpickled from the same
+    string, which is much cheaper than deep-copying the nodes and their
+    interfaces. The ``shared`` objects are not copied, but referenced by all
+    copies; by default these are the iterables of the ``nodes``, which are
+    read-only once a workflow runs. If the object cannot be pickled, the
+    copies are deep copies (that still reference the shared objects).
+    """
+
+    def __init__(self, obj, nodes=None, shared=None):
+        if shared is None:
+            shared = [node.iterables for node in (nodes or [])
+                      if node.iterables]
+        self._shared = {}
+        shared_ids = {}
+        for item in shared:
+            if id(item) not in shared_ids:
+                shared_ids[id(item)] = len(self._shared)
+                self._shared[len(self._shared)] = item
+        try:
+            stream = BytesIO()
+            _NodePickler(stream, shared_ids).dump(obj)
+            self._pickled = stream.getvalue()
+        except Exception as e:
+            logger.debug('Cannot pickle %s, copies will be deep copies: %s' %
+                         (type(obj).__name__, e))
+            self._obj = obj
+            self._pickled = None
+
+    def copy(self):
+        """Return a new deep copy of the object
+        """
+        if self._pickled is None:
+            memo = dict((id(item), item) for item in self._shared.values())
+            return deepcopy(self._obj, memo)
+        return _NodeUnpickler(BytesIO(self._pickled), self._shared).load()
+
+
+def clone_nodes(obj, nodes=None):
+    """Deep copy an object holding workflow nodes, sharing the iterables of
+    the ``nodes`` with the copy (see :class:`NodeTemplate`)
+    """
+    return NodeTemplate(obj, nodes=nodes).copy()
+
+
 def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
                   prefix, synchronize=False):
     """Merges two graphs that share a subset of nodes.
@@ -489,23 +651,21 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     # Retrieve edge information connecting nodes of the subgraph to other
     # nodes of the supergraph.
     supernodes = supergraph.nodes()
-    ids = [n._hierarchy + n._id for n in supernodes]
-    if len(np.unique(ids)) != len(ids):
+    ids = set(n._hierarchy + n._id for n in supernodes)
+    if len(ids) != len(supernodes):
         # This should trap the problem of miswiring when multiple iterables are
         # used at the same level. The use of the template below for naming
         # updates to nodes is the general solution.
         raise Exception(("Execution graph does not have a unique set of node "
                          "names. Please rerun the workflow"))
+    subgraph_nodes = set(subgraph.nodes_iter())
     edgeinfo = {}
-    for n in subgraph.nodes():
-        nidx = ids.index(n._hierarchy + n._id)
-        for edge in supergraph.in_edges_iter(supernodes[nidx]):
-                # make sure edge is not part of subgraph
-            if edge[0] not in subgraph.nodes():
-                if n._hierarchy + n._id not in edgeinfo.keys():
-                    edgeinfo[n._hierarchy + n._id] = []
-                edgeinfo[n._hierarchy + n._id].append((edge[0],
-                                                       supergraph.get_edge_data(*edge)))
+    for n in subgraph_nodes:
+        for edge in supergraph.in_edges_iter(n):
+            # make sure edge is not part of subgraph
+            if edge[0] not in subgraph_nodes:
+                edgeinfo.setdefault(n._hierarchy + n._id, []).append(
+                    (edge[0], supergraph.get_edge_data(*edge)))
     supergraph.remove_nodes_from(nodes)
     # Add copies of the subgraph depending on the number of iterables
     iterable_params = expand_iterables(iterables, synchronize)
@@ -515,19 +675,29 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
     # Make an iterable subgraph node id template
     count = len(iterable_params)
     template = '.%s%%0%dd' % (prefix, np.ceil(np.log10(count)))
+    # The subgraph is serialized once and every copy is cloned from it
+    subnodes = subgraph.nodes()
+    index = dict((node, i) for i, node in enumerate(subnodes))
+    subedges = [(index[u], index[v])
+                for u, v in subgraph.edges_iter()]
+    subgraph_template = NodeTemplate(
+        (subnodes, [data for _, _, data in subgraph.edges_iter(data=True)]),
+        nodes=subnodes)
+    levels = get_levels(subgraph)
+    levels = [levels[n] for n in subnodes]
+    nodeidx = [n._hierarchy + n._id for n in subnodes].index(nodeid)
     # Copy the iterable subgraphs
     for i, params in enumerate(iterable_params):
-        Gc = deepcopy(subgraph)
-        ids = [n._hierarchy + n._id for n in Gc.nodes()]
-        nodeidx = ids.index(nodeid)
-        rootnode = Gc.nodes()[nodeidx]
+        Gc_nodes, Gc_edgedata = subgraph_template.copy()
+        Gc_edges = [(Gc_nodes[u], Gc_nodes[v], data)
+                    for (u, v), data in zip(subedges, Gc_edgedata)]
+        rootnode = Gc_nodes[nodeidx]
         paramstr = ''
         for key, val in sorted(params.items()):
             paramstr = '_'.join((paramstr, _get_valid_pathstr(key),
                                  _get_valid_pathstr(str(val))))
             rootnode.set_input(key, val)
-        levels = get_levels(Gc)
-        for n in Gc.nodes():
+        for n, path_length in zip(Gc_nodes, levels):
             """
             update parameterization of the node to reflect the location of
             the output directory.  For example, if the iterables along a
@@ -536,7 +706,6 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
             with iterable 'b' will be placed in a directory
             _a_aval/_b_bval/.
             """
-            path_length = levels[n]
             # enter as negative numbers so that earlier iterables with longer
             # path lengths get precedence in a sort
             paramlist = [(-path_length, paramstr)]
@@ -544,12 +713,11 @@ def _merge_graphs(supergraph, nodes, subgraph, nodeid, iterables,
                 n.parameterization = paramlist + n.parameterization
             else:
                 n.parameterization = paramlist
-        supergraph.add_nodes_from(Gc.nodes())
-        supergraph.add_edges_from(Gc.edges(data=True))
-        for node in Gc.nodes():
-            if node._hierarchy + node._id in edgeinfo.keys():
-                for info in edgeinfo[node._hierarchy + node._id]:
-                    supergraph.add_edges_from([(info[0], node, info[1])])
+        supergraph.add_nodes_from(Gc_nodes)
+        supergraph.add_edges_from(Gc_edges)
+        for node in Gc_nodes:
+            for info in edgeinfo.get(node._hierarchy + node._id, []):
+                supergraph.add_edges_from([(info[0], node, info[1])])
             node._id += template % i
     return supergraph
 
@@ -788,23 +956,28 @@ def generate_expanded_graph(graph_in):
                                  subgraph, inode._hierarchy + inode._id,
                                  iterables, iterable_prefix, inode.synchronize)
 
+        # index the nodes on their ids to look up the join source replicates
+        if jnodes:
+            id_index = sorted((node._id, i, node)
+                              for i, node in enumerate(graph_in.nodes_iter()))
+            sorted_ids = [node_id for node_id, _, _ in id_index]
         # reconnect the join nodes
         for jnode in jnodes:
             # the {node id: edge data} dictionary for edges connecting
             # to the join node in the unexpanded graph
             old_edge_dict = jedge_dict[jnode]
-            # the edge source node replicates
+            # the edge source node replicates, i.e., the nodes whose id
+            # starts with the source id, in the order of their ids
             expansions = defaultdict(list)
-            for node in graph_in.nodes_iter():
-                for src_id, edge_data in list(old_edge_dict.items()):
-                    if node._id.startswith(src_id):
-                        expansions[src_id].append(node)
+            for src_id in old_edge_dict:
+                idx = bisect_left(sorted_ids, src_id)
+                while (idx < len(sorted_ids) and
+                       sorted_ids[idx].startswith(src_id)):
+                    expansions[src_id].append(id_index[idx][2])
+                    idx += 1
             for in_id, in_nodes in list(expansions.items()):
                 logger.debug("The join node %s input %s was expanded"
                              " to %d nodes." % (jnode, in_id, len(in_nodes)))
-            # preserve the node iteration order by sorting on the node id
-            for in_nodes in list(expansions.values()):
-                in_nodes.sort(key=lambda node: node._id)
 
             # the number of join source replicates.
             iter_cnt = count_iterables(iterables, inode.synchronize)
@@ -1225,6 +1398,7 @@ def merge_bundles(g1, g2):
 def write_workflow_prov(graph, filename=None, format='all'):
     """Write W3C PROV Model JSON file
     """
+    from ...utils.provenance import ProvStore, pm, nipype_ns, get_id
     if not filename:
         filename = os.path.join(os.getcwd(), 'workflow_provenance')
 
@@ -53,6 +53,7 @@ from ...utils.misc import package_check, str2bool
 package_check('networkx', '1.3')
 
 from ... import config, logging
+from ...utils.config import freeze_config
 logger = logging.getLogger('workflow')
 from ...interfaces.base import (traits, InputMultiPath, CommandLine,
                                 Undefined, TraitedSpec, DynamicTraitedSpec,
@@ -65,13 +66,14 @@ from ...utils.filemanip import (save_json, FileNotFoundError,
                                 copyfiles, fnames_presuffix, loadpkl,
                                 split_filename, load_json, savepkl,
                                 write_rst_header, write_rst_dict,
-                                write_rst_list)
+                                write_rst_list, get_file_hash_cache)
 from ...external.six import string_types
 from .utils import (generate_expanded_graph, modify_paths,
                     export_graph, make_output_dir, write_workflow_prov,
                     clean_working_directory, format_dot, topological_sort,
                     get_print_name, merge_dict, evaluate_connect_function,
-                    _write_inputs, format_node)
+                    _write_inputs, format_node, get_result_cache,
+                    clone_nodes)
 
 from .base import EngineBase
 from .nodes import Node, MapNode
@@ -449,7 +451,7 @@ connected.
             if graph2use in ['flat', 'exec']:
                 graph = self._create_flat_graph()
             if graph2use == 'exec':
-                graph = generate_expanded_graph(deepcopy(graph))
+                graph = generate_expanded_graph(graph)
             export_graph(graph, base_dir, dotfilename=dotfilename,
                          format=format, simple_form=simple_form)
 
@@ -584,9 +586,14 @@ connected.
             del self.config['crashdump_dir']
         logger.info(str(sorted(self.config)))
         self._set_needed_outputs(flatgraph)
-        execgraph = generate_expanded_graph(deepcopy(flatgraph))
+        # the flat graph is a private copy of the workflow, hence it can be
+        # expanded in place
+        execgraph = generate_expanded_graph(flatgraph)
+        # nodes reference a read-only snapshot of the workflow configuration,
+        # nodes with their own settings a snapshot with these layered on top
+        config_snapshot = freeze_config(self.config)
         for index, node in enumerate(execgraph.nodes()):
-            node.config = merge_dict(deepcopy(self.config), node.config)
+            node.config = config_snapshot.override(node.config)
             node.base_dir = self.base_dir
             node.index = index
             if isinstance(node, MapNode):
@@ -594,7 +601,18 @@ connected.
         self._configure_exec_nodes(execgraph)
         if str2bool(self.config['execution']['create_report']):
             self._write_report_info(self.base_dir, self.name, execgraph)
-        runner.run(execgraph, updatehash=updatehash, config=self.config)
+        # outputs of upstream nodes are cached for the duration of this run
+        result_cache = get_result_cache()
+        result_cache.clear()
+        result_cache.maxsize = int(self.config['execution']['result_cache_size'])
+        try:
+            runner.run(execgraph, updatehash=updatehash, config=self.config)
+        finally:
+            logger.debug('Result cache: %s' % result_cache.stats())
+            result_cache.clear()
+        hash_cache = get_file_hash_cache()
+        if hash_cache is not None:
+            logger.debug('File hash cache: %s' % hash_cache.stats())
         datestr = datetime.utcnow().strftime('%Y%m%dT%H%M%S')
         if str2bool(self.config['execution']['write_provenance']):
             prov_base = op.join(self.base_dir,
@@ -834,7 +852,7 @@ connected.
     def _create_flat_graph(self):
         """Make a simple DAG where no node is a workflow."""
         logger.debug('Creating flat graph for workflow: %s', self.name)
-        workflowcopy = deepcopy(self)
+        workflowcopy = clone_nodes(self, nodes=self._get_all_nodes())
         workflowcopy._generate_flatgraph()
         return workflowcopy._graph
 
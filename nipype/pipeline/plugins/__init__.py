@@ -17,6 +17,6 @@ from .sgegraph import SGEGraphPlugin
 from .lsf import LSFPlugin
 from .slurm import SLURMPlugin
 from .slurmgraph import SLURMGraphPlugin
+from .pilot import PilotPlugin
 
 from .callback_log import log_nodes_cb
-from . import  semaphore_singleton
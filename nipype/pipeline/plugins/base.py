@@ -6,25 +6,28 @@
 from builtins import range
 from builtins import object
 
-from copy import deepcopy
 from glob import glob
+from heapq import heappush, heappop
 import os
 import getpass
 import shutil
 from socket import gethostname
+import struct
 import sys
+import threading
 import uuid
 from time import strftime, sleep, time
 from traceback import format_exception, format_exc
 from warnings import warn
 
 import numpy as np
-import scipy.sparse as ssp
 
 
+from ...interfaces.base import Bunch
 from ...utils.filemanip import savepkl, loadpkl
 from ...utils.misc import str2bool
-from ..engine.utils import (nx, dfs_preorder, topological_sort)
+from ..engine.utils import (nx, dfs_preorder, topological_sort,
+                            cache_node_result)
 from ..engine import MapNode
 
 
@@ -96,8 +99,10 @@ def report_nodes_not_run(notrun):
                             'Check log for details'))
 
 
-def create_pyscript(node, updatehash=False, store_exception=True):
-    # pickle node
+def _batch_paths(node):
+    """Return the batch directory of a node and a unique suffix for the
+    files that are written there
+    """
     timestamp = strftime('%Y%m%d_%H%M%S')
     if node._hierarchy:
         suffix = '%s_%s_%s' % (timestamp, node._hierarchy, node._id)
@@ -109,70 +114,100 @@ def create_pyscript(node, updatehash=False, store_exception=True):
         batch_dir = os.path.join(node.base_dir, 'batch')
     if not os.path.exists(batch_dir):
         os.makedirs(batch_dir)
+    return batch_dir, suffix
+
+
+def _node_duration(node, default):
+    """Return the estimated duration of a node in seconds
+    """
+    try:
+        return float(node.plugin_args['estimated_duration'])
+    except (AttributeError, KeyError, TypeError):
+        return default
+
+
+def create_pyscript(node, updatehash=False, store_exception=True,
+                    marker_dir=None):
+    """Create a python script running a node
+
+    When ``marker_dir`` is given, the script writes the marker returned by
+    :func:`task_marker` in this directory once the node finished.
+    """
+    # pickle node
+    batch_dir, suffix = _batch_paths(node)
     pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % suffix)
     savepkl(pkl_file, dict(node=node, updatehash=updatehash))
-    mpl_backend = node.config["execution"]["matplotlib_backend"]
-    # create python script to load and trap exception
-    cmdstr = """import os
-import sys
+    return _write_pyscript(node, batch_dir, suffix, pkl_file,
+                           store_exception=store_exception,
+                           marker_dir=marker_dir)
 
-can_import_matplotlib = True #Silently allow matplotlib to be ignored
-try:
-    import matplotlib
-    matplotlib.use('%s')
-except ImportError:
-    can_import_matplotlib = False
-    pass
 
-from nipype import config, logging
-from nipype.utils.filemanip import loadpkl, savepkl
-from socket import gethostname
-from traceback import format_exception
-info = None
-pklfile = '%s'
-batchdir = '%s'
-from nipype.utils.filemanip import loadpkl, savepkl
-try:
-    if not sys.version_info < (2, 7):
-        from collections import OrderedDict
-    config_dict=%s
-    config.update_config(config_dict)
-    ## Only configure matplotlib if it was successfully imported, matplotlib is an optional component to nipype
-    if can_import_matplotlib:
-        config.update_matplotlib()
-    logging.update_logging(config)
-    traceback=None
-    cwd = os.getcwd()
-    info = loadpkl(pklfile)
-    result = info['node'].run(updatehash=info['updatehash'])
-except Exception as e:
-    etype, eval, etr = sys.exc_info()
-    traceback = format_exception(etype,eval,etr)
-    if info is None or not os.path.exists(info['node'].output_dir()):
-        result = None
-        resultsfile = os.path.join(batchdir, 'crashdump_%s.pklz')
-    else:
-        result = info['node'].result
-        resultsfile = os.path.join(info['node'].output_dir(),
-                               'result_%%s.pklz'%%info['node'].name)
-"""
-    if store_exception:
-        cmdstr += """
-    savepkl(resultsfile, dict(result=result, hostname=gethostname(),
-                              traceback=traceback))
-"""
-    else:
-        cmdstr += """
-    if info is None:
-        savepkl(resultsfile, dict(result=result, hostname=gethostname(),
-                              traceback=traceback))
-    else:
-        from nipype.pipeline.plugins.base import report_crash
-        report_crash(info['node'], traceback, gethostname())
-    raise Exception(e)
-"""
-    cmdstr = cmdstr % (mpl_backend, pkl_file, batch_dir, node.config, suffix)
+def create_manifest_pyscript(nodes, updatehash=False, store_exception=True,
+                             kind='array', marker_dir=None):
+    """Create a single python script running several nodes
+
+    The nodes are pickled in a single manifest file, each in its own section
+    so that the script only unpickles the nodes it runs. The script runs, in
+    one interpreter, the nodes whose indices are passed as arguments or all
+    the nodes in order without arguments. After each node, it writes the
+    marker returned by :func:`task_marker`, in ``marker_dir`` or next to
+    the script. Without ``store_exception``, the script stops at the first
+    node that crashes.
+    """
+    batch_dir, suffix = _batch_paths(nodes[0])
+    suffix = '%s_%s' % (suffix, kind)
+    manifest = Bunch()
+    names = []
+    for index, node in enumerate(nodes):
+        names.append('node_%d' % index)
+        setattr(manifest, names[-1],
+                dict(node=node, updatehash=updatehash))
+    pkl_file = os.path.join(batch_dir, 'node_%s.pklz' % suffix)
+    savepkl(pkl_file, manifest, sections=names)
+    return _write_pyscript(nodes[0], batch_dir, suffix, pkl_file,
+                           store_exception=store_exception,
+                           num_nodes=len(nodes),
+                           marker_dir=marker_dir or batch_dir)
+
+
+def task_marker(pyscript, index=None, marker_dir=None):
+    """Return the file written when a script created by
+    :func:`create_pyscript`, or its node ``index`` for scripts created by
+    :func:`create_manifest_pyscript`, finishes
+    """
+    name = os.path.splitext(os.path.basename(pyscript))[0]
+    if index is not None:
+        name = '%s.%d' % (name, index)
+    return os.path.join(marker_dir or os.path.dirname(pyscript),
+                        name + '.done')
+
+
+def _write_pyscript(node, batch_dir, suffix, pkl_file, store_exception=True,
+                    num_nodes=None, marker_dir=None):
     pyscript = os.path.join(batch_dir, 'pyscript_%s.py' % suffix)
+    marker = None
+    if marker_dir:
+        marker = os.path.join(marker_dir, os.path.splitext(
+            os.path.basename(pyscript))[0])
+    # the script only imports the launcher, the configuration is read from
+    # the pickled node
+    cmdstr = """import sys
+from nipype.pipeline.plugins.launcher import run_node
+pklfile = %r
+batchdir = %r
+""" % (pkl_file, batch_dir)
+    if num_nodes is None:
+        cmdstr += "run_node(pklfile, batchdir, %r, store_exception=%r" % (
+            suffix, store_exception)
+        if marker:
+            cmdstr += ",\n         marker=%r" % (marker + '.done')
+        cmdstr += ")\n"
+    else:
+        cmdstr += """indices = sys.argv[1:] or [str(i) for i in range(%d)]
+for index in indices:
+    run_node(pklfile, batchdir, %r + index, section='node_' + index,
+             store_exception=%r, marker=%r + index + '.done')
+""" % (num_nodes, suffix + '_', store_exception, marker + '.')
     fp = open(pyscript, 'wt')
     fp.writelines(cmdstr)
     fp.close()
@@ -195,6 +230,13 @@ class PluginBase(object):
 
 class DistributedPluginBase(PluginBase):
     """Execute workflow with a distribution engine
+
+    Scheduling is event driven: every process keeps a counter of the
+    dependencies that have not finished yet and a process enters the ready
+    queue as soon as its counter drops to zero. Plugins that are notified
+    asynchronously about finished tasks (e.g., through a callback) should
+    call :meth:`_task_done_signal` so that the scheduler wakes up
+    immediately instead of sleeping for ``poll_sleep_duration`` seconds.
     """
 
     def __init__(self, plugin_args=None):
@@ -207,13 +249,21 @@ class DistributedPluginBase(PluginBase):
             process is currently running. Note: A process is finished only when
             both proc_done==True and
         proc_pending==False
-        depidx: a boolean matrix (NxN) storing the dependency structure accross
-            processes. Process dependencies are derived from each column.
+        depcount: an integer vector (N) storing the number of unfinished
+            dependencies of each process
+        successors: list (N) of the indices of the processes that depend on
+            each process
+        predecessors: list (N) of the indices of the processes each process
+            depends on
+        refcount: an integer vector (N) storing the number of dependent
+            processes that still need the outputs of each process
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
-        self.depidx = None
-        self.refidx = None
+        self.depcount = None
+        self.successors = None
+        self.predecessors = None
+        self.refcount = None
         self.mapnodes = None
         self.mapnodesubids = None
         self.proc_done = None
@@ -221,6 +271,20 @@ class DistributedPluginBase(PluginBase):
         self.max_jobs = np.inf
         if plugin_args and 'max_jobs' in plugin_args:
             self.max_jobs = plugin_args['max_jobs']
+        self._ready = []
+        self._ready_changed = False
+        self._task_done_event = threading.Event()
+
+    def __getstate__(self):
+        # MapNodes keep a reference to the plugin, which must survive
+        # deepcopy and pickling without the thread synchronization primitive
+        state = self.__dict__.copy()
+        del state['_task_done_event']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._task_done_event = threading.Event()
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline using distributed approaches
@@ -230,10 +294,9 @@ class DistributedPluginBase(PluginBase):
         # Generate appropriate structures for worker-manager model
         self._generate_dependency_list(graph)
         self.pending_tasks = []
-        self.readytorun = []
         self.mapnodes = []
         self.mapnodesubids = {}
-        # setup polling - TODO: change to threaded model
+        self._task_done_event.clear()
         notrun = []
         while np.any(self.proc_done == False) | \
                 np.any(self.proc_pending == True):
@@ -249,7 +312,8 @@ class DistributedPluginBase(PluginBase):
                             notrun.append(self._clean_queue(jobid, graph,
                                                             result=result))
                         else:
-                            self._task_finished_cb(jobid)
+                            self._task_finished_cb(jobid,
+                                                   result=result['result'])
                             self._remove_node_dirs()
                         self._clear_task(taskid)
                     else:
@@ -263,6 +327,7 @@ class DistributedPluginBase(PluginBase):
                 self.pending_tasks.extend(toappend)
             num_jobs = len(self.pending_tasks)
             logger.debug('Number of pending tasks: %d' % num_jobs)
+            self._ready_changed = False
             if num_jobs < self.max_jobs:
                 self._send_procs_to_workers(updatehash=updatehash,
                                             graph=graph)
@@ -273,15 +338,35 @@ class DistributedPluginBase(PluginBase):
         self._remove_node_dirs()
         report_nodes_not_run(notrun)
 
+    def _wait(self):
+        """Block until a pending task finishes or the poll interval elapses
 
+        Returns immediately when there is nothing to wait for or when new
+        processes became ready while submitting jobs.
+        """
+        if self._ready_changed or not self.pending_tasks:
+            return
+        timeout = float(self._config['execution']['poll_sleep_duration'])
+        self._task_done_event.wait(timeout)
+        self._task_done_event.clear()
 
-    def _wait(self):
-        sleep(float(self._config['execution']['poll_sleep_duration']))
+    def _task_done_signal(self, *args):
+        """Wake up the scheduler loop
+
+        Safe to call from any thread, so it can be used directly as the
+        completion callback of asynchronous results.
+        """
+        self._task_done_event.set()
 
     def _get_result(self, taskid):
         raise NotImplementedError
 
     def _submit_job(self, node, updatehash=False):
+        """Submit a node and return a task id
+
+        The node is the one held by the scheduler, not a copy. It must be
+        serialized (or copied) before returning and must not be modified.
+        """
         raise NotImplementedError
 
     def _report_crash(self, node, result=None):
@@ -311,34 +396,70 @@ class DistributedPluginBase(PluginBase):
     def _submit_mapnode(self, jobid):
         if jobid in self.mapnodes:
             return True
+        for subid in self._add_mapnode_subnodes(jobid):
+            self._push_ready(subid)
+        return False
+
+    def _add_mapnode_subnodes(self, jobid):
+        """Add the subnodes of a mapnode to the processes and return their
+        ids
+        """
         self.mapnodes.append(jobid)
         mapnodesubids = self.procs[jobid].get_subnodes()
         numnodes = len(mapnodesubids)
         logger.info('Adding %d jobs for mapnode %s' % (numnodes,
                                                        self.procs[jobid]._id))
-        for i in range(numnodes):
-            self.mapnodesubids[self.depidx.shape[0] + i] = jobid
+        firstid = len(self.procs)
+        subids = list(range(firstid, firstid + numnodes))
+        for subid in subids:
+            self.mapnodesubids[subid] = jobid
         self.procs.extend(mapnodesubids)
-        self.depidx = ssp.vstack((self.depidx,
-                                  ssp.lil_matrix(np.zeros(
-                                      (numnodes, self.depidx.shape[1])))),
-                                 'lil')
-        self.depidx = ssp.hstack((self.depidx,
-                                  ssp.lil_matrix(
-                                      np.zeros((self.depidx.shape[0],
-                                                numnodes)))),
-                                 'lil')
-        self.depidx[-numnodes:, jobid] = 1
+        # the mapnode collates its subnodes, hence depends on all of them
+        self.successors.extend([[jobid] for _ in subids])
+        self.predecessors.extend([[] for _ in subids])
+        self.predecessors[jobid].extend(subids)
+        self.depcount[jobid] += numnodes
+        self.depcount = np.concatenate((self.depcount,
+                                        np.zeros(numnodes, dtype=int)))
+        self.refcount = np.concatenate((self.refcount,
+                                        np.zeros(numnodes, dtype=int)))
         self.proc_done = np.concatenate((self.proc_done,
                                          np.zeros(numnodes, dtype=bool)))
         self.proc_pending = np.concatenate((self.proc_pending,
                                             np.zeros(numnodes, dtype=bool)))
-        return False
+        return subids
+
+    def _push_ready(self, jobid):
+        """Add a process whose dependencies have all finished to the queue
+        """
+        heappush(self._ready, jobid)
+        self._ready_changed = True
+
+    def _pop_ready(self, maxjobs=None):
+        """Remove and return up to ``maxjobs`` processes from the ready queue
+
+        Processes are returned in topological order. Processes that were
+        marked as done in the meantime (e.g., dependents of a crashed node)
+        are discarded.
+        """
+        jobids = []
+        while self._ready and (maxjobs is None or len(jobids) < maxjobs):
+            jobid = heappop(self._ready)
+            if not self.proc_done[jobid] and self.depcount[jobid] == 0:
+                jobids.append(jobid)
+        return jobids
+
+    def _requeue(self, jobids):
+        """Put back processes that were popped but could not be submitted
+        """
+        for jobid in jobids:
+            if not self.proc_done[jobid] and self.depcount[jobid] == 0:
+                heappush(self._ready, jobid)
 
     def _send_procs_to_workers(self, updatehash=False, graph=None):
         """ Sends jobs to workers
         """
-        while np.any(self.proc_done == False):
+        while self._ready:
             num_jobs = len(self.pending_tasks)
             if np.isinf(self.max_jobs):
                 slots = None
@@ -348,114 +469,136 @@ class DistributedPluginBase(PluginBase):
             if (num_jobs >= self.max_jobs) or (slots == 0):
                 break
             # Check to see if a job is available
-            jobids = np.flatnonzero((self.proc_done == False) &
-                                    (self.depidx.sum(axis=0) == 0).__array__())
-            if len(jobids) > 0:
-                # send all available jobs
-                if slots:
-                    logger.info('Pending[%d] Submitting[%d] jobs Slots[%d]' % (num_jobs, len(jobids[:slots]), slots))
-                else:
-                    logger.info('Pending[%d] Submitting[%d] jobs Slots[inf]' % (num_jobs, len(jobids)))
-                for jobid in jobids[:slots]:
-                    if isinstance(self.procs[jobid], MapNode):
-                        try:
-                            num_subnodes = self.procs[jobid].num_subnodes()
-                        except Exception:
-                            self._clean_queue(jobid, graph)
-                            self.proc_pending[jobid] = False
+            jobids = self._pop_ready(slots)
+            if not jobids:
+                break
+            # send all available jobs
+            if slots:
+                logger.info('Pending[%d] Submitting[%d] jobs Slots[%d]' %
+                            (num_jobs, len(jobids), slots))
+            else:
+                logger.info('Pending[%d] Submitting[%d] jobs Slots[inf]' %
+                            (num_jobs, len(jobids)))
+            deferred = False
+            for jobid in jobids:
+                if isinstance(self.procs[jobid], MapNode):
+                    try:
+                        num_subnodes = self.procs[jobid].num_subnodes()
+                    except Exception:
+                        self._clean_queue(jobid, graph)
+                        self.proc_pending[jobid] = False
+                        continue
+                    if num_subnodes > 1:
+                        submit = self._submit_mapnode(jobid)
+                        if not submit:
                             continue
-                        if num_subnodes > 1:
-                            submit = self._submit_mapnode(jobid)
-                            if not submit:
-                                continue
-                    # change job status in appropriate queues
-                    self.proc_done[jobid] = True
-                    self.proc_pending[jobid] = True
-                    # Send job to task manager and add to pending tasks
-                    logger.info('Submitting: %s ID: %d' %
-                                (self.procs[jobid]._id, jobid))
-                    if self._status_callback:
-                        self._status_callback(self.procs[jobid], 'start')
-                    continue_with_submission = True
-                    if str2bool(self.procs[jobid].config['execution']
-                                ['local_hash_check']):
-                        logger.debug('checking hash locally')
+                # change job status in appropriate queues
+                self.proc_done[jobid] = True
+                self.proc_pending[jobid] = True
+                # Send job to task manager and add to pending tasks
+                logger.info('Submitting: %s ID: %d' %
+                            (self.procs[jobid]._id, jobid))
+                if self._status_callback:
+                    self._status_callback(self.procs[jobid], 'start')
+                continue_with_submission = True
+                if str2bool(self.procs[jobid].config['execution']
+                            ['local_hash_check']):
+                    logger.debug('checking hash locally')
+                    try:
+                        hash_exists, _, _, _ = self.procs[
+                            jobid].hash_exists()
+                        logger.debug('Hash exists %s' % str(hash_exists))
+                        if (hash_exists and (self.procs[jobid].overwrite is False or
+                            (self.procs[jobid].overwrite is None and not
+                                self.procs[jobid]._interface.always_run))):
+                            continue_with_submission = False
+                            self._task_finished_cb(jobid)
+                            self._remove_node_dirs()
+                    except Exception:
+                        self._clean_queue(jobid, graph)
+                        self.proc_pending[jobid] = False
+                        continue_with_submission = False
+                logger.debug('Finished checking hash %s' %
+                             str(continue_with_submission))
+                if continue_with_submission:
+                    if self.procs[jobid].run_without_submitting:
+                        logger.debug('Running node %s on master thread' %
+                                     self.procs[jobid])
+                        result = None
                         try:
-                            hash_exists, _, _, _ = self.procs[
-                                jobid].hash_exists()
-                            logger.debug('Hash exists %s' % str(hash_exists))
-                            if (hash_exists and (self.procs[jobid].overwrite is False or
-                                (self.procs[jobid].overwrite is None and not
-                                    self.procs[jobid]._interface.always_run))):
-                                continue_with_submission = False
-                                self._task_finished_cb(jobid)
-                                self._remove_node_dirs()
+                            result = self.procs[jobid].run()
                         except Exception:
                             self._clean_queue(jobid, graph)
+                        self._task_finished_cb(jobid, result=result)
+                        self._remove_node_dirs()
+                    else:
+                        tid = self._submit_job(self.procs[jobid],
+                                               updatehash=updatehash)
+                        if tid is None:
+                            self.proc_done[jobid] = False
                             self.proc_pending[jobid] = False
-                            continue_with_submission = False
-                    logger.debug('Finished checking hash %s' %
-                                 str(continue_with_submission))
-                    if continue_with_submission:
-                        if self.procs[jobid].run_without_submitting:
-                            logger.debug('Running node %s on master thread' %
-                                         self.procs[jobid])
-                            try:
-                                self.procs[jobid].run()
-                            except Exception:
-                                self._clean_queue(jobid, graph)
-                            self._task_finished_cb(jobid)
-                            self._remove_node_dirs()
+                            deferred = True
                         else:
-                            tid = self._submit_job(deepcopy(self.procs[jobid]),
-                                                   updatehash=updatehash)
-                            if tid is None:
-                                self.proc_done[jobid] = False
-                                self.proc_pending[jobid] = False
-                            else:
-                                self.pending_tasks.insert(0, (tid, jobid))
-                    logger.info('Finished submitting: %s ID: %d' %
-                                (self.procs[jobid]._id, jobid))
-            else:
+                            self.pending_tasks.insert(0, (tid, jobid))
+                logger.info('Finished submitting: %s ID: %d' %
+                            (self.procs[jobid]._id, jobid))
+            self._requeue(jobids)
+            if deferred:
+                # the task manager refused a job, retry on the next cycle
                 break
 
-    def _task_finished_cb(self, jobid):
+    def _task_finished_cb(self, jobid, result=None):
         """ Extract outputs and assign to inputs of dependent tasks
 
-        This is called when a job is completed.
+        This is called when a job is completed. The outputs of the ``result``
+        received from the worker are cached for the dependent tasks.
         """
         logger.info('[Job finished] jobname: %s jobid: %d' %
                     (self.procs[jobid]._id, jobid))
         if self._status_callback:
             self._status_callback(self.procs[jobid], 'end')
+        cache_node_result(self.procs[jobid], result)
         # Update job and worker queues
         self.proc_pending[jobid] = False
         # update the job dependency structure
-        rowview = self.depidx.getrowview(jobid)
-        rowview[rowview.nonzero()] = 0
+        for child in self.successors[jobid]:
+            self.depcount[child] -= 1
+            if self.depcount[child] == 0 and not self.proc_done[child]:
+                self._push_ready(child)
+        self.successors[jobid] = []
         if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+            for parent in self.predecessors[jobid]:
+                if parent not in self.mapnodesubids:
+                    self.refcount[parent] -= 1
+            self.predecessors[jobid] = []
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
         """
         self.procs, _ = topological_sort(graph)
-        try:
-            self.depidx = nx.to_scipy_sparse_matrix(graph,
-                                                    nodelist=self.procs,
-                                                    format='lil')
-        except:
-            self.depidx = nx.to_scipy_sparse_matrix(graph,
-                                                    nodelist=self.procs)
-        self.refidx = deepcopy(self.depidx)
-        self.refidx.astype = np.int
+        procidx = dict((node, idx) for idx, node in enumerate(self.procs))
+        self.successors = [[procidx[child] for child in graph.successors(node)]
+                           for node in self.procs]
+        self.predecessors = [[procidx[parent]
+                              for parent in graph.predecessors(node)]
+                             for node in self.procs]
+        self.depcount = np.array([len(parents)
+                                  for parents in self.predecessors],
+                                 dtype=int)
+        self.refcount = np.array([len(children)
+                                  for children in self.successors],
+                                 dtype=int)
         self.proc_done = np.zeros(len(self.procs), dtype=bool)
         self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        self._ready = []
+        for jobid in np.flatnonzero(self.depcount == 0):
+            self._push_ready(int(jobid))
 
     def _remove_node_deps(self, jobid, crashfile, graph):
         subnodes = [s for s in dfs_preorder(graph, self.procs[jobid])]
+        procidx = dict((node, idx) for idx, node in enumerate(self.procs))
         for node in subnodes:
-            idx = self.procs.index(node)
+            idx = procidx[node]
             self.proc_done[idx] = True
             self.proc_pending[idx] = False
         return dict(node=self.procs[jobid],
@@ -466,12 +609,11 @@ class DistributedPluginBase(PluginBase):
         """Removes directories whose outputs have already been used up
         """
         if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero(
-                                 (self.refidx.sum(axis=1) == 0).__array__())[0]:
+            for idx in np.flatnonzero(self.refcount == 0):
                 if idx in self.mapnodesubids:
                     continue
                 if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
+                    self.refcount[idx] = -1
                     outdir = self.procs[idx]._output_directory()
                     logger.info(('[node dependencies finished] '
                                  'removing node: %s from directory %s') %
@@ -479,14 +621,201 @@ class DistributedPluginBase(PluginBase):
                     shutil.rmtree(outdir)
 
 
+class BatchStatusCache(object):
+    """Status of the jobs of a batch system, refreshed with a single query
+    for all the jobs at most every ``refresh_interval`` seconds
+
+    Jobs submitted after the last query are pending. Jobs that are missing
+    from the last query, or all the jobs when the batch system could not be
+    queried, are checked one by one.
+    """
+
+    def __init__(self, refresh_interval=5):
+        self.refresh_interval = refresh_interval
+        self._status = None
+        self._refreshed = None
+        self._submitted = {}
+
+    def submitted(self, taskid):
+        self._submitted[str(taskid)] = time()
+
+    def forget(self, taskid):
+        self._submitted.pop(str(taskid), None)
+
+    def is_pending(self, taskid, query, job_query):
+        """Check if a task is pending
+
+        Parameters
+        ----------
+        taskid : the id of the job in the batch system
+        query : function returning a dictionary that maps the ids (as
+            strings) of the jobs listed by the batch system to whether they
+            are pending
+        job_query : function checking if a single job is pending
+        """
+        now = time()
+        if self._refreshed is None or \
+                now - self._refreshed >= self.refresh_interval:
+            try:
+                self._status = query()
+            except Exception as e:
+                logger.debug('Could not query the status of all jobs: %s', e)
+                self._status = None
+            self._refreshed = now
+        key = str(taskid)
+        if self._status is None:
+            return job_query(taskid)
+        if key in self._status:
+            return self._status[key]
+        if self._submitted.get(key, 0) >= self._refreshed:
+            return True
+        # the job left the queue, make sure that it finished
+        return job_query(taskid)
+
+
+def _inotify_watch(path):
+    """Watch the files written in a directory with inotify
+
+    Returns the inotify file descriptor, or None where inotify is not
+    available.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (AttributeError, OSError, TypeError):
+        return None
+    if fd < 0:
+        return None
+    # IN_CLOSE_WRITE | IN_MOVED_TO
+    if libc.inotify_add_watch(fd, path.encode('utf-8'), 0x8 | 0x80) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+class CompletionSpool(object):
+    """Directory where batch jobs write a marker when they finish
+
+    The directory is listed at most once every ``interval`` seconds, which
+    is once per scheduling cycle. Where inotify is available, the markers
+    written from the host running the scheduler are also picked up as soon
+    as they are written and ``callback`` is called. inotify does not report
+    the files written by other hosts on network filesystems, which are only
+    seen by the listing.
+    """
+
+    def __init__(self, path, callback=None, interval=0.5):
+        self.path = path
+        self.interval = interval
+        self._callback = callback
+        self._done = set()
+        self._listed = None
+        self._lock = threading.Lock()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._stop = threading.Event()
+        self._fd = _inotify_watch(path)
+        self._watcher = None
+        if self._fd is not None:
+            self._watcher = threading.Thread(target=self._watch)
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def _watch(self):
+        from select import select
+        while not self._stop.is_set():
+            if not select([self._fd], [], [], 0.5)[0]:
+                continue
+            data = os.read(self._fd, 65536)
+            names = []
+            offset = 0
+            while offset < len(data):
+                _, _, _, size = struct.unpack_from('iIII', data, offset)
+                offset += struct.calcsize('iIII')
+                names.append(data[offset:offset + size].rstrip(b'\0')
+                             .decode('utf-8'))
+                offset += size
+            with self._lock:
+                self._done.update(names)
+            if self._callback:
+                self._callback()
+
+    def refresh(self, force=False):
+        """List the markers in the directory
+        """
+        now = time()
+        if not force and self._listed is not None and \
+                now - self._listed < self.interval:
+            return
+        self._listed = now
+        names = os.listdir(self.path)
+        with self._lock:
+            self._done.update(names)
+
+    def is_done(self, marker):
+        self.refresh()
+        with self._lock:
+            return os.path.basename(marker) in self._done
+
+    def discard(self, marker):
+        name = os.path.basename(marker)
+        with self._lock:
+            self._done.discard(name)
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def close(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            os.close(self._fd)
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
 class SGELikeBatchManagerBase(DistributedPluginBase):
     """Execute workflow with SGE/OGE/PBS like batch system
+
+    The status of the jobs is queried at once for all the jobs when the
+    plugin implements :meth:`_query_status`, at most every
+    ``status_refresh_interval`` seconds (plugin argument, default 5).
+
+    When the ``array_jobs`` plugin argument is set and the plugin implements
+    :meth:`_submit_array`, the subnodes of a mapnode are submitted as a
+    single array job, whose tasks run the subnode selected by their index.
+    The subnodes are pickled in a single manifest file and a task is
+    finished as soon as it wrote its completion marker, otherwise the status
+    of the whole array is queried.
+
+    When the ``bundle_duration`` plugin argument is set, ready nodes, each
+    followed by the chain of nodes that only depend on it, are bundled into
+    a single job until their estimated duration reaches ``bundle_duration``
+    seconds. The jobs run their nodes one after the other in a single
+    interpreter and the nodes finish separately. Nodes are estimated to run
+    for ``estimated_duration`` seconds (plugin argument, default 10), unless
+    their ``plugin_args`` provide an ``estimated_duration``.
+
+    The jobs write a completion marker in a spool directory of the run (see
+    :class:`CompletionSpool`) after their results. Finished jobs are picked
+    up from the markers without querying the batch system, and their results
+    are loaded without waiting for them to show up.
     """
 
+    # shell expression expanding to the index (starting at 0) of a task of
+    # an array job, None if the plugin does not support array jobs
+    _array_index = None
+
     def __init__(self, template, plugin_args=None):
         super(SGELikeBatchManagerBase, self).__init__(plugin_args=plugin_args)
         self._template = template
         self._qsub_args = None
+        refresh_interval = 5
+        self._array_jobs = False
+        self._bundle_duration = 0
+        self._estimated_duration = 10
         if plugin_args:
             if 'template' in plugin_args:
                 self._template = plugin_args['template']
@@ -494,24 +823,235 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
                     self._template = open(self._template).read()
             if 'qsub_args' in plugin_args:
                 self._qsub_args = plugin_args['qsub_args']
+            if 'status_refresh_interval' in plugin_args:
+                refresh_interval = plugin_args['status_refresh_interval']
+            if 'array_jobs' in plugin_args:
+                self._array_jobs = plugin_args['array_jobs']
+            if 'bundle_duration' in plugin_args:
+                self._bundle_duration = plugin_args['bundle_duration']
+            if 'estimated_duration' in plugin_args:
+                self._estimated_duration = plugin_args['estimated_duration']
         self._pending = {}
+        self._status_cache = BatchStatusCache(refresh_interval)
+        self._task_markers = {}
+        self._job_tasks = {}
+        self._spool = None
+        self._updatehash = False
+        self._bundle = []
+        self._bundle_time = 0
+        self._bundle_count = 0
+        self._jobids = {}
+
+    def __getstate__(self):
+        state = super(SGELikeBatchManagerBase, self).__getstate__()
+        state['_spool'] = None
+        return state
+
+    def run(self, graph, config, updatehash=False):
+        self._updatehash = updatehash
+        if graph.nodes():
+            batch_dir, _ = _batch_paths(graph.nodes()[0])
+            self._spool = CompletionSpool(
+                os.path.join(batch_dir, 'done_%s' % uuid.uuid4().hex),
+                callback=self._task_done_signal)
+        try:
+            return super(SGELikeBatchManagerBase, self).run(
+                graph, config, updatehash=updatehash)
+        finally:
+            if self._spool is not None:
+                self._spool.close()
+                self._spool = None
+
+    def _marker_dir(self):
+        if self._spool is None:
+            return None
+        return self._spool.path
+
+    def _marker_done(self, marker):
+        if self._spool is None:
+            return os.path.exists(marker)
+        return self._spool.is_done(marker)
+
+    def _add_tasks(self, jobid, pyscript, taskids, nodes):
+        """Track the nodes run by the job ``jobid`` with ``pyscript``
+        """
+        self._status_cache.submitted(jobid)
+        self._job_tasks[jobid] = len(nodes)
+        marker_dir = self._marker_dir()
+        if len(nodes) == 1 and taskids[0] == jobid:
+            self._task_markers[jobid] = (
+                jobid, task_marker(pyscript, marker_dir=marker_dir))
+            return
+        for index, (taskid, node) in enumerate(zip(taskids, nodes)):
+            self._pending[taskid] = node.output_dir()
+            self._task_markers[taskid] = (
+                jobid, task_marker(pyscript, index, marker_dir=marker_dir))
 
     def _is_pending(self, taskid):
         """Check if a task is pending in the batch system
         """
         raise NotImplementedError
 
+    def _query_status(self):
+        """Return whether the jobs listed by the batch system are pending
+
+        Returns a dictionary keyed on the job ids (as strings). Batch systems
+        that cannot list all jobs at once return None, and their jobs are
+        checked one by one with :meth:`_is_pending`.
+        """
+        return None
+
+    def _task_pending(self, taskid):
+        jobid, marker = self._task_markers.get(taskid, (taskid, None))
+        if marker is not None and self._marker_done(marker):
+            return False
+        return self._status_cache.is_pending(jobid, self._query_status,
+                                             self._is_pending)
+
     def _submit_batchtask(self, scriptfile, node):
         """Submit a task to the batch system
         """
         raise NotImplementedError
 
+    def _submit_array(self, scriptfile, node, size):
+        """Submit an array job of ``size`` tasks to the batch system and
+        return its id
+        """
+        raise NotImplementedError
+
+    def _submit_mapnode(self, jobid):
+        if not self._array_jobs or self._array_index is None:
+            return super(SGELikeBatchManagerBase, self)._submit_mapnode(jobid)
+        if jobid in self.mapnodes:
+            return True
+        subids = self._add_mapnode_subnodes(jobid)
+        try:
+            taskids = self._submit_array_job(
+                [self.procs[subid] for subid in subids],
+                updatehash=self._updatehash)
+        except Exception as e:
+            logger.warn('Could not submit mapnode %s as an array job, '
+                        'submitting its subnodes separately: %s' %
+                        (self.procs[jobid]._id, e))
+            for subid in subids:
+                self._push_ready(subid)
+            return False
+        for subid, taskid in zip(subids, taskids):
+            self.proc_done[subid] = True
+            self.proc_pending[subid] = True
+            if self._status_callback:
+                self._status_callback(self.procs[subid], 'start')
+            self.pending_tasks.insert(0, (taskid, subid))
+        return False
+
+    def _submit_array_job(self, nodes, updatehash=False):
+        """submit nodes as a single array job and return the taskids of its
+        tasks
+        """
+        pyscript = create_manifest_pyscript(nodes, updatehash=updatehash,
+                                            marker_dir=self._marker_dir())
+        batchscriptfile = self._write_batchscript(pyscript,
+                                                  self._array_index)
+        arrayid = self._submit_array(batchscriptfile, nodes[0], len(nodes))
+        taskids = ['%s.%d' % (arrayid, index) for index in range(len(nodes))]
+        self._add_tasks(arrayid, pyscript, taskids, nodes)
+        logger.debug('submitted array job %s for %d nodes' %
+                     (arrayid, len(nodes)))
+        return taskids
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        super(SGELikeBatchManagerBase, self)._send_procs_to_workers(
+            updatehash=updatehash, graph=graph)
+        self._submit_bundle()
+
+    def _jobid(self, node):
+        if len(self._jobids) != len(self.procs):
+            self._jobids = dict((id(proc), jobid)
+                                for jobid, proc in enumerate(self.procs))
+        return self._jobids[id(node)]
+
+    def _bundle_job(self, node):
+        """Add a node to the current bundle, followed by the chain of nodes
+        that only depend on it, and return its taskid
+        """
+        duration = _node_duration(node, self._estimated_duration)
+        if self._bundle and \
+                self._bundle_time + duration > self._bundle_duration:
+            self._submit_bundle()
+        taskid = self._add_to_bundle(node, duration)
+        jobid = self._jobid(node)
+        while len(self.successors[jobid]) == 1:
+            nextid = self.successors[jobid][0]
+            nextnode = self.procs[nextid]
+            duration = _node_duration(nextnode, self._estimated_duration)
+            if self.depcount[nextid] != 1 or self.proc_done[nextid] or \
+                    isinstance(nextnode, MapNode) or \
+                    nextnode.run_without_submitting or \
+                    self._bundle_time + duration > self._bundle_duration:
+                break
+            self.proc_done[nextid] = True
+            self.proc_pending[nextid] = True
+            logger.info('Bundling: %s ID: %d' % (nextnode._id, nextid))
+            if self._status_callback:
+                self._status_callback(nextnode, 'start')
+            self.pending_tasks.insert(
+                0, (self._add_to_bundle(nextnode, duration), nextid))
+            jobid = nextid
+        if self._bundle_time >= self._bundle_duration:
+            self._submit_bundle()
+        return taskid
+
+    def _add_to_bundle(self, node, duration):
+        taskid = 'bundle%d.%d' % (self._bundle_count, len(self._bundle))
+        self._bundle.append((taskid, node))
+        self._bundle_time += duration
+        return taskid
+
+    def _submit_bundle(self):
+        """submit the nodes of the current bundle as a single job
+        """
+        if not self._bundle:
+            return
+        taskids, nodes = zip(*self._bundle)
+        self._bundle = []
+        self._bundle_time = 0
+        self._bundle_count += 1
+        pyscript = create_manifest_pyscript(nodes, updatehash=self._updatehash,
+                                            kind='bundle',
+                                            marker_dir=self._marker_dir())
+        jobid = self._submit_batchtask(self._write_batchscript(pyscript),
+                                       nodes[0])
+        # the nodes are tracked separately, not the job
+        self._pending.pop(jobid, None)
+        self._add_tasks(jobid, pyscript, taskids, nodes)
+        logger.debug('submitted bundle job %s for %d nodes' %
+                     (jobid, len(nodes)))
+
+    def _write_batchscript(self, pyscript, args=None):
+        batch_dir, name = os.path.split(pyscript)
+        name = '.'.join(name.split('.')[:-1])
+        cmdline = '%s %s' % (sys.executable, pyscript)
+        if args:
+            cmdline = '%s %s' % (cmdline, args)
+        batchscript = '\n'.join((self._template, cmdline))
+        batchscriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
+        fp = open(batchscriptfile, 'wt')
+        fp.writelines(batchscript)
+        fp.close()
+        return batchscriptfile
+
     def _get_result(self, taskid):
         if taskid not in self._pending:
-            raise Exception('Task %d not found' % taskid)
-        if self._is_pending(taskid):
+            raise Exception('Task %s not found' % taskid)
+        if self._task_pending(taskid):
             return None
         node_dir = self._pending[taskid]
+        results_file = None
+        marker = self._task_markers.get(taskid, (None, None))[1]
+        if marker is not None and self._marker_done(marker):
+            # the job wrote the marker after the result
+            results_file = next(
+                iter(glob(os.path.join(node_dir, 'result_*.pklz'))), None)
         # MIT HACK
         # on the pbs system at mit the parent node directory needs to be
         # accessed before internal directories become available. there
@@ -519,20 +1059,18 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
         # finished to when the directories become statable.
         t = time()
         timeout = float(self._config['execution']['job_finished_timeout'])
-        timed_out = True
-        while (time() - t) < timeout:
+        while results_file is None and (time() - t) < timeout:
             try:
-                glob(os.path.join(node_dir, 'result_*.pklz')).pop()
-                timed_out = False
+                results_file = glob(os.path.join(node_dir,
+                                                 'result_*.pklz')).pop()
                 break
             except Exception as e:
                 logger.debug(e)
             sleep(2)
-        if timed_out:
+        if results_file is None:
             result_data = {'hostname': 'unknown',
                            'result': None,
                            'traceback': None}
-            results_file = None
             try:
                 error_message = ('Job id ({0}) finished or terminated, but '
                                  'results file does not exist after ({1}) '
@@ -544,7 +1082,6 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
             except IOError as e:
                 result_data['traceback'] = format_exc()
         else:
-            results_file = glob(os.path.join(node_dir, 'result_*.pklz'))[0]
             result_data = loadpkl(results_file)
         result_out = dict(result=None, traceback=None)
         if isinstance(result_data, dict):
@@ -561,16 +1098,14 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
     def _submit_job(self, node, updatehash=False):
         """submit job and return taskid
         """
-        pyscript = create_pyscript(node, updatehash=updatehash)
-        batch_dir, name = os.path.split(pyscript)
-        name = '.'.join(name.split('.')[:-1])
-        batchscript = '\n'.join((self._template,
-                                 '%s %s' % (sys.executable, pyscript)))
-        batchscriptfile = os.path.join(batch_dir, 'batchscript_%s.sh' % name)
-        fp = open(batchscriptfile, 'wt')
-        fp.writelines(batchscript)
-        fp.close()
-        return self._submit_batchtask(batchscriptfile, node)
+        if self._bundle_duration:
+            return self._bundle_job(node)
+        pyscript = create_pyscript(node, updatehash=updatehash,
+                                   marker_dir=self._marker_dir())
+        taskid = self._submit_batchtask(self._write_batchscript(pyscript),
+                                        node)
+        self._add_tasks(taskid, pyscript, [taskid], [node])
+        return taskid
 
     def _report_crash(self, node, result=None):
         if result and result['traceback']:
@@ -583,30 +1118,87 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
 
     def _clear_task(self, taskid):
         del self._pending[taskid]
+        if taskid in self._task_markers:
+            taskid, marker = self._task_markers.pop(taskid)
+            if self._spool is not None:
+                self._spool.discard(marker)
+            self._job_tasks[taskid] -= 1
+            if self._job_tasks[taskid]:
+                return
+            del self._job_tasks[taskid]
+        self._status_cache.forget(taskid)
 
 
 class GraphPluginBase(PluginBase):
     """Base class for plugins that distribute graphs to workflows
+
+    When the ``bundle_duration`` plugin argument is set, chains of linearly
+    dependent nodes are bundled into a single job until their estimated
+    duration reaches ``bundle_duration`` seconds (see
+    :class:`SGELikeBatchManagerBase`). The jobs are then passed to
+    :meth:`_submit_graph` with the last node of their chain.
     """
 
     def __init__(self, plugin_args=None):
         if plugin_args and 'status_callback' in plugin_args:
             warn('status_callback not supported for Graph submission plugins')
         super(GraphPluginBase, self).__init__(plugin_args=plugin_args)
+        self._bundle_duration = 0
+        self._estimated_duration = 10
+        if plugin_args:
+            if 'bundle_duration' in plugin_args:
+                self._bundle_duration = plugin_args['bundle_duration']
+            if 'estimated_duration' in plugin_args:
+                self._estimated_duration = plugin_args['estimated_duration']
 
     def run(self, graph, config, updatehash=False):
         pyfiles = []
         dependencies = {}
         self._config = config
         nodes = nx.topological_sort(graph)
+        chains = self._bundle_chains(graph, nodes)
+        chainidx = dict((node, idx) for idx, chain in enumerate(chains)
+                        for node in chain)
         logger.debug('Creating executable python files for each node')
-        for idx, node in enumerate(nodes):
-            pyfiles.append(create_pyscript(node,
-                                           updatehash=updatehash,
-                                           store_exception=False))
-            dependencies[idx] = [nodes.index(prevnode) for prevnode in
-                                 graph.predecessors(node)]
-        self._submit_graph(pyfiles, dependencies, nodes)
+        for idx, chain in enumerate(chains):
+            if len(chain) == 1:
+                pyfiles.append(create_pyscript(chain[0],
+                                               updatehash=updatehash,
+                                               store_exception=False))
+            else:
+                pyfiles.append(create_manifest_pyscript(
+                    chain, updatehash=updatehash, store_exception=False,
+                    kind='bundle'))
+            dependencies[idx] = [chainidx[prevnode] for prevnode in
+                                 graph.predecessors(chain[0])]
+        self._submit_graph(pyfiles, dependencies,
+                           [chain[-1] for chain in chains])
+
+    def _bundle_chains(self, graph, nodes):
+        """Split the topologically sorted nodes into chains of linearly
+        dependent nodes to run in a single job
+        """
+        if not self._bundle_duration:
+            return [[node] for node in nodes]
+        chains = []
+        chainof = {}
+        durations = {}
+        for node in nodes:
+            duration = _node_duration(node, self._estimated_duration)
+            prevnodes = graph.predecessors(node)
+            if len(prevnodes) == 1 and \
+                    graph.out_degree(prevnodes[0]) == 1 and \
+                    durations[prevnodes[0]] + duration <= \
+                    self._bundle_duration:
+                chain = chainof[prevnodes[0]]
+                chain.append(node)
+                duration += durations[prevnodes[0]]
+            else:
+                chain = [node]
+                chains.append(chain)
+            chainof[node] = chain
+            durations[node] = duration
+        return chains
 
     def _get_args(self, node, keywords):
         values = ()
@@ -641,7 +1233,7 @@ class GraphPluginBase(PluginBase):
     def _get_result(self, taskid):
         if taskid not in self._pending:
             raise Exception('Task %d not found' % taskid)
-        if self._is_pending(taskid):
+        if self._task_pending(taskid):
             return None
         node_dir = self._pending[taskid]
 
@@ -104,6 +104,10 @@ class IPythonPlugin(DistributedPluginBase):
                                                                    pckld_node,
                                                                    node.config,
                                                                    updatehash)
+        if hasattr(result_object, 'add_done_callback'):
+            # newer ipyparallel results are futures, wake up the scheduler
+            # as soon as the task finishes
+            result_object.add_done_callback(self._task_done_signal)
         self._taskid += 1
         self.taskmap[self._taskid] = result_object
         return self._taskid
@@ -0,0 +1,75 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Minimal launcher running the nodes pickled by the batch plugins
+
+The scripts written by :func:`~nipype.pipeline.plugins.base.create_pyscript`
+only import this module. Importing it still runs ``nipype/__init__.py``,
+which holds the ``config`` and ``logging`` instances shared with the
+interfaces, and the pipeline engine is needed to unpickle the node anyway.
+What the launcher avoids is importing the optional packages (matplotlib,
+prov, nose...) up front: the interfaces that use them import them when they
+run.
+"""
+from __future__ import absolute_import
+
+import os
+import sys
+from socket import gethostname
+from traceback import format_exception
+
+from ... import config, logging
+from ...utils.filemanip import loadpkl, savepkl
+
+
+def configure(node_config):
+    """Update the configuration of the running process from the
+    configuration of a node
+    """
+    if node_config:
+        config.update_config(node_config)
+    # matplotlib reads the backend from the environment when it is first
+    # imported, so that it is only imported by the interfaces using it
+    os.environ['MPLBACKEND'] = config.get('execution', 'matplotlib_backend')
+    if 'matplotlib' in sys.modules:
+        config.update_matplotlib()
+    logging.update_logging(config)
+
+
+def run_node(pklfile, batchdir, taskname, section=None,
+             store_exception=True, marker=None):
+    """Run the node pickled in ``pklfile``, or in its ``section``
+
+    Crashes are pickled with the result of the node. Without
+    ``store_exception``, a crash file is written instead and the exception
+    is raised again. ``marker`` is created once the node finished.
+    """
+    info = None
+    cwd = os.getcwd()
+    try:
+        info = loadpkl(pklfile, section=section)
+        configure(info['node'].config)
+        traceback = None
+        result = info['node'].run(updatehash=info['updatehash'])
+    except Exception as e:
+        traceback = format_exception(*sys.exc_info())
+        if info is None or not os.path.exists(info['node'].output_dir()):
+            result = None
+            resultsfile = os.path.join(batchdir,
+                                       'crashdump_%s.pklz' % taskname)
+        else:
+            result = info['node'].result
+            resultsfile = os.path.join(info['node'].output_dir(),
+                                       'result_%s.pklz' % info['node'].name)
+        if store_exception or info is None:
+            savepkl(resultsfile, dict(result=result, hostname=gethostname(),
+                                      traceback=traceback))
+        if not store_exception:
+            if info is not None:
+                from .base import report_crash
+                report_crash(info['node'], traceback, gethostname())
+            raise Exception(e)
+    finally:
+        # the next node of a manifest runs from the same directory
+        os.chdir(cwd)
+    if marker:
+        open(marker, 'w').close()
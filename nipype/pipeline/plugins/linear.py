@@ -6,7 +6,8 @@ import os
 
 from .base import (PluginBase, logger, report_crash, report_nodes_not_run,
                    str2bool)
-from ..engine.utils import (nx, dfs_preorder, topological_sort)
+from ..engine.utils import (nx, dfs_preorder, topological_sort,
+                            cache_node_result)
 
 
 class LinearPlugin(PluginBase):
@@ -36,7 +37,8 @@ class LinearPlugin(PluginBase):
                     continue
                 if self._status_callback:
                     self._status_callback(node, 'start')
-                node.run(updatehash=updatehash)
+                result = node.run(updatehash=updatehash)
+                cache_node_result(node, result)
                 if self._status_callback:
                     self._status_callback(node, 'end')
             except:
@@ -1,7 +1,9 @@
 """Parallel workflow execution via LSF
 """
 
+from getpass import getuser
 import os
+import subprocess
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
@@ -21,6 +23,8 @@ class LSFPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - bsub_args : arguments to be prepended to the job execution script in the
                   bsub call
+    - status_refresh_interval : minimum number of seconds between two queries
+                  of the status of all the jobs of the user (default 5)
 
     """
 
@@ -59,6 +63,22 @@ class LSFPlugin(SGELikeBatchManagerBase):
         else:
             return True
 
+    def _query_status(self):
+        proc = subprocess.Popen(['bjobs', '-a', '-w', '-u', getuser()],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        o, e = proc.communicate()
+        o = o.decode()
+        if proc.returncode and not o.strip() and b'No ' not in e:
+            raise RuntimeError(e)
+        status = {}
+        # JOBID, USER, STAT, ... after a header line
+        for line in o.split('\n')[1:]:
+            fields = line.split()
+            if len(fields) >= 3:
+                status[fields[0]] = fields[2] not in ('DONE', 'EXIT')
+        return status
+
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('bsub', environ=dict(os.environ),
                           terminal_output='allatonce')
@@ -10,14 +10,14 @@ http://stackoverflow.com/a/8963618/1183453
 from multiprocessing import Process, Pool, cpu_count, pool
 from traceback import format_exception
 import os
+import pickle
 import sys
+from time import time
 
 import numpy as np
-from copy import deepcopy
 from ..engine import MapNode
 from ...utils.misc import str2bool
-from ... import logging
-from nipype.pipeline.plugins import semaphore_singleton
+from ... import config, logging
 from .base import (DistributedPluginBase, report_crash)
 
 # Init logger
@@ -56,6 +56,25 @@ def run_node(node, updatehash):
     return result
 
 
+def run_pickled_node(pickled_node, updatehash, matlab_engines=None):
+    """Load a node pickled by the scheduler and execute it with run_node
+
+    Nodes are pickled when they are submitted, hence the scheduler does not
+    need to keep a private copy while the task waits in the pool queue.
+    ``matlab_engines`` is the address of the MATLAB engine server of the
+    current run, if any.
+    """
+    if matlab_engines:
+        os.environ['NIPYPE_MATLAB_ENGINES'] = matlab_engines
+    else:
+        os.environ.pop('NIPYPE_MATLAB_ENGINES', None)
+    node = pickle.loads(pickled_node)
+    if hasattr(node.inputs, 'terminal_output'):
+        if node.inputs.terminal_output == 'stream':
+            node.inputs.terminal_output = 'allatonce'
+    return run_node(node, updatehash)
+
+
 class NonDaemonProcess(Process):
     """A non-daemon process to support internal multiprocessing.
     """
@@ -74,10 +93,6 @@ class NonDaemonPool(pool.Pool):
     Process = NonDaemonProcess
 
 
-def release_lock(args):
-    semaphore_singleton.semaphore.release()
-
-
 # Get total system RAM
 def get_system_total_memory_gb():
     """Function to get the total RAM of the running system in GB
@@ -121,12 +136,22 @@ class MultiProcPlugin(DistributedPluginBase):
 
     The default number of threads and memory for a node is 1.
 
+    The memory and threads of every running task are reserved until the task
+    finishes. Ready jobs are submitted largest first and smaller jobs are
+    backfilled into the remaining capacity. Jobs that request more than the
+    available resources run alone. The utilization of the reserved
+    resources is logged at the end of a run and is available through
+    :meth:`utilization`.
+
     Currently supported options are:
 
     - non_daemon : boolean flag to execute as non-daemon processes
     - n_procs: maximum number of threads to be executed in parallel
     - memory_gb: maximum memory (in GB) that can be used at once.
 
+    When the ``matlab_engine_pool`` execution option is set, the workers share
+    that many MATLAB engines, and no more MATLAB or SPM nodes run at once.
+
     """
 
     def __init__(self, plugin_args=None):
@@ -147,23 +172,148 @@ class MultiProcPlugin(DistributedPluginBase):
                 self.processors = self.plugin_args['n_procs']
             if 'memory_gb' in self.plugin_args:
                 self.memory_gb = self.plugin_args['memory_gb']
+        # the MATLAB engines shared by the workers during a run
+        self.matlab_engines = 0
+        self._engine_address = None
         # Instantiate different thread pools for non-daemon processes
         if non_daemon:
             # run the execution using the non-daemon pool subclass
             self.pool = NonDaemonPool(processes=self.processors)
         else:
             self.pool = Pool(processes=self.processors)
-
-    def _wait(self):
-        if len(self.pending_tasks) > 0:
-            semaphore_singleton.semaphore.acquire()
-        semaphore_singleton.semaphore.release()
+        self._reset_resources()
+
+    def _reset_resources(self):
+        # the (memory, threads, MATLAB engines) reserved by every running task
+        self._reserved = {}
+        self.reserved_memory_gb = 0
+        self.reserved_threads = 0
+        self.reserved_engines = 0
+        # the first job that did not fit, and the tasks backfilled since
+        self._head_jobid = None
+        self._backfilled = set()
+        self._usage = dict(start=None, last=None, memory_gb_seconds=0.,
+                           thread_seconds=0., peak_memory_gb=0,
+                           peak_threads=0, tasks=0, backfilled=0)
+
+    def run(self, graph, config, updatehash=False):
+        self._reset_resources()
+        self.matlab_engines = int(config['execution'].get(
+            'matlab_engine_pool', 0))
+        if self.matlab_engines > 0:
+            from ...interfaces.matlab import start_matlab_engine_server
+            self._engine_address = start_matlab_engine_server(
+                self.matlab_engines).address
+        try:
+            super(MultiProcPlugin, self).run(graph, config,
+                                             updatehash=updatehash)
+        finally:
+            if self._engine_address is not None:
+                from ...interfaces.matlab import stop_matlab_engine_server
+                stop_matlab_engine_server()
+                self._engine_address = None
+            self._account_usage()
+            usage = self.utilization()
+            logger.info('MultiProc utilization: %d tasks (%d backfilled), '
+                        'threads %.0f%% (peak %d/%d), memory %.0f%% '
+                        '(peak %.1f/%.1f GB)',
+                        usage['tasks'], usage['backfilled'],
+                        100 * usage['thread_utilization'],
+                        usage['peak_threads'], self.processors,
+                        100 * usage['memory_utilization'],
+                        usage['peak_memory_gb'], self.memory_gb)
+
+    def utilization(self):
+        """Return statistics about the resources reserved by running tasks
+
+        The utilization is the time-averaged fraction of the threads and
+        memory available to the plugin that was reserved since the first
+        task was submitted.
+        """
+        usage = self._usage
+        elapsed = 0.
+        if usage['start'] is not None:
+            elapsed = usage['last'] - usage['start']
+        stats = dict(elapsed=elapsed, tasks=usage['tasks'],
+                     backfilled=usage['backfilled'],
+                     peak_threads=usage['peak_threads'],
+                     peak_memory_gb=usage['peak_memory_gb'],
+                     reserved_threads=self.reserved_threads,
+                     reserved_memory_gb=self.reserved_memory_gb,
+                     thread_utilization=0., memory_utilization=0.)
+        if elapsed > 0:
+            stats['thread_utilization'] = (usage['thread_seconds'] /
+                                           (elapsed * self.processors))
+            if self.memory_gb > 0:
+                stats['memory_utilization'] = (usage['memory_gb_seconds'] /
+                                               (elapsed * self.memory_gb))
+        return stats
+
+    def _account_usage(self):
+        """Integrate the reserved resources over time"""
+        now = time()
+        usage = self._usage
+        if usage['start'] is None:
+            return
+        elapsed = now - usage['last']
+        usage['memory_gb_seconds'] += elapsed * self.reserved_memory_gb
+        usage['thread_seconds'] += elapsed * self.reserved_threads
+        usage['last'] = now
+
+    def _reserve(self, taskid, memory_gb, threads, engines=0):
+        if self._usage['start'] is None:
+            self._usage['start'] = self._usage['last'] = time()
+        self._account_usage()
+        self._reserved[taskid] = (memory_gb, threads, engines)
+        self.reserved_memory_gb += memory_gb
+        self.reserved_threads += threads
+        self.reserved_engines += engines
+        usage = self._usage
+        usage['tasks'] += 1
+        usage['peak_memory_gb'] = max(usage['peak_memory_gb'],
+                                      self.reserved_memory_gb)
+        usage['peak_threads'] = max(usage['peak_threads'],
+                                    self.reserved_threads)
+
+    def _release(self, taskid):
+        if taskid not in self._reserved:
+            return
+        self._account_usage()
+        memory_gb, threads, engines = self._reserved.pop(taskid)
+        self.reserved_memory_gb -= memory_gb
+        self.reserved_threads -= threads
+        self.reserved_engines -= engines
+        self._backfilled.discard(taskid)
+
+    def _job_resources(self, jobid):
+        """Return the memory and threads a job reserves
+
+        Requests that exceed the resources of the plugin are capped, so that
+        these jobs can run once nothing else is running.
+        """
+        interface = self.procs[jobid]._interface
+        memory_gb = interface.estimated_memory_gb
+        threads = interface.num_threads
+        if memory_gb > self.memory_gb or threads > self.processors:
+            logger.warning('Job %s requests %s GB and %d threads, but only '
+                           '%s GB and %d threads are available, it will run '
+                           'alone', self.procs[jobid]._id, memory_gb, threads,
+                           self.memory_gb, self.processors)
+        return min(memory_gb, self.memory_gb), min(threads, self.processors)
+
+    def _job_engines(self, jobid):
+        """Return the number of MATLAB engines a job uses"""
+        if self.matlab_engines > 0 and getattr(self.procs[jobid]._interface,
+                                               '_uses_matlab', False):
+            return 1
+        return 0
 
     def _get_result(self, taskid):
         if taskid not in self._taskresult:
             raise RuntimeError('Multiproc task %d not found' % taskid)
         if not self._taskresult[taskid].ready():
             return None
+        self._release(taskid)
         return self._taskresult[taskid].get()
 
     def _report_crash(self, node, result=None):
@@ -176,133 +326,149 @@ class MultiProcPlugin(DistributedPluginBase):
             return report_crash(node)
 
     def _clear_task(self, taskid):
+        self._release(taskid)
         del self._taskresult[taskid]
 
     def _submit_job(self, node, updatehash=False):
         self._taskid += 1
-        if hasattr(node.inputs, 'terminal_output'):
-            if node.inputs.terminal_output == 'stream':
-                node.inputs.terminal_output = 'allatonce'
-
+        pickled_node = pickle.dumps(node, pickle.HIGHEST_PROTOCOL)
         self._taskresult[self._taskid] = \
-            self.pool.apply_async(run_node,
-                                  (node, updatehash),
-                                  callback=release_lock)
+            self.pool.apply_async(run_pickled_node,
+                                  (pickled_node, updatehash,
+                                   self._engine_address),
+                                  callback=self._task_done_signal)
         return self._taskid
 
     def _send_procs_to_workers(self, updatehash=False, graph=None):
         """ Sends jobs to workers when system resources are available.
             Check memory (gb) and cores usage before running jobs.
         """
-        executing_now = []
-
-        # Check to see if a job is available
-        jobids = np.flatnonzero((self.proc_pending == True) & \
-                                (self.depidx.sum(axis=0) == 0).__array__())
-
-        # Check available system resources by summing all threads and memory used
-        busy_memory_gb = 0
-        busy_processors = 0
-        for jobid in jobids:
-            busy_memory_gb += self.procs[jobid]._interface.estimated_memory_gb
-            busy_processors += self.procs[jobid]._interface.num_threads
-
-        free_memory_gb = self.memory_gb - busy_memory_gb
-        free_processors = self.processors - busy_processors
+        free_memory_gb = self.memory_gb - self.reserved_memory_gb
+        free_processors = self.processors - self.reserved_threads
 
         # Check all jobs without dependency not run
-        jobids = np.flatnonzero((self.proc_done == False) & \
-                                (self.depidx.sum(axis=0) == 0).__array__())
+        readyids = self._pop_ready()
 
         # Sort jobs ready to run first by memory and then by number of threads
-        # The most resource consuming jobs run first
-        jobids = sorted(jobids,
-                        key=lambda item: (self.procs[item]._interface.estimated_memory_gb,
-                                          self.procs[item]._interface.num_threads))
+        # The most resource consuming jobs run first, smaller jobs are
+        # backfilled into the remaining capacity
+        resources = dict((jobid, self._job_resources(jobid))
+                         for jobid in readyids)
+        jobids = sorted(readyids, key=lambda jobid: resources[jobid],
+                        reverse=True)
+        # the job that waits the longest goes first
+        if self._head_jobid in resources:
+            jobids.remove(self._head_jobid)
+            jobids.insert(0, self._head_jobid)
+        else:
+            self._head_jobid = None
+            self._backfilled.clear()
 
-        logger.debug('Free memory (GB): %d, Free processors: %d',
+        logger.debug('Free memory (GB): %.2f, Free processors: %d',
                      free_memory_gb, free_processors)
 
-        # While have enough memory and processors for first job
-        # Submit first job on the list
         for jobid in jobids:
-            logger.debug('Next Job: %d, memory (GB): %d, threads: %d' \
-                         % (jobid, self.procs[jobid]._interface.estimated_memory_gb,
-                            self.procs[jobid]._interface.num_threads))
-
-            if self.procs[jobid]._interface.estimated_memory_gb <= free_memory_gb and \
-               self.procs[jobid]._interface.num_threads <= free_processors:
-                logger.info('Executing: %s ID: %d' %(self.procs[jobid]._id, jobid))
-                executing_now.append(self.procs[jobid])
-
-                if isinstance(self.procs[jobid], MapNode):
-                    try:
-                        num_subnodes = self.procs[jobid].num_subnodes()
-                    except Exception:
-                        etype, eval, etr = sys.exc_info()
-                        traceback = format_exception(etype, eval, etr)
-                        report_crash(self.procs[jobid], traceback=traceback)
-                        self._clean_queue(jobid, graph)
-                        self.proc_pending[jobid] = False
+            memory_gb, threads = resources[jobid]
+            logger.debug('Next Job: %d, memory (GB): %.2f, threads: %d' \
+                         % (jobid, memory_gb, threads))
+
+            engines = self._job_engines(jobid)
+            fits = (memory_gb <= free_memory_gb and
+                    threads <= free_processors and not
+                    self.reserved_engines + engines > self.matlab_engines > 0)
+            if fits and self._head_jobid not in (None, jobid):
+                # the resources of the waiting job are reserved: smaller
+                # jobs are backfilled only if the waiting job still fits
+                # next to all of them once the other tasks have finished
+                head_memory_gb, head_threads = resources[self._head_jobid]
+                backfilled = [self._reserved[tid] for tid in self._backfilled]
+                fits = (head_memory_gb + memory_gb +
+                        sum(res[0] for res in backfilled) <= self.memory_gb and
+                        head_threads + threads +
+                        sum(res[1] for res in backfilled) <= self.processors)
+            if not fits:
+                # leave the job in the ready queue and try smaller ones
+                if self._head_jobid is None:
+                    self._head_jobid = jobid
+                continue
+
+            logger.info('Executing: %s ID: %d' %(self.procs[jobid]._id, jobid))
+
+            if isinstance(self.procs[jobid], MapNode):
+                try:
+                    num_subnodes = self.procs[jobid].num_subnodes()
+                except Exception:
+                    etype, eval, etr = sys.exc_info()
+                    traceback = format_exception(etype, eval, etr)
+                    report_crash(self.procs[jobid], traceback=traceback)
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+                if num_subnodes > 1:
+                    submit = self._submit_mapnode(jobid)
+                    if not submit:
                         continue
-                    if num_subnodes > 1:
-                        submit = self._submit_mapnode(jobid)
-                        if not submit:
-                            continue
-
-                # change job status in appropriate queues
-                self.proc_done[jobid] = True
-                self.proc_pending[jobid] = True
-
-                free_memory_gb -= self.procs[jobid]._interface.estimated_memory_gb
-                free_processors -= self.procs[jobid]._interface.num_threads
-
-                # Send job to task manager and add to pending tasks
-                if self._status_callback:
-                    self._status_callback(self.procs[jobid], 'start')
-                if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
-                    logger.debug('checking hash locally')
-                    try:
-                        hash_exists, _, _, _ = self.procs[
-                            jobid].hash_exists()
-                        logger.debug('Hash exists %s' % str(hash_exists))
-                        if (hash_exists and (self.procs[jobid].overwrite == False or \
-                                             (self.procs[jobid].overwrite == None and \
-                                              not self.procs[jobid]._interface.always_run))):
-                            self._task_finished_cb(jobid)
-                            self._remove_node_dirs()
-                            continue
-                    except Exception:
-                        etype, eval, etr = sys.exc_info()
-                        traceback = format_exception(etype, eval, etr)
-                        report_crash(self.procs[jobid], traceback=traceback)
-                        self._clean_queue(jobid, graph)
-                        self.proc_pending[jobid] = False
+
+            # change job status in appropriate queues
+            self.proc_done[jobid] = True
+            self.proc_pending[jobid] = True
+
+            # Send job to task manager and add to pending tasks
+            if self._status_callback:
+                self._status_callback(self.procs[jobid], 'start')
+            if str2bool(self.procs[jobid].config['execution']['local_hash_check']):
+                logger.debug('checking hash locally')
+                try:
+                    hash_exists, _, _, _ = self.procs[
+                        jobid].hash_exists()
+                    logger.debug('Hash exists %s' % str(hash_exists))
+                    if (hash_exists and (self.procs[jobid].overwrite == False or \
+                                         (self.procs[jobid].overwrite == None and \
+                                          not self.procs[jobid]._interface.always_run))):
+                        self._task_finished_cb(jobid)
+                        self._remove_node_dirs()
                         continue
-                logger.debug('Finished checking hash')
-
-                if self.procs[jobid].run_without_submitting:
-                    logger.debug('Running node %s on master thread' \
-                                 % self.procs[jobid])
-                    try:
-                        self.procs[jobid].run()
-                    except Exception:
-                        etype, eval, etr = sys.exc_info()
-                        traceback = format_exception(etype, eval, etr)
-                        report_crash(self.procs[jobid], traceback=traceback)
-                    self._task_finished_cb(jobid)
-                    self._remove_node_dirs()
+                except Exception:
+                    etype, eval, etr = sys.exc_info()
+                    traceback = format_exception(etype, eval, etr)
+                    report_crash(self.procs[jobid], traceback=traceback)
+                    self._clean_queue(jobid, graph)
+                    self.proc_pending[jobid] = False
+                    continue
+            logger.debug('Finished checking hash')
+
+            if self.procs[jobid].run_without_submitting:
+                logger.debug('Running node %s on master thread' \
+                             % self.procs[jobid])
+                result = None
+                try:
+                    result = self.procs[jobid].run()
+                except Exception:
+                    etype, eval, etr = sys.exc_info()
+                    traceback = format_exception(etype, eval, etr)
+                    report_crash(self.procs[jobid], traceback=traceback)
+                self._task_finished_cb(jobid, result=result)
+                self._remove_node_dirs()
 
-                else:
-                    logger.debug('submitting %s' % str(jobid))
-                    tid = self._submit_job(deepcopy(self.procs[jobid]),
-                                           updatehash=updatehash)
-                    if tid is None:
-                        self.proc_done[jobid] = False
-                        self.proc_pending[jobid] = False
-                    else:
-                        self.pending_tasks.insert(0, (tid, jobid))
             else:
-                break
-
+                logger.debug('submitting %s' % str(jobid))
+                tid = self._submit_job(self.procs[jobid],
+                                       updatehash=updatehash)
+                if tid is None:
+                    self.proc_done[jobid] = False
+                    self.proc_pending[jobid] = False
+                else:
+                    self.pending_tasks.insert(0, (tid, jobid))
+                    self._reserve(tid, memory_gb, threads, engines)
+                    if jobid == self._head_jobid:
+                        self._head_jobid = None
+                        self._backfilled.clear()
+                    elif self._head_jobid is not None:
+                        self._backfilled.add(tid)
+                        self._usage['backfilled'] += 1
+                    free_memory_gb -= memory_gb
+                    free_processors -= threads
+
+        # Jobs that did not fit remain in the ready queue
+        self._requeue(readyids)
         logger.debug('No jobs waiting to execute')
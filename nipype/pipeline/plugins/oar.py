@@ -1,6 +1,7 @@
 """Parallel workflow execution via OAR http://oar.imag.fr
 """
 
+from getpass import getuser
 import os
 import stat
 from time import sleep
@@ -22,6 +23,8 @@ class OARPlugin(SGELikeBatchManagerBase):
     - oarsub_args : arguments to be prepended to the job execution
                     script in the oarsub call
     - max_jobname_len: maximum length of the job name.  Default 15.
+    - status_refresh_interval: minimum number of seconds between two
+      queries of the status of all the jobs of the user (default 5)
 
     """
 
@@ -64,6 +67,20 @@ class OARPlugin(SGELikeBatchManagerBase):
         )
         return is_pending
 
+    def _query_status(self):
+        proc = subprocess.Popen(['oarstat', '-J', '-u', getuser()],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        o, e = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError(e)
+        status = {}
+        for jobid, info in json.loads(o.decode() or '{}').items():
+            state = info['state'].lower()
+            status[str(jobid)] = ('error' not in state and
+                                  'terminated' not in state)
+        return status
+
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('oarsub', environ=dict(os.environ),
                           terminal_output='allatonce')
@@ -1,15 +1,45 @@
 """Parallel workflow execution via PBS/Torque
 """
 
+from getpass import getuser
 import os
 from time import sleep
 import subprocess
+from xml.etree import ElementTree
 
 from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
 from ...interfaces.base import CommandLine, text_type
 
 
+def _parse_qstat(output):
+    """Return whether the jobs listed by ``qstat -u`` are still pending,
+    keyed on their number
+
+    Completed (Torque) and finished (PBS Pro) jobs are not pending.
+    """
+    status = {}
+    if output.lstrip().startswith('<'):
+        for job in ElementTree.fromstring(output.strip()).iter('Job'):
+            status[job.findtext('Job_Id').split('.')[0]] = \
+                job.findtext('job_state') not in ('C', 'F')
+        return status
+    # Job ID, Username, Queue, Jobname, SessID, NDS, TSK, Req'd Memory,
+    # Req'd Time, S(tate), Elap Time after the header lines
+    lines = output.split('\n')
+    for idx, line in enumerate(lines):
+        if line.startswith('---'):
+            lines = lines[idx + 1:]
+            break
+    else:
+        lines = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) >= 10:
+            status[fields[0].split('.')[0]] = fields[-2] not in ('C', 'F')
+    return status
+
+
 class PBSPlugin(SGELikeBatchManagerBase):
     """Execute using PBS/Torque
 
@@ -20,6 +50,8 @@ class PBSPlugin(SGELikeBatchManagerBase):
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
     - max_jobname_len: maximum length of the job name.  Default 15.
+    - status_refresh_interval: minimum number of seconds between two
+      queries of the status of all jobs (default 5)
 
     """
 
@@ -51,6 +83,21 @@ class PBSPlugin(SGELikeBatchManagerBase):
         errmsg = 'Unknown Job Id'  # %s' % taskid
         return errmsg not in e
 
+    def _query_status(self):
+        # -x also lists the jobs that finished recently (PBS Pro), the
+        # listing is in XML with Torque and -x is unknown to older versions
+        for args in (['qstat', '-x', '-u', getuser()],
+                     ['qstat', '-u', getuser()]):
+            proc = subprocess.Popen(args,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            o, e = proc.communicate()
+            if not proc.returncode:
+                break
+        else:
+            raise RuntimeError(e)
+        return _parse_qstat(o.decode())
+
     def _submit_batchtask(self, scriptfile, node):
         cmd = CommandLine('qsub', environ=dict(os.environ),
                           terminal_output='allatonce')
@@ -0,0 +1,455 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Parallel workflow execution with pilot jobs
+
+Long-lived worker agents are submitted once to the batch system and pull the
+nodes from a work queue in a shared directory, so that nodes start as soon as
+a worker has free resources instead of waiting for queue admission.
+
+The work queue is laid out as follows::
+
+    queue/task_<taskid>_<memory_mb>_<threads>.pklz  nodes waiting for a worker
+    running/<workerid>/task_<...>.pklz              nodes claimed by a worker
+    done/task_<taskid>.pklz                         results of the nodes
+    workers/<workerid>                              heartbeats of the workers
+    idle/<workerid>_<uuid>                          workers which exited idle
+    stop                                            asks the workers to exit
+
+Files are moved atomically with ``os.rename``, which is how the workers claim
+nodes without further locking.
+"""
+from __future__ import print_function, division
+
+from builtins import range
+
+import argparse
+from math import ceil
+from multiprocessing import cpu_count
+import os
+from socket import gethostname
+import subprocess
+import sys
+import threading
+from time import sleep, time
+from traceback import format_exc
+import uuid
+
+from ... import config, logging
+from ...interfaces.base import CommandLine
+from ...utils.filemanip import loadpkl, savepkl
+from .base import (DistributedPluginBase, report_crash)
+from .multiproc import NonDaemonPool, get_system_total_memory_gb, run_node
+
+logger = logging.getLogger('workflow')
+
+
+def _task_name(taskid, memory_gb, threads):
+    return 'task_%d_%d_%d.pklz' % (taskid, int(ceil(memory_gb * 1024)),
+                                   threads)
+
+
+def _parse_task_name(name):
+    """Return the taskid and the memory (in GB) and threads requested by a
+    queued node
+    """
+    _, taskid, memory_mb, threads = name[:-len('.pklz')].split('_')
+    return int(taskid), int(memory_mb) / 1024, int(threads)
+
+
+def _atomic_savepkl(filename, record):
+    tmpfile = os.path.join(os.path.dirname(filename),
+                           '.tmp_' + os.path.basename(filename))
+    savepkl(tmpfile, record)
+    os.rename(tmpfile, filename)
+
+
+def run_task(taskfile, resultfile):
+    """Run a node claimed by a worker and write its result
+    """
+    cwd = os.getcwd()
+    try:
+        info = loadpkl(taskfile)
+        node = info['node']
+        config.update_config(node.config)
+        logging.update_logging(config)
+        if hasattr(node.inputs, 'terminal_output'):
+            if node.inputs.terminal_output == 'stream':
+                node.inputs.terminal_output = 'allatonce'
+        result = run_node(node, info['updatehash'])
+    except Exception:
+        # the master waits for a result whatever happens
+        result = dict(result=None, traceback=format_exc())
+    os.chdir(cwd)
+    result['hostname'] = gethostname()
+    _atomic_savepkl(resultfile, result)
+    os.remove(taskfile)
+
+
+class PilotWorker(object):
+    """Worker agent pulling nodes from the work queue in ``spool_dir``
+
+    The worker runs nodes concurrently as long as the memory and threads
+    they request (the ``estimated_memory_gb`` and ``num_threads`` attributes
+    of their interface) fit in its resources. A node requesting more than
+    the resources of the worker runs alone. The worker exits when the master
+    asks it to stop, or after ``idle_timeout`` seconds without nodes to run,
+    in which case it leaves a marker in ``idle`` for the master to start new
+    workers if nodes get queued later.
+    """
+
+    def __init__(self, spool_dir, memory_gb=None, n_procs=None,
+                 idle_timeout=600, poll_interval=0.1):
+        self.spool_dir = spool_dir
+        self.memory_gb = memory_gb or get_system_total_memory_gb()
+        self.n_procs = n_procs or cpu_count()
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.workerid = '%s_%d' % (gethostname(), os.getpid())
+        self._queue_dir = os.path.join(spool_dir, 'queue')
+        self._done_dir = os.path.join(spool_dir, 'done')
+        self._running_dir = os.path.join(spool_dir, 'running', self.workerid)
+        self._heartbeat_file = os.path.join(spool_dir, 'workers',
+                                            self.workerid)
+        self._heartbeat_time = None
+        self._running = {}
+
+    def run(self):
+        os.makedirs(self._running_dir)
+        pool = NonDaemonPool(processes=self.n_procs)
+        last_active = time()
+        try:
+            while True:
+                self._heartbeat()
+                for job in [job for job in self._running if job.ready()]:
+                    del self._running[job]
+                stopping = os.path.exists(os.path.join(self.spool_dir,
+                                                       'stop'))
+                claimed = 0
+                if not stopping:
+                    claimed = self._claim_tasks(pool)
+                if self._running or claimed:
+                    last_active = time()
+                elif stopping:
+                    break
+                elif time() - last_active > self.idle_timeout:
+                    open(os.path.join(self.spool_dir, 'idle', '%s_%s' % (
+                        self.workerid, uuid.uuid4().hex)), 'w').close()
+                    break
+                if not claimed:
+                    sleep(self.poll_interval)
+        finally:
+            pool.close()
+            pool.join()
+            os.rmdir(self._running_dir)
+            os.remove(self._heartbeat_file)
+
+    def _heartbeat(self):
+        if self._heartbeat_time is None or time() - self._heartbeat_time > 1:
+            open(self._heartbeat_file, 'w').close()
+            self._heartbeat_time = time()
+
+    def _claim_tasks(self, pool):
+        """Claim the queued nodes that fit in the free resources and return
+        their number
+        """
+        free_memory_gb = self.memory_gb - sum(
+            memory_gb for memory_gb, _ in self._running.values())
+        free_threads = self.n_procs - sum(
+            threads for _, threads in self._running.values())
+        claimed = 0
+        for name in sorted((name for name in os.listdir(self._queue_dir)
+                            if name.startswith('task_')),
+                           key=_parse_task_name):
+            taskid, memory_gb, threads = _parse_task_name(name)
+            memory_gb = min(memory_gb, self.memory_gb)
+            threads = min(threads, self.n_procs)
+            if self._running and (memory_gb > free_memory_gb or
+                                  threads > free_threads):
+                continue
+            taskfile = os.path.join(self._running_dir, name)
+            try:
+                os.rename(os.path.join(self._queue_dir, name), taskfile)
+            except OSError:
+                # claimed by another worker
+                continue
+            resultfile = os.path.join(self._done_dir, 'task_%d.pklz' % taskid)
+            job = pool.apply_async(run_task, (taskfile, resultfile))
+            self._running[job] = (memory_gb, threads)
+            free_memory_gb -= memory_gb
+            free_threads -= threads
+            claimed += 1
+        return claimed
+
+
+class PilotPlugin(DistributedPluginBase):
+    """Execute workflow with pilot jobs
+
+    The plugin submits ``n_workers`` worker agents (see :class:`PilotWorker`)
+    to the batch system when the workflow starts, then only queues the nodes
+    in a shared directory. The plugin_args input to run can be used to
+    control the execution. Currently supported options are:
+
+    - n_workers : number of worker agents (default 1)
+    - n_procs, memory_gb : threads and memory (in GB) of each worker
+      (default: those of the host running the worker)
+    - launcher : 'sbatch', 'qsub' or 'local', the command submitting the
+      workers, which 'local' runs as subprocesses (default 'sbatch')
+    - launcher_args : arguments prepended to the batch script in the call
+      to the launcher
+    - template : template of the batch script of the workers
+    - spool_dir : shared directory holding the work queues, in a new
+      ``<spool_dir>/<uuid>`` subdirectory for each run (default:
+      ``<base_dir>/pilot``)
+    - worker_timeout : number of seconds without heartbeat after which a
+      worker is considered dead and its running nodes crashed (default 300)
+    - idle_timeout : number of seconds without nodes to run after which the
+      workers exit (default 600). The workers are started again when nodes
+      are queued and all of them exited this way. The queued nodes crash
+      instead when no worker is left and some exited otherwise, e.g. failed
+      to start.
+    """
+
+    def __init__(self, plugin_args=None):
+        super(PilotPlugin, self).__init__(plugin_args=plugin_args)
+        plugin_args = plugin_args or {}
+        self._n_workers = plugin_args.get('n_workers', 1)
+        self._n_procs = plugin_args.get('n_procs')
+        self._memory_gb = plugin_args.get('memory_gb')
+        self._launcher = plugin_args.get('launcher', 'sbatch')
+        self._launcher_args = plugin_args.get('launcher_args', '')
+        self._template = plugin_args.get('template', '#!/bin/sh')
+        if os.path.isfile(self._template):
+            self._template = open(self._template).read()
+        self._spool_dir = plugin_args.get('spool_dir')
+        self._worker_timeout = plugin_args.get('worker_timeout', 300)
+        self._idle_timeout = plugin_args.get('idle_timeout', 600)
+        self._taskid = 0
+        self._workers = []
+        self._n_started = 0
+        self._launched = None
+        self._watcher = None
+        self._stale = set()
+        self._stale_checked = None
+        self._lost = set()
+
+    def __getstate__(self):
+        state = super(PilotPlugin, self).__getstate__()
+        for key in ('_workers', '_watcher', '_watch_stop'):
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        super(PilotPlugin, self).__setstate__(state)
+        self._workers = []
+        self._watcher = None
+
+    def run(self, graph, config, updatehash=False):
+        """Executes a pre-defined pipeline with pilot jobs
+        """
+        spool_dir = self._spool_dir
+        if spool_dir is None:
+            spool_dir = os.path.join(graph.nodes()[0].base_dir, 'pilot')
+        # the files left by a previous run must not be taken for this one
+        self._spool = os.path.join(spool_dir, uuid.uuid4().hex)
+        for name in ('queue', 'running', 'done', 'workers', 'idle'):
+            os.makedirs(os.path.join(self._spool, name))
+        self._taskid = 0
+        self._n_started = 0
+        self._stale = set()
+        self._stale_checked = None
+        self._lost = set()
+        self._start_workers()
+        try:
+            return super(PilotPlugin, self).run(graph, config,
+                                                updatehash=updatehash)
+        finally:
+            self._stop_workers()
+
+    def _start_workers(self):
+        self._launch_workers()
+        self._watch_stop = threading.Event()
+        self._watcher = threading.Thread(target=self._watch_results)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def _launch_workers(self):
+        cmdline = [sys.executable, '-m', 'nipype.pipeline.plugins.pilot',
+                   self._spool, '--idle_timeout', str(self._idle_timeout)]
+        if self._n_procs:
+            cmdline += ['--n_procs', str(self._n_procs)]
+        if self._memory_gb:
+            cmdline += ['--memory_gb', str(self._memory_gb)]
+        scriptfile = os.path.join(self._spool, 'worker.sh')
+        with open(scriptfile, 'wt') as fp:
+            fp.write('\n'.join((self._template, ' '.join(cmdline))) + '\n')
+        logger.info('Starting %d pilot workers with %s' %
+                    (self._n_workers, self._launcher))
+        for _ in range(self._n_workers):
+            if self._launcher == 'local':
+                self._workers.append(subprocess.Popen(['sh', scriptfile]))
+            else:
+                cmd = CommandLine(self._launcher, environ=dict(os.environ),
+                                  terminal_output='allatonce')
+                cmd.inputs.args = '%s %s' % (self._launcher_args, scriptfile)
+                cmd.run()
+        self._n_started += self._n_workers
+        self._launched = time()
+
+    def _stop_workers(self):
+        open(os.path.join(self._spool, 'stop'), 'w').close()
+        if self._watcher is not None:
+            self._watch_stop.set()
+            self._watcher.join()
+            self._watcher = None
+        for worker in self._workers:
+            worker.wait()
+        self._workers = []
+
+    def _watch_results(self):
+        """Wake up the scheduler when nodes finish, and handle the nodes
+        queued once no worker is left
+
+        New workers are started if all the workers exited idle, otherwise
+        the queued nodes crash: the workers failing to start would fail
+        again.
+        """
+        done_dir = os.path.join(self._spool, 'done')
+        idle_dir = os.path.join(self._spool, 'idle')
+        queue_dir = os.path.join(self._spool, 'queue')
+        seen = set()
+        while not self._watch_stop.wait(0.1):
+            names = set(os.listdir(done_dir))
+            if names - seen:
+                self._task_done_signal()
+            seen = names
+            queued = [name for name in os.listdir(queue_dir)
+                      if name.startswith('task_')]
+            if not queued or self._workers_alive():
+                continue
+            if len(os.listdir(idle_dir)) >= self._n_started:
+                logger.info('Pilot workers exited idle, restarting them')
+                self._launch_workers()
+                continue
+            logger.error('Pilot workers exited before running %d queued '
+                         'nodes' % len(queued))
+            for name in queued:
+                try:
+                    os.remove(os.path.join(queue_dir, name))
+                except OSError:
+                    continue
+                self._lost.add(_parse_task_name(name)[0])
+            self._task_done_signal()
+
+    def _workers_alive(self):
+        """Return whether some workers may still run the queued nodes
+
+        Local workers are polled. Workers submitted to a batch system are
+        alive while their heartbeat is recent, and until ``worker_timeout``
+        seconds after their submission if none started yet.
+        """
+        if self._launcher == 'local':
+            return any(worker.poll() is None for worker in self._workers)
+        now = time()
+        if now - self._launched < self._worker_timeout:
+            return True
+        workers_dir = os.path.join(self._spool, 'workers')
+        for workerid in os.listdir(workers_dir):
+            try:
+                if now - os.stat(os.path.join(
+                        workers_dir, workerid)).st_mtime < \
+                        self._worker_timeout:
+                    return True
+            except OSError:
+                continue
+        return False
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        interface = node._interface
+        name = _task_name(self._taskid,
+                          getattr(interface, 'estimated_memory_gb', 1),
+                          getattr(interface, 'num_threads', 1))
+        _atomic_savepkl(os.path.join(self._spool, 'queue', name),
+                        dict(node=node, updatehash=updatehash))
+        return self._taskid
+
+    def _result_file(self, taskid):
+        return os.path.join(self._spool, 'done', 'task_%d.pklz' % taskid)
+
+    def _get_result(self, taskid):
+        resultfile = self._result_file(taskid)
+        if os.path.exists(resultfile):
+            return loadpkl(resultfile)
+        if taskid in self._stale_tasks():
+            return dict(result=None, hostname=None,
+                        traceback='Pilot worker stopped while running task '
+                                  '%d' % taskid)
+        if taskid in self._lost:
+            return dict(result=None, hostname=None,
+                        traceback='Pilot workers exited before running task '
+                                  '%d, see their output' % taskid)
+        return None
+
+    def _stale_tasks(self):
+        """Return the tasks claimed by workers whose heartbeat stopped for
+        more than ``worker_timeout`` seconds
+        """
+        now = time()
+        if self._stale_checked is not None and \
+                now - self._stale_checked < min(10, self._worker_timeout):
+            return self._stale
+        self._stale_checked = now
+        running_dir = os.path.join(self._spool, 'running')
+        for workerid in os.listdir(running_dir):
+            heartbeat = os.path.join(self._spool, 'workers', workerid)
+            try:
+                alive = now - os.stat(heartbeat).st_mtime < \
+                    self._worker_timeout
+            except OSError:
+                alive = False
+            if alive:
+                continue
+            try:
+                names = os.listdir(os.path.join(running_dir, workerid))
+            except OSError:
+                continue
+            for name in names:
+                if name.startswith('task_'):
+                    self._stale.add(_parse_task_name(name)[0])
+        return self._stale
+
+    def _report_crash(self, node, result=None):
+        if result and result['traceback']:
+            node._result = result['result']
+            node._traceback = result['traceback']
+            return report_crash(node, traceback=result['traceback'],
+                                hostname=result['hostname'])
+        else:
+            return report_crash(node)
+
+    def _clear_task(self, taskid):
+        resultfile = self._result_file(taskid)
+        if os.path.exists(resultfile):
+            os.remove(resultfile)
+        self._stale.discard(taskid)
+        self._lost.discard(taskid)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run a pilot worker pulling nipype nodes from a work '
+                    'queue')
+    parser.add_argument('spool_dir', help='directory of the work queue')
+    parser.add_argument('--memory_gb', type=float,
+                        help='memory of the worker in GB')
+    parser.add_argument('--n_procs', type=int,
+                        help='number of threads of the worker')
+    parser.add_argument('--idle_timeout', type=float, default=600,
+                        help='seconds without nodes to run before exiting')
+    args = parser.parse_args(argv)
+    PilotWorker(args.spool_dir, memory_gb=args.memory_gb,
+                n_procs=args.n_procs, idle_timeout=args.idle_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
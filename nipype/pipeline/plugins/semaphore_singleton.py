@@ -1,2 +0,0 @@
-import threading
-semaphore = threading.Semaphore(1)
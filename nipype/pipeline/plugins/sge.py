@@ -333,9 +333,16 @@ class SGEPlugin(SGELikeBatchManagerBase):
     - template : template to use for batch job submission
     - qsub_args : arguments to be prepended to the job execution script in the
                   qsub call
+    - array_jobs : submit the subnodes of each mapnode as a single array job
+                   (default False)
+    - bundle_duration : estimated duration in seconds of the short nodes
+                        bundled into a single job (default 0, no bundling)
 
     """
 
+    # SGE numbers the tasks of array jobs from 1
+    _array_index = '$(($SGE_TASK_ID - 1))'
+
     def __init__(self, **kwargs):
         template = """
 #$ -V
@@ -363,6 +370,14 @@ class SGEPlugin(SGELikeBatchManagerBase):
         return self._refQstatSubstitute.is_job_pending(int(taskid))
 
     def _submit_batchtask(self, scriptfile, node):
+        taskid = self._qsub(scriptfile, node)
+        self._pending[taskid] = node.output_dir()
+        return taskid
+
+    def _submit_array(self, scriptfile, node, size):
+        return self._qsub(scriptfile, node, array_size=size)
+
+    def _qsub(self, scriptfile, node, array_size=None):
         cmd = CommandLine('qsub', environ=dict(os.environ),
                           terminal_output='allatonce')
         path = os.path.dirname(scriptfile)
@@ -375,6 +390,8 @@ class SGEPlugin(SGELikeBatchManagerBase):
                 qsubargs = node.plugin_args['qsub_args']
             else:
                 qsubargs += (" " + node.plugin_args['qsub_args'])
+        if array_size:
+            qsubargs = '%s -t 1-%d' % (qsubargs, array_size)
         if '-o' not in qsubargs:
             qsubargs = '%s -o %s' % (qsubargs, path)
         if '-e' not in qsubargs:
@@ -415,9 +432,8 @@ class SGEPlugin(SGELikeBatchManagerBase):
         iflogger.setLevel(oldlevel)
         # retrieve sge taskid
         lines = [line for line in result.runtime.stdout.split('\n') if line]
-        taskid = int(re.match("Your job ([0-9]*) .* has been submitted",
-                              lines[-1]).groups()[0])
-        self._pending[taskid] = node.output_dir()
+        taskid = int(re.match("Your job(?:-array)? ([0-9]*)[ .].* has been "
+                              "submitted", lines[-1]).groups()[0])
         self._refQstatSubstitute.add_startup_job(taskid, cmd.cmdline)
         logger.debug('submitted sge task: %d for node %s with %s' %
                      (taskid, node._id, cmd.cmdline))
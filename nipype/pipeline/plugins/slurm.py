@@ -6,6 +6,7 @@ Created on Aug 2, 2013
 Parallel workflow execution with SLURM
 '''
 
+from getpass import getuser
 import os
 import re
 import subprocess
@@ -15,6 +16,9 @@ from .base import (SGELikeBatchManagerBase, logger, iflogger, logging)
 
 from nipype.interfaces.base import CommandLine
 
+# job state codes of squeue for jobs that are not running anymore
+FINISHED_STATES = ('BF', 'CA', 'CD', 'DL', 'F', 'NF', 'OOM', 'PR', 'TO')
+
 
 class SLURMPlugin(SGELikeBatchManagerBase):
     '''
@@ -27,9 +31,20 @@ class SLURMPlugin(SGELikeBatchManagerBase):
 
     - sbatch_args: arguments to pass prepend to the sbatch call
 
+    - status_refresh_interval: minimum number of seconds between two
+      queries of the status of all the jobs of the user (default 5)
+
+    - array_jobs: submit the subnodes of each mapnode as a single job array
+      (default False)
+
+    - bundle_duration: estimated duration in seconds of the short nodes
+      bundled into a single job (default 0, no bundling)
+
 
     '''
 
+    _array_index = '$SLURM_ARRAY_TASK_ID'
+
     def __init__(self, **kwargs):
 
         template = "#!/bin/bash"
@@ -62,11 +77,45 @@ class SLURMPlugin(SGELikeBatchManagerBase):
 
         return o.find(str(taskid)) > -1
 
+    def _query_status(self):
+        proc = subprocess.Popen(['squeue', '-h', '-o', '%i %t',
+                                 '-u', getuser()],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        o, e = proc.communicate()
+        if proc.returncode:
+            raise RuntimeError(e)
+        status = {}
+        for line in o.decode().split('\n'):
+            fields = line.split()
+            if len(fields) == 2:
+                pending = fields[1] not in FINISHED_STATES
+                status[fields[0]] = pending
+                # tasks of job arrays are listed as <jobid>_<index> or
+                # <jobid>_[<indices>], an array is pending if any of its
+                # tasks is
+                arrayid = fields[0].split('_')[0]
+                if arrayid != fields[0]:
+                    status[arrayid] = status.get(arrayid, False) or pending
+        return status
+
     def _submit_batchtask(self, scriptfile, node):
         """
         This is more or less the _submit_batchtask from sge.py with flipped variable
         names, different command line switches, and different output formatting/processing
         """
+        taskid = self._sbatch(scriptfile, node)
+        self._pending[taskid] = node.output_dir()
+        logger.debug('submitted sbatch task: %d for node %s' % (taskid, node._id))
+        return taskid
+
+    def _submit_array(self, scriptfile, node, size):
+        arrayid = self._sbatch(scriptfile, node, array_size=size)
+        logger.debug('submitted sbatch array: %d of %d tasks for node %s' %
+                     (arrayid, size, node._id))
+        return arrayid
+
+    def _sbatch(self, scriptfile, node, array_size=None):
         cmd = CommandLine('sbatch', environ=dict(os.environ),
                           terminal_output='allatonce')
         path = os.path.dirname(scriptfile)
@@ -80,10 +129,14 @@ class SLURMPlugin(SGELikeBatchManagerBase):
                 sbatch_args = node.plugin_args['sbatch_args']
             else:
                 sbatch_args += (" " + node.plugin_args['sbatch_args'])
+        outfile = 'slurm-%j.out'
+        if array_size:
+            sbatch_args = '%s --array=0-%d' % (sbatch_args, array_size - 1)
+            outfile = 'slurm-%A_%a.out'
         if '-o' not in sbatch_args:
-            sbatch_args = '%s -o %s' % (sbatch_args, os.path.join(path, 'slurm-%j.out'))
+            sbatch_args = '%s -o %s' % (sbatch_args, os.path.join(path, outfile))
         if '-e' not in sbatch_args:
-            sbatch_args = '%s -e %s' % (sbatch_args, os.path.join(path, 'slurm-%j.out'))
+            sbatch_args = '%s -e %s' % (sbatch_args, os.path.join(path, outfile))
         if node._hierarchy:
             jobname = '.'.join((dict(os.environ)['LOGNAME'],
                                 node._hierarchy,
@@ -118,8 +171,5 @@ class SLURMPlugin(SGELikeBatchManagerBase):
         iflogger.setLevel(oldlevel)
         # retrieve taskid
         lines = [line for line in result.runtime.stdout.split('\n') if line]
-        taskid = int(re.match("Submitted batch job ([0-9]*)",
-                              lines[-1]).groups()[0])
-        self._pending[taskid] = node.output_dir()
-        logger.debug('submitted sbatch task: %d for node %s' % (taskid, node._id))
-        return taskid
+        return int(re.match("Submitted batch job ([0-9]*)",
+                            lines[-1]).groups()[0])
@@ -2,14 +2,24 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 """Tests for the engine module
 """
+from builtins import range
+import os
+import subprocess
+from time import sleep, time
+from tempfile import mkdtemp
+from shutil import rmtree
+
 import numpy as np
 import scipy.sparse as ssp
 import re
 
 import mock
 
+import nipype
 from nipype.testing import (assert_raises, assert_equal, assert_true,
                             assert_false, skipif, assert_regexp_matches)
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
 import nipype.pipeline.plugins.base as pb
 
 def test_scipy_sparse():
@@ -61,3 +71,268 @@ wf.base_dir = '/tmp'
 
 wf.run(plugin='MultiProc')
 '''
+
+
+def add_one(in_value):
+    return in_value + 1
+
+
+def sum_values(in_value):
+    return sum(in_value)
+
+
+class InlinePlugin(pb.DistributedPluginBase):
+    """Runs every job synchronously when it is submitted"""
+
+    def __init__(self, plugin_args=None):
+        super(InlinePlugin, self).__init__(plugin_args=plugin_args)
+        self._taskresult = {}
+        self._taskid = 0
+        self.submitted = []
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        self.submitted.append(node._id)
+        self._taskresult[self._taskid] = dict(
+            result=node.run(updatehash=updatehash), traceback=None)
+        self._task_done_signal()
+        return self._taskid
+
+    def _get_result(self, taskid):
+        return self._taskresult[taskid]
+
+    def _report_crash(self, node, result=None):
+        return pb.report_crash(node, traceback=result['traceback'])
+
+    def _clear_task(self, taskid):
+        del self._taskresult[taskid]
+
+
+def test_event_driven_scheduling():
+    temp_dir = mkdtemp(prefix='test_scheduler_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    first = pe.Node(niu.Function(input_names=['in_value'],
+                                 output_names=['out_value'],
+                                 function=add_one), name='first')
+    first.inputs.in_value = 0
+    left = first.clone('left')
+    right = first.clone('right')
+    mapped = pe.MapNode(niu.Function(input_names=['in_value'],
+                                     output_names=['out_value'],
+                                     function=add_one),
+                        iterfield=['in_value'], name='mapped')
+    last = pe.Node(niu.Function(input_names=['in_value'],
+                                output_names=['out_value'],
+                                function=sum_values), name='last')
+    merge = pe.Node(niu.Merge(2), name='merge')
+    wf.connect([(first, left, [('out_value', 'in_value')]),
+                (first, right, [('out_value', 'in_value')]),
+                (left, merge, [('out_value', 'in1')]),
+                (right, merge, [('out_value', 'in2')]),
+                (merge, mapped, [('out', 'in_value')]),
+                (mapped, last, [('out_value', 'in_value')])])
+    wf.config['execution']['poll_sleep_duration'] = 30
+    wf.config['execution']['local_hash_check'] = False
+    plugin = InlinePlugin()
+    t0 = time()
+    execgraph = wf.run(plugin=plugin)
+    # completions wake up the scheduler, nothing waits for the poll interval
+    yield assert_true, time() - t0 < 30
+    yield assert_equal, plugin.submitted[0], 'first'
+    yield assert_equal, plugin.submitted[-1], 'last'
+    yield assert_equal, sorted(plugin.submitted[3:6]), ['_mapped0', '_mapped1',
+                                                        'merge']
+    yield assert_true, np.all(plugin.depcount == 0)
+    yield assert_true, np.all(plugin.proc_done)
+    yield assert_false, np.any(plugin.proc_pending)
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('last')].get_output('out_value')
+    yield assert_equal, result, 6
+    rmtree(temp_dir)
+
+
+def test_batch_status_cache():
+    cache = pb.BatchStatusCache(refresh_interval=60)
+    query = mock.MagicMock(return_value={'1': True, '2': False})
+    job_query = mock.MagicMock(return_value=False)
+    yield assert_true, cache.is_pending(1, query, job_query)
+    yield assert_false, cache.is_pending(2, query, job_query)
+    # jobs submitted after the last query are pending
+    cache.submitted(3)
+    yield assert_true, cache.is_pending(3, query, job_query)
+    yield assert_equal, query.call_count, 1
+    yield assert_equal, job_query.call_count, 0
+    # jobs that left the queue are checked one by one
+    cache.refresh_interval = 0
+    yield assert_false, cache.is_pending(3, query, job_query)
+    yield assert_equal, query.call_count, 2
+    yield assert_equal, job_query.call_count, 1
+    # as are all jobs when the batch system cannot be queried
+    query.side_effect = RuntimeError
+    yield assert_false, cache.is_pending(1, query, job_query)
+    yield assert_equal, job_query.call_count, 2
+
+
+class LocalBatchPlugin(pb.SGELikeBatchManagerBase):
+    """Runs the batch scripts synchronously when they are submitted"""
+
+    # the batch scripts import nipype, which might not be installed
+    environ = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        os.environ.get('PYTHONPATH', '').split(os.pathsep)))
+
+    _array_index = '$ARRAY_TASK_INDEX'
+
+    def __init__(self, plugin_args=None):
+        super(LocalBatchPlugin, self).__init__('#!/bin/sh',
+                                               plugin_args=plugin_args)
+        self._taskid = 0
+        self.arrays = []
+        self.submitted = []
+
+    def _is_pending(self, taskid):
+        return False
+
+    def _submit_batchtask(self, scriptfile, node):
+        self._taskid += 1
+        self.submitted.append(node._id)
+        subprocess.call(['sh', scriptfile], env=self.environ)
+        self._pending[self._taskid] = node.output_dir()
+        return self._taskid
+
+    def _submit_array(self, scriptfile, node, size):
+        self._taskid += 1
+        self.arrays.append(size)
+        for index in range(size):
+            subprocess.call(['sh', scriptfile],
+                            env=dict(self.environ,
+                                     ARRAY_TASK_INDEX=str(index)))
+        return self._taskid
+
+
+def test_mapnode_array_jobs():
+    temp_dir = mkdtemp(prefix='test_array_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    mapped = pe.MapNode(niu.Function(input_names=['in_value'],
+                                     output_names=['out_value'],
+                                     function=add_one),
+                        iterfield=['in_value'], name='mapped')
+    mapped.inputs.in_value = [1, 2, 3]
+    last = pe.Node(niu.Function(input_names=['in_value'],
+                                output_names=['out_value'],
+                                function=sum_values), name='last')
+    wf.connect(mapped, 'out_value', last, 'in_value')
+    wf.config['execution']['poll_sleep_duration'] = 0
+    wf.config['execution']['local_hash_check'] = False
+    plugin = LocalBatchPlugin(plugin_args=dict(array_jobs=True))
+    execgraph = wf.run(plugin=plugin)
+    # the subnodes ran as the tasks of a single array job, the mapnode then
+    # collates their results
+    yield assert_equal, plugin.arrays, [3]
+    yield assert_equal, plugin.submitted, ['mapped', 'last']
+    yield assert_equal, plugin._task_markers, {}
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('last')].get_output('out_value')
+    yield assert_equal, result, 9
+    rmtree(temp_dir)
+
+
+def test_bundle_jobs():
+    temp_dir = mkdtemp(prefix='test_bundle_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    first = pe.Node(niu.Function(input_names=['in_value'],
+                                 output_names=['out_value'],
+                                 function=add_one), name='first')
+    first.inputs.in_value = 0
+    second = first.clone('second')
+    third = first.clone('third')
+    other = first.clone('other')
+    wf.connect([(first, second, [('out_value', 'in_value')]),
+                (second, third, [('out_value', 'in_value')])])
+    wf.add_nodes([other])
+    wf.config['execution']['poll_sleep_duration'] = 0
+    wf.config['execution']['local_hash_check'] = False
+    # the chain and the other node run in a single job
+    plugin = LocalBatchPlugin(plugin_args=dict(bundle_duration=60))
+    execgraph = wf.run(plugin=plugin)
+    yield assert_equal, len(plugin.submitted), 1
+    yield assert_equal, plugin._task_markers, {}
+    yield assert_equal, plugin._pending, {}
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('third')].get_output('out_value')
+    yield assert_equal, result, 3
+    # the estimated duration of the nodes limits the size of the jobs
+    third.plugin_args = dict(estimated_duration=60)
+    wf.config['execution']['stop_on_first_rerun'] = False
+    plugin = LocalBatchPlugin(plugin_args=dict(bundle_duration=60))
+    for node in (first, second, third, other):
+        node.overwrite = True
+    wf.run(plugin=plugin)
+    yield assert_equal, len(plugin.submitted), 2
+    rmtree(temp_dir)
+
+
+def test_bundle_chains():
+    graph = pb.nx.DiGraph()
+    graph.add_edges_from([('a', 'b'), ('b', 'c'), ('c', 'd'), ('c', 'e'),
+                          ('f', 'e')])
+    plugin = pb.GraphPluginBase(plugin_args=dict(bundle_duration=30))
+    chains = plugin._bundle_chains(graph, ['a', 'f', 'b', 'c', 'd', 'e'])
+    # chains end at forks and joins, and at the duration budget
+    yield assert_equal, chains, [['a', 'b', 'c'], ['f'], ['d'], ['e']]
+    plugin._bundle_duration = 20
+    chains = plugin._bundle_chains(graph, ['a', 'f', 'b', 'c', 'd', 'e'])
+    yield assert_equal, chains, [['a', 'b'], ['f'], ['c'], ['d'], ['e']]
+
+
+def test_completion_spool():
+    temp_dir = mkdtemp(prefix='test_spool_')
+    spool_dir = os.path.join(temp_dir, 'done')
+    callback = mock.MagicMock()
+    spool = pb.CompletionSpool(spool_dir, callback=callback, interval=60)
+    marker = os.path.join(spool_dir, 'pyscript_a.done')
+    yield assert_false, spool.is_done(marker)
+    open(marker, 'w').close()
+    # without inotify, markers are only seen by the next listing
+    if spool._watcher is not None:
+        for _ in range(50):
+            if callback.called:
+                break
+            sleep(0.1)
+        yield assert_true, callback.called
+    else:
+        spool.refresh(force=True)
+    yield assert_true, spool.is_done(marker)
+    spool.discard(marker)
+    yield assert_false, os.path.exists(marker)
+    yield assert_false, spool.is_done(marker)
+    spool.close()
+    yield assert_false, os.path.exists(spool_dir)
+    rmtree(temp_dir)
+
+
+def test_batch_completion_markers():
+    temp_dir = mkdtemp(prefix='test_markers_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    first = pe.Node(niu.Function(input_names=['in_value'],
+                                 output_names=['out_value'],
+                                 function=add_one), name='first')
+    first.inputs.in_value = 0
+    second = first.clone('second')
+    wf.connect(first, 'out_value', second, 'in_value')
+    wf.config['execution']['poll_sleep_duration'] = 0
+    wf.config['execution']['local_hash_check'] = False
+    plugin = LocalBatchPlugin()
+    with mock.patch.object(plugin, '_is_pending') as is_pending:
+        execgraph = wf.run(plugin=plugin)
+    # the finished jobs were found from their markers
+    yield assert_equal, is_pending.call_count, 0
+    yield assert_equal, plugin.submitted, ['first', 'second']
+    yield assert_equal, plugin._task_markers, {}
+    batch_dir = os.path.join(temp_dir, 'wf', 'batch')
+    yield assert_equal, [name for name in os.listdir(batch_dir)
+                         if name.startswith('done_')], []
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('second')].get_output('out_value')
+    yield assert_equal, result, 2
+    rmtree(temp_dir)
@@ -0,0 +1,102 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+"""Tests of the launcher of the batch plugins
+
+The import of the launcher in a fresh interpreter must not load the
+optional packages. Run the module as a script to time the import, e.g.::
+
+    python test_launcher.py 20
+"""
+from __future__ import print_function
+
+import os
+from shutil import rmtree
+import subprocess
+import sys
+from tempfile import mkdtemp
+
+import nipype
+from nipype.testing import assert_equal, assert_false, assert_true
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.base import create_pyscript, task_marker
+from nipype.pipeline.plugins.launcher import run_node
+from nipype.utils.filemanip import loadpkl, savepkl
+
+# optional packages that must only be imported by the nodes using them
+LAZY_MODULES = ['matplotlib', 'nibabel', 'nose', 'prov']
+
+IMPORT_SCRIPT = """
+import sys
+from time import time
+t0 = time()
+import nipype.pipeline.plugins.launcher
+print(' '.join([str(time() - t0)] +
+               [name for name in %r if name in sys.modules]))
+""" % LAZY_MODULES
+
+
+def time_import():
+    """Return the time to import the launcher in a fresh interpreter and
+    the optional packages it imported
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        env.get('PYTHONPATH', '').split(os.pathsep))
+    output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT],
+                                     env=env)
+    fields = output.decode().strip().splitlines()[-1].split()
+    return float(fields[0]), fields[1:]
+
+
+def add_one(in_value):
+    return in_value + 1
+
+
+def test_launcher_imports():
+    _, imported = time_import()
+    yield assert_equal, imported, []
+
+
+def test_run_node():
+    temp_dir = mkdtemp(prefix='test_launcher_')
+    node = pe.Node(niu.Function(input_names=['in_value'],
+                                output_names=['out_value'],
+                                function=add_one), name='node')
+    node.inputs.in_value = 1
+    node.base_dir = temp_dir
+    pklfile = os.path.join(temp_dir, 'node.pklz')
+    savepkl(pklfile, dict(node=node, updatehash=False))
+    marker = os.path.join(temp_dir, 'node.done')
+    run_node(pklfile, temp_dir, 'node', marker=marker)
+    yield assert_true, os.path.exists(marker)
+    result = loadpkl(os.path.join(temp_dir, 'node', 'result_node.pklz'))
+    yield assert_equal, result.outputs.out_value, 2
+    # crashes are stored with the result of the node
+    node.inputs.in_value = 'a'
+    savepkl(pklfile, dict(node=node, updatehash=False))
+    run_node(pklfile, temp_dir, 'node')
+    crash = loadpkl(os.path.join(temp_dir, 'node', 'result_node.pklz'))
+    yield assert_true, 'TypeError' in crash['traceback'][-1]
+    # the generated script runs the node through the launcher
+    node.inputs.in_value = 2
+    pyscript = create_pyscript(node, marker_dir=temp_dir)
+    source = open(pyscript).read()
+    yield assert_false, 'config' in source
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        env.get('PYTHONPATH', '').split(os.pathsep))
+    subprocess.check_call([sys.executable, pyscript], env=env)
+    yield assert_true, os.path.exists(task_marker(pyscript,
+                                                  marker_dir=temp_dir))
+    result = loadpkl(os.path.join(temp_dir, 'node', 'result_node.pklz'))
+    yield assert_equal, result.outputs.out_value, 3
+    rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    times = [time_import()[0] for _ in range(int((sys.argv[1:] or [10])[0]))]
+    print('launcher imported in %.3f s (best of %d)' % (min(times),
+                                                         len(times)))
@@ -6,10 +6,11 @@ from multiprocessing import cpu_count
 
 import nipype.interfaces.base as nib
 from nipype.utils import draw_gantt_chart
-from nipype.testing import assert_equal, skipif
+from nipype.testing import assert_equal, assert_false, skipif
 import nipype.pipeline.engine as pe
 from nipype.pipeline.plugins.callback_log import log_nodes_cb
-from nipype.pipeline.plugins.multiproc import get_system_total_memory_gb
+from nipype.pipeline.plugins.multiproc import (get_system_total_memory_gb,
+                                             MultiProcPlugin)
 
 class InputSpec(nib.TraitedSpec):
     input1 = nib.traits.Int(desc='a random int')
@@ -234,3 +235,103 @@ def test_do_not_use_more_threads_then_specified():
           "using more memory than system has (memory is not specified by user)"
 
     os.remove(LOG_FILENAME)
+
+
+def test_backfill_smaller_jobs():
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    pipe.base_dir = temp_dir
+    for name, num_threads in [('big', 3), ('medium', 2), ('small', 1)]:
+        node = pe.Node(interface=TestInterfaceSingleNode(), name=name)
+        node.interface.num_threads = num_threads
+        node.inputs.input1 = num_threads
+        pipe.add_nodes([node])
+
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 4, 'memory_gb': 10})
+    pipe.run(plugin=plugin)
+    usage = plugin.utilization()
+    # the small job runs next to the big one, the medium one has to wait
+    yield assert_equal, usage['tasks'], 3
+    yield assert_equal, usage['backfilled'], 1
+    yield assert_equal, usage['peak_threads'], 4
+    yield assert_equal, usage['reserved_threads'], 0
+    yield assert_equal, usage['thread_utilization'] <= 1, True
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
+
+
+class RecordingPlugin(MultiProcPlugin):
+    """Records the jobs it is asked to submit instead of running them"""
+
+    def _submit_job(self, node, updatehash=False):
+        self._taskid += 1
+        self.started.append(node.name)
+        return self._taskid
+
+
+def test_backfill_does_not_starve_waiting_jobs():
+    import networkx as nx
+    graph = nx.DiGraph()
+    nodes = []
+    for name, num_threads in [('big', 4)] + [('small%d' % i, 1)
+                                             for i in range(6)]:
+        node = pe.Node(interface=TestInterfaceSingleNode(), name=name)
+        node.interface.num_threads = num_threads
+        node.config = {'execution': {'local_hash_check': 'false'}}
+        graph.add_node(node)
+        nodes.append(node)
+    plugin = RecordingPlugin(plugin_args={'n_procs': 4, 'memory_gb': 10})
+    plugin.started = []
+    plugin._generate_dependency_list(graph)
+    plugin.pending_tasks = []
+    plugin.mapnodes = []
+    plugin.mapnodesubids = {}
+    # a small task is running when the job using the whole machine
+    # becomes ready, then small tasks keep finishing
+    plugin._reserve(0, 0, 1)
+    plugin._send_procs_to_workers()
+    yield assert_equal, plugin.started, []
+    plugin._release(0)
+    plugin._send_procs_to_workers()
+    yield assert_equal, plugin.started, ['big']
+    yield assert_equal, plugin.reserved_threads, 4
+    plugin.pool.terminate()
+
+
+def test_matlab_engines():
+    import sys
+    import nipype.interfaces.matlab as mlab
+    from nipype.interfaces.tests.test_matlab import FAKE_ENGINE, mcr_command
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+    engine = os.path.join(temp_dir, 'fake_engine.py')
+    with open(engine, 'wt') as fp:
+        fp.write(FAKE_ENGINE)
+    matlab_cmd = '%s %s %s' % (sys.executable, engine, mlab.ENGINE_DONE)
+
+    pipe = pe.Workflow(name='pipe')
+    pipe.base_dir = temp_dir
+    # the size of the pool is read from the configuration of the workflow
+    pipe.config['execution'] = {'matlab_engine_pool': '1'}
+    for i in range(3):
+        pipe.add_nodes([pe.Node(mcr_command(matlab_cmd, "disp('%d')" % i),
+                                name='mlab%d' % i)])
+    plugin = MultiProcPlugin(plugin_args={'n_procs': 3})
+    try:
+        execgraph = pipe.run(plugin=plugin)
+    finally:
+        os.chdir(cur_dir)
+    # the workers share a single engine and wait for it
+    engines = set(node.result.runtime.stdout.split()[1]
+                  for node in execgraph.nodes())
+    yield assert_equal, len(engines), 1
+    yield assert_equal, plugin.reserved_engines, 0
+    # the engine server does not outlive the run
+    yield assert_equal, mlab._engine_manager, None
+    yield assert_false, 'NIPYPE_MATLAB_ENGINES' in os.environ
+    plugin.pool.terminate()
+    rmtree(temp_dir)
@@ -3,9 +3,12 @@ from shutil import rmtree
 from tempfile import mkdtemp
 from time import sleep
 
+import mock
+
 import nipype.interfaces.base as nib
-from nipype.testing import assert_equal, skipif
+from nipype.testing import assert_equal, assert_true, assert_false, skipif
 import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.pbs import PBSPlugin
 
 
 class InputSpec(nib.TraitedSpec):
@@ -52,3 +55,54 @@ def test_run_pbsgraph():
     yield assert_equal, result, [1, 1]
     os.chdir(cur_dir)
     rmtree(temp_dir)
+
+
+QSTAT_OUTPUT = b"""
+server.example.org:
+                                                            Req'd  Req'd   Elap
+Job ID          Username Queue    Jobname    SessID NDS TSK Memory Time  S Time
+--------------- -------- -------- ---------- ------ --- --- ------ ----- - -----
+101.server      user     batch    job1        1234   1   1    --  01:00 R 00:01
+102.server      user     batch    job2          --   1   1    --  01:00 Q   --
+103.server      user     batch    job3        1236   1   1    --  01:00 F 00:10
+104[].server    user     batch    job4          --   1   1    --  01:00 B   --
+"""
+
+QSTAT_XML = b"""<Data><Job><Job_Id>201.server</Job_Id><job_state>R</job_state>\
+</Job><Job><Job_Id>202.server</Job_Id><job_state>C</job_state></Job></Data>
+"""
+
+
+def test_pbs_query_status():
+    plugin = PBSPlugin(plugin_args={'status_refresh_interval': 60})
+    with mock.patch('subprocess.Popen') as popen:
+        popen.return_value.communicate.return_value = (QSTAT_OUTPUT, b'')
+        popen.return_value.returncode = 0
+        yield assert_true, plugin._task_pending(101)
+        yield assert_true, plugin._task_pending(102)
+        yield assert_false, plugin._task_pending(103)
+        yield assert_true, plugin._query_status()['104[]']
+        # the status is refreshed once for the three jobs, then on request
+        yield assert_equal, popen.call_count, 2
+        yield assert_equal, popen.call_args[0][0][:3], ['qstat', '-x', '-u']
+
+
+def test_pbs_query_status_fallback():
+    plugin = PBSPlugin()
+    with mock.patch('subprocess.Popen') as popen:
+        # Torque lists the jobs in XML with -x
+        popen.return_value.communicate.return_value = (QSTAT_XML, b'')
+        popen.return_value.returncode = 0
+        status = plugin._query_status()
+        yield assert_true, status['201']
+        yield assert_false, status['202']
+    with mock.patch('subprocess.Popen') as popen:
+        # -x is not supported
+        popen.return_value.communicate.side_effect = [
+            (b'', b'qstat: invalid option -- x'), (QSTAT_OUTPUT, b'')]
+        type(popen.return_value).returncode = mock.PropertyMock(
+            side_effect=[2, 0])
+        status = plugin._query_status()
+        yield assert_equal, popen.call_args[0][0][:2], ['qstat', '-u']
+        yield assert_true, status['101']
+        yield assert_false, status['103']
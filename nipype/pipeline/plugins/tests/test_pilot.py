@@ -0,0 +1,154 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import mock
+
+import nipype
+from nipype.testing import assert_equal, assert_raises
+import nipype.interfaces.utility as niu
+import nipype.pipeline.engine as pe
+from nipype.pipeline.plugins.pilot import PilotWorker, _task_name
+
+
+def add_one(in_value):
+    return in_value + 1
+
+
+def sum_values(in_value):
+    return sum(in_value)
+
+
+def test_pilot_workers():
+    temp_dir = mkdtemp(prefix='test_pilot_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    mapped = pe.MapNode(niu.Function(input_names=['in_value'],
+                                     output_names=['out_value'],
+                                     function=add_one),
+                        iterfield=['in_value'], name='mapped')
+    mapped.inputs.in_value = [1, 2, 3]
+    last = pe.Node(niu.Function(input_names=['in_value'],
+                                output_names=['out_value'],
+                                function=sum_values), name='last')
+    wf.connect(mapped, 'out_value', last, 'in_value')
+    wf.config['execution']['poll_sleep_duration'] = 30
+    spool_dir = os.path.join(temp_dir, 'spool')
+    # the workers import nipype, which might not be installed
+    pythonpath = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        os.environ.get('PYTHONPATH', '').split(os.pathsep))
+    plugin_args = dict(launcher='local', n_workers=2, n_procs=2,
+                       memory_gb=1, spool_dir=spool_dir)
+    with mock.patch.dict(os.environ, PYTHONPATH=pythonpath):
+        execgraph = wf.run(plugin='Pilot', plugin_args=plugin_args)
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('last')].get_output('out_value')
+    yield assert_equal, result, 9
+    # the workers exited and the queue is empty
+    run_dir = os.path.join(spool_dir, os.listdir(spool_dir)[0])
+    yield assert_equal, os.listdir(os.path.join(run_dir, 'workers')), []
+    yield assert_equal, os.listdir(os.path.join(run_dir, 'queue')), []
+    yield assert_equal, os.listdir(os.path.join(run_dir, 'done')), []
+    # a second run does not see the files left by the first one
+    mapped.inputs.in_value = [4, 5]
+    with mock.patch.dict(os.environ, PYTHONPATH=pythonpath):
+        execgraph = wf.run(plugin='Pilot', plugin_args=plugin_args)
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('last')].get_output('out_value')
+    yield assert_equal, result, 11
+    yield assert_equal, len(os.listdir(spool_dir)), 2
+    rmtree(temp_dir)
+
+
+def sleep_value(in_value):
+    from time import sleep
+    sleep(3)
+    return in_value
+
+
+def test_pilot_workers_restart():
+    temp_dir = mkdtemp(prefix='test_pilot_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    first = pe.Node(niu.Function(input_names=['in_value'],
+                                 output_names=['out_value'],
+                                 function=add_one), name='first')
+    first.inputs.in_value = 1
+    # keeps the queue empty for longer than the idle timeout
+    local = pe.Node(niu.Function(input_names=['in_value'],
+                                 output_names=['out_value'],
+                                 function=sleep_value), name='local',
+                    run_without_submitting=True)
+    last = pe.Node(niu.Function(input_names=['in_value'],
+                                output_names=['out_value'],
+                                function=add_one), name='last')
+    wf.connect([(first, local, [('out_value', 'in_value')]),
+                (local, last, [('out_value', 'in_value')])])
+    wf.config['execution']['poll_sleep_duration'] = 30
+    spool_dir = os.path.join(temp_dir, 'spool')
+    pythonpath = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        os.environ.get('PYTHONPATH', '').split(os.pathsep))
+    with mock.patch.dict(os.environ, PYTHONPATH=pythonpath):
+        execgraph = wf.run(plugin='Pilot', plugin_args=dict(
+            launcher='local', n_workers=1, n_procs=1, memory_gb=1,
+            idle_timeout=1, spool_dir=spool_dir))
+    names = [node.name for node in execgraph.nodes()]
+    result = execgraph.nodes()[names.index('last')].get_output('out_value')
+    yield assert_equal, result, 3
+    # the worker exited idle once and was started again
+    run_dir = os.path.join(spool_dir, os.listdir(spool_dir)[0])
+    yield assert_equal, len(os.listdir(os.path.join(run_dir, 'idle'))), 1
+    yield assert_equal, os.listdir(os.path.join(run_dir, 'workers')), []
+    rmtree(temp_dir)
+
+
+def test_pilot_workers_failing():
+    temp_dir = mkdtemp(prefix='test_pilot_')
+    wf = pe.Workflow(name='wf', base_dir=temp_dir)
+    node = pe.Node(niu.Function(input_names=['in_value'],
+                                output_names=['out_value'],
+                                function=add_one), name='node')
+    node.inputs.in_value = 1
+    wf.add_nodes([node])
+    wf.config['execution']['poll_sleep_duration'] = 30
+    wf.config['execution']['crashdump_dir'] = temp_dir
+    # the workers exit before starting
+    yield assert_raises, RuntimeError, wf.run, 'Pilot', dict(
+        launcher='local', template='#!/bin/sh\nexit 1')
+    yield assert_equal, len([name for name in os.listdir(temp_dir)
+                             if name.startswith('crash-')]), 1
+    rmtree(temp_dir)
+
+
+def test_pilot_worker_resources():
+    spool_dir = mkdtemp(prefix='test_pilot_')
+    for name in ('queue', 'running', 'done', 'workers'):
+        os.mkdir(os.path.join(spool_dir, name))
+    for taskid, memory_gb, threads in [(1, 3, 1), (2, 2, 1), (3, 1, 2),
+                                       (4, 1, 1), (5, 8, 4)]:
+        open(os.path.join(spool_dir, 'queue',
+                          _task_name(taskid, memory_gb, threads)), 'w').close()
+    worker = PilotWorker(spool_dir, memory_gb=4, n_procs=2)
+    os.makedirs(worker._running_dir)
+    pool = mock.MagicMock()
+    pool.apply_async.side_effect = lambda *args: mock.MagicMock()
+    # nodes are claimed in order as long as they fit in the worker
+    yield assert_equal, worker._claim_tasks(pool), 2
+    yield assert_equal, sorted(os.listdir(worker._running_dir)), \
+        [_task_name(1, 3, 1), _task_name(4, 1, 1)]
+    yield assert_equal, sorted(worker._running.values()), [(1, 1), (3, 1)]
+    yield assert_equal, worker._claim_tasks(pool), 0
+    worker._running = {}
+    yield assert_equal, worker._claim_tasks(pool), 1
+    yield assert_equal, list(worker._running.values()), [(2, 1)]
+    worker._running = {}
+    yield assert_equal, worker._claim_tasks(pool), 1
+    yield assert_equal, list(worker._running.values()), [(1, 2)]
+    # nodes larger than the worker run alone
+    worker._running = {}
+    yield assert_equal, worker._claim_tasks(pool), 1
+    yield assert_equal, list(worker._running.values()), [(4, 2)]
+    yield assert_equal, os.listdir(os.path.join(spool_dir, 'queue')), []
+    rmtree(spool_dir)
@@ -0,0 +1,34 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import mock
+
+from nipype.testing import assert_equal, assert_true, assert_false
+from nipype.pipeline.plugins.slurm import SLURMPlugin
+
+
+def test_slurm_query_status():
+    plugin = SLURMPlugin(plugin_args={'status_refresh_interval': 60})
+    with mock.patch('subprocess.Popen') as popen:
+        popen.return_value.communicate.return_value = (
+            b'101 R\n102 PD\n103 CD\n', b'')
+        popen.return_value.returncode = 0
+        yield assert_true, plugin._task_pending(101)
+        yield assert_true, plugin._task_pending(102)
+        yield assert_false, plugin._task_pending(103)
+        # a single squeue call for all the jobs
+        yield assert_equal, popen.call_count, 1
+        yield assert_equal, popen.call_args[0][0][:4], \
+            ['squeue', '-h', '-o', '%i %t']
+
+
+def test_slurm_query_array_status():
+    plugin = SLURMPlugin()
+    with mock.patch('subprocess.Popen') as popen:
+        popen.return_value.communicate.return_value = (
+            b'201_[2-9] PD\n201_1 R\n201_0 CD\n202_0 CD\n', b'')
+        popen.return_value.returncode = 0
+        status = plugin._query_status()
+        # an array is pending as long as any of its tasks is
+        yield assert_true, status['201']
+        yield assert_false, status['201_0']
+        yield assert_false, status['202']
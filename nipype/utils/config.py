@@ -18,6 +18,7 @@ import os
 import shutil
 import errno
 from warnings import warn
+import weakref
 
 from ..external import portalocker
 from ..external.six import StringIO
@@ -36,22 +37,34 @@ log_size = 16384000
 log_rotate = 4
 
 [execution]
+content_hash_algorithm = md5
+content_hash_chunk_size = 1048576
+content_hash_mmap_size = 67108864
+content_hash_sampling = 0
 create_report = true
 crashdump_dir = %s
 display_variable = :1
+executable_cache = stat
+file_hash_cache = true
+file_hash_cache_db =
+file_hash_threads = 4
 hash_method = timestamp
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = true
+matlab_engine_pool = 0
 matplotlib_backend = Agg
 plugin = Linear
 remove_node_directories = false
 remove_unnecessary_outputs = true
+result_cache_size = 1000
 try_hard_link_datasink = true
 single_thread_matlab = true
 stop_on_first_crash = false
 stop_on_first_rerun = false
 use_relative_paths = false
+version_cache_persist = false
+version_cache_ttl = 86400
 stop_on_unknown_version = false
 write_provenance = false
 parameterize_dirs = true
@@ -74,6 +87,158 @@ def mkdir_p(path):
             raise
 
 
+class _FrozenDict(dict):
+    """A dict that cannot be modified"""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('Configuration snapshots are read-only, assign a new '
+                        'configuration dictionary instead')
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (_FrozenDict, (dict(self),))
+
+
+class ConfigSnapshot(_FrozenDict):
+    """An interned, hashable and read-only copy of configuration sections
+
+    Snapshots are created with :func:`freeze_config`, which returns the same
+    object for equal configurations, so that nodes sharing settings reference
+    a single snapshot. Nodes that customise their settings reference a
+    snapshot created with :meth:`override`. When pickled, only the options
+    that differ from the default configuration are stored.
+    """
+
+    def __init__(self, sections, key):
+        dict.__init__(self, sections)
+        self._key = key
+        self._hash = hash(key)
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        if isinstance(other, ConfigSnapshot):
+            return self._key == other._key
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __reduce__(self):
+        defaults = _default_sections()
+        changed = {}
+        removed = []
+        for section, options in list(self.items()):
+            if not isinstance(options, dict):
+                changed[section] = options
+                continue
+            default = defaults.get(section, {})
+            changed[section] = dict((key, val) for key, val in
+                                    list(options.items())
+                                    if key not in default or
+                                    default[key] != val)
+            removed.extend((section, key) for key in default
+                           if key not in options)
+        removed.extend((section, None) for section in defaults
+                       if section not in self)
+        return (_restore_config, (changed, removed))
+
+    def thaw(self):
+        """Return a mutable copy of the configuration sections"""
+        return dict((section, dict(options) if isinstance(options, dict)
+                     else options)
+                    for section, options in list(self.items()))
+
+    def override(self, overrides):
+        """Return the snapshot of this configuration with the sections of
+        ``overrides`` layered on top
+        """
+        if not overrides:
+            return self
+        sections = dict(self)
+        for section, options in list(overrides.items()):
+            if isinstance(options, dict) and isinstance(sections.get(section),
+                                                        dict):
+                merged = dict(sections[section])
+                merged.update(options)
+                options = merged
+            sections[section] = options
+        return freeze_config(sections)
+
+
+def _freeze_value(value):
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze_value(val))
+                            for key, val in list(value.items())))
+    if isinstance(value, (list, tuple)):
+        return (type(value).__name__,) + tuple(_freeze_value(val)
+                                               for val in value)
+    return value
+
+
+_snapshots = weakref.WeakValueDictionary()
+
+
+def freeze_config(sections):
+    """Return the interned :class:`ConfigSnapshot` of a dict of sections
+    """
+    if isinstance(sections, ConfigSnapshot):
+        return sections
+    key = _freeze_value(sections)
+    snapshot = _snapshots.get(key)
+    if snapshot is None:
+        frozen = dict((name, _FrozenDict(options)
+                       if isinstance(options, dict) else options)
+                      for name, options in list(sections.items()))
+        snapshot = ConfigSnapshot(frozen, key)
+        _snapshots[key] = snapshot
+    return snapshot
+
+
+_defaults = None
+
+
+def _default_sections():
+    """The sections of the default configuration that pickled snapshots
+    are stored relative to
+    """
+    global _defaults
+    if _defaults is None:
+        parser = configparser.ConfigParser()
+        parser.readfp(StringIO(default_cfg))
+        _defaults = dict((name, dict(options)) for name, options in
+                         list(parser._sections.items()))
+        # these defaults depend on the process that reads the configuration
+        del _defaults['logging']['log_directory']
+        del _defaults['execution']['crashdump_dir']
+    return _defaults
+
+
+def _restore_config(changed, removed):
+    sections = dict((name, dict(options)) for name, options in
+                    list(_default_sections().items()))
+    for section, key in removed:
+        if key is None:
+            sections.pop(section, None)
+        else:
+            sections[section].pop(key, None)
+    for section, options in list(changed.items()):
+        if isinstance(options, dict):
+            sections.setdefault(section, {}).update(options)
+        else:
+            sections[section] = options
+    return freeze_config(sections)
+
+
 class NipypeConfig(object):
     """Base nipype config class
     """
@@ -141,6 +306,12 @@ class NipypeConfig(object):
     def _sections(self):
         return self._config._sections
 
+    def snapshot(self):
+        """Return a read-only :class:`ConfigSnapshot` of the current
+        configuration
+        """
+        return freeze_config(self._sections)
+
     def get_data(self, key):
         if not os.path.exists(self.data_file):
             return None
@@ -7,19 +7,35 @@
 from future import standard_library
 standard_library.install_aliases()
 
+from copy import copy
 import pickle
 import gzip
 import hashlib
 from hashlib import md5
+import mmap
 import simplejson
 import os
 import re
 import shutil
+import struct
 import posixpath
+import threading
+from multiprocessing.pool import ThreadPool
+from io import BytesIO
+from time import time
+import zlib
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
 
 import numpy as np
 
-from .misc import is_container
+from .misc import is_container, str2bool
 from ..external.six import string_types
 from ..interfaces.traits_extension import isdefined
 
@@ -147,18 +163,362 @@ def check_forhash(filename):
         return False, None
 
 
-def hash_infile(afile, chunk_len=8192, crypto=hashlib.md5):
-    """ Computes hash of a file using 'crypto' module"""
-    hex = None
-    if os.path.isfile(afile):
-        crypto_obj = crypto()
-        with open(afile, 'rb') as fp:
+class FileHashCache(object):
+    """Cache of file content digests
+
+    Entries are keyed on the real path of a file and the name of the hash
+    algorithm, and remain valid as long as the stat signature of the file
+    (inode, size and modification time) does not change. Files modified less
+    than ``racy_window`` seconds ago are never cached, because a second
+    modification within the timestamp resolution would go unnoticed.
+
+    The in-memory cache is bounded to ``maxsize`` entries (least recently
+    used entries are evicted first). If ``dbfile`` is given, digests are
+    also persisted to a SQLite database so that they can be reused by other
+    processes (e.g., nodes executed by batch plugins) and later runs.
+
+    >>> from nipype.utils.filemanip import FileHashCache
+    >>> cache = FileHashCache()
+    >>> cache.stats()['hits']
+    0
+
+    """
+
+    racy_window = 2.0
+
+    def __init__(self, maxsize=100000, dbfile=None):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_pid = None
+        self.dbfile = None
+        self.hits = 0
+        self.dbhits = 0
+        self.misses = 0
+        self.set_dbfile(dbfile)
+
+    def set_dbfile(self, dbfile):
+        """Set (or disable with None) the database used for persistence"""
+        with self._lock:
+            self._close_db()
+            self.dbfile = dbfile
+
+    def clear(self):
+        """Empty the in-memory cache and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.dbhits = self.misses = 0
+
+    def stats(self):
+        """Return the number of hits, database hits and misses"""
+        with self._lock:
+            lookups = self.hits + self.dbhits + self.misses
+            hit_rate = 0.0
+            if lookups:
+                hit_rate = float(self.hits + self.dbhits) / lookups
+            return dict(hits=self.hits, dbhits=self.dbhits,
+                        misses=self.misses, entries=len(self._entries),
+                        hit_rate=hit_rate)
+
+    def get_digest(self, afile, algorithm, hashfn):
+        """Return the digest of ``afile``, calling ``hashfn(afile)`` on a miss
+
+        Parameters
+        ----------
+        afile : str
+            path of an existing file
+        algorithm : str
+            name identifying ``hashfn``, digests of different algorithms
+            are cached separately
+        hashfn : callable
+            computes the digest of a file
+        """
+        path = os.path.realpath(afile)
+        signature = self._signature(path)
+        key = (path, algorithm)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return entry[1]
+            digest = self._db_lookup(key, signature)
+            if digest is not None:
+                self.dbhits += 1
+                self._add_entry(key, signature, digest)
+                return digest
+            self.misses += 1
+        digest = hashfn(afile)
+        if digest is None:
+            return digest
+        # do not cache files that are being modified
+        if (self._signature(path) == signature and
+                time() - signature[2] > self.racy_window):
+            with self._lock:
+                self._add_entry(key, signature, digest)
+                self._db_store(key, signature, digest)
+        return digest
+
+    def _signature(self, path):
+        stat = os.stat(path)
+        return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+    def _add_entry(self, key, signature, digest):
+        self._entries.pop(key, None)
+        self._entries[key] = (signature, digest)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _close_db(self):
+        if self._db is not None and self._db_pid == os.getpid():
+            try:
+                self._db.close()
+            except sqlite3.Error:
+                pass
+        self._db = None
+        self._db_pid = None
+
+    def _get_db(self):
+        if self.dbfile is None or sqlite3 is None:
+            return None
+        if self._db_pid != os.getpid():
+            # connections must not be shared with forked processes
+            self._db = None
+            try:
+                dbdir = os.path.dirname(self.dbfile)
+                if dbdir and not os.path.exists(dbdir):
+                    os.makedirs(dbdir)
+                db = sqlite3.connect(self.dbfile, timeout=30,
+                                     check_same_thread=False)
+                db.execute('CREATE TABLE IF NOT EXISTS filehash ('
+                           'path TEXT, algorithm TEXT, inode INTEGER, '
+                           'size INTEGER, mtime TEXT, digest TEXT, '
+                           'PRIMARY KEY (path, algorithm))')
+                db.commit()
+            except (OSError, sqlite3.Error) as e:
+                fmlogger.warn('Could not open file hash database %s: %s' %
+                              (self.dbfile, e))
+                self.dbfile = None
+                return None
+            self._db = db
+            self._db_pid = os.getpid()
+        return self._db
+
+    def _db_lookup(self, key, signature):
+        db = self._get_db()
+        if db is None:
+            return None
+        try:
+            row = db.execute('SELECT inode, size, mtime, digest FROM filehash '
+                             'WHERE path=? AND algorithm=?', key).fetchone()
+        except sqlite3.Error as e:
+            fmlogger.debug('File hash database lookup failed: %s' % e)
+            return None
+        if row is None:
+            return None
+        if (row[0], row[1], row[2]) != (signature[0], signature[1],
+                                        repr(signature[2])):
+            return None
+        return str(row[3])
+
+    def _db_store(self, key, signature, digest):
+        db = self._get_db()
+        if db is None:
+            return
+        try:
+            db.execute('INSERT OR REPLACE INTO filehash VALUES (?,?,?,?,?,?)',
+                       key + (signature[0], signature[1], repr(signature[2]),
+                              digest))
+            db.commit()
+        except sqlite3.Error as e:
+            fmlogger.debug('File hash database update failed: %s' % e)
+
+
+_file_hash_cache = None
+
+
+def get_file_hash_cache():
+    """Return the process-wide :class:`FileHashCache`
+
+    Returns None if the cache is disabled with the ``file_hash_cache``
+    execution option. The ``file_hash_cache_db`` option sets the SQLite
+    file used to persist the digests.
+    """
+    global _file_hash_cache
+    if not str2bool(config.get('execution', 'file_hash_cache')):
+        return None
+    dbfile = None
+    if config.has_option('execution', 'file_hash_cache_db'):
+        dbfile = config.get('execution', 'file_hash_cache_db').strip()
+    if dbfile:
+        dbfile = os.path.abspath(os.path.expanduser(dbfile))
+    else:
+        dbfile = None
+    if _file_hash_cache is None:
+        _file_hash_cache = FileHashCache(dbfile=dbfile)
+    elif _file_hash_cache.dbfile != dbfile:
+        _file_hash_cache.set_dbfile(dbfile)
+    return _file_hash_cache
+
+
+_xxhash_warned = False
+
+
+def _get_crypto(algorithm):
+    """Return the constructor of hash objects for ``algorithm``
+
+    ``xxhash`` selects the fast non-cryptographic xxh64 hash of the optional
+    xxhash package. Any other name is looked up in hashlib.
+    """
+    global _xxhash_warned
+    algorithm = algorithm.lower()
+    if algorithm in ('xxhash', 'xxh64'):
+        try:
+            import xxhash
+        except ImportError:
+            if not _xxhash_warned:
+                fmlogger.warn('xxhash is not installed, using md5 to hash '
+                              'file contents')
+                _xxhash_warned = True
+            return 'md5', hashlib.md5
+        return 'xxh64', xxhash.xxh64
+    if hasattr(hashlib, algorithm):
+        return algorithm, getattr(hashlib, algorithm)
+    try:
+        hashlib.new(algorithm)
+    except ValueError:
+        raise ValueError('Unknown content hash algorithm: %s' % algorithm)
+    return algorithm, lambda: hashlib.new(algorithm)
+
+
+def content_hash_settings(options=None):
+    """Return the content hash configuration
+
+    The configuration is read from the ``content_hash_*`` execution options,
+    taken from ``options`` (e.g. the execution section of the configuration
+    of a node) if given, else from the global configuration:
+
+    - ``content_hash_algorithm``: md5, sha1, blake2b, xxhash or any other
+      hashlib algorithm
+    - ``content_hash_chunk_size``: number of bytes read at once
+    - ``content_hash_mmap_size``: files of at least this many bytes are
+      read through mmap (0 disables mmap)
+    - ``content_hash_sampling``: if larger than zero, only the first chunk
+      and this many strided chunks of each file are hashed
+    """
+    def get_option(name):
+        if options is not None and name in options:
+            return options[name]
+        return config.get('execution', name)
+
+    algorithm, crypto = _get_crypto(get_option('content_hash_algorithm'))
+    return dict(
+        algorithm=algorithm, crypto=crypto,
+        chunk_len=int(get_option('content_hash_chunk_size')),
+        mmap_size=int(get_option('content_hash_mmap_size')),
+        sampling=int(get_option('content_hash_sampling')))
+
+
+def content_hash_tag(settings=None):
+    """Return a name identifying the configured content hash
+
+    The tag is empty for the default full md5 hash, so that hashes computed
+    by previous versions remain valid. Sampled hashes depend on the chunk
+    size, which is part of their tag.
+
+    >>> from nipype.utils.filemanip import content_hash_tag
+    >>> content_hash_tag()
+    ''
+    >>> content_hash_tag(dict(algorithm='sha1', sampling=16,
+    ...                       chunk_len=65536))
+    'sha1s16c65536'
+
+    """
+    if settings is None:
+        settings = content_hash_settings()
+    tag = settings['algorithm']
+    if settings['sampling'] > 0:
+        tag += 's%dc%d' % (settings['sampling'], settings['chunk_len'])
+    if tag == 'md5':
+        return ''
+    return tag
+
+
+def _hash_infile(afile, chunk_len=8192, crypto=hashlib.md5, mmap_size=0,
+                 sampling=0):
+    crypto_obj = crypto()
+    size = os.path.getsize(afile)
+    if sampling > 0:
+        # hash the size, the first chunk and evenly strided chunks
+        crypto_obj.update(str(size).encode())
+        stride = max(chunk_len, size // (sampling + 1))
+        offsets = range(0, size, stride)
+    else:
+        offsets = None
+    with open(afile, 'rb') as fp:
+        if mmap_size and size >= mmap_size:
+            mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                view = memoryview(mapped)
+            except TypeError:
+                view = mapped
+            try:
+                if offsets is None:
+                    offsets = range(0, size, chunk_len)
+                for offset in offsets:
+                    crypto_obj.update(view[offset:offset + chunk_len])
+            finally:
+                if hasattr(view, 'release'):
+                    view.release()
+                mapped.close()
+        elif offsets is not None:
+            for offset in offsets:
+                fp.seek(offset)
+                crypto_obj.update(fp.read(chunk_len))
+        else:
             while True:
                 data = fp.read(chunk_len)
                 if not data:
                     break
                 crypto_obj.update(data)
-        hex = crypto_obj.hexdigest()
+    return crypto_obj.hexdigest()
+
+
+def hash_infile(afile, chunk_len=None, crypto=None, settings=None):
+    """ Computes hash of a file using 'crypto' module
+
+    If ``crypto`` is not given, the algorithm, the reading strategy and the
+    sampling are set by ``settings``, which defaults to the ``content_hash_*``
+    execution options (see :func:`content_hash_settings`). Digests are
+    memoized in the process-wide file hash cache (see
+    :func:`get_file_hash_cache`), so unchanged files are read only once.
+    """
+    hex = None
+    if os.path.isfile(afile):
+        if settings is None:
+            settings = content_hash_settings()
+        if chunk_len is None:
+            chunk_len = settings['chunk_len']
+        if crypto is None:
+            crypto = settings['crypto']
+            # the cache key includes the chunk size of sampled hashes
+            algorithm = content_hash_tag(
+                dict(settings, chunk_len=chunk_len)) or 'md5'
+            sampling = settings['sampling']
+        else:
+            algorithm = getattr(crypto(), 'name', repr(crypto))
+            sampling = 0
+
+        def hashfn(fname):
+            return _hash_infile(fname, chunk_len, crypto,
+                                mmap_size=settings['mmap_size'],
+                                sampling=sampling)
+
+        cache = get_file_hash_cache()
+        if cache is None:
+            return hashfn(afile)
+        hex = cache.get_digest(afile, algorithm, hashfn)
     return hex
 
 
@@ -174,6 +534,53 @@ def hash_timestamp(afile):
     return md5hex
 
 
+def get_file_hashes(fnames, hash_method='timestamp', num_threads=1,
+                    settings=None):
+    """Hash many files concurrently
+
+    Files are hashed by a pool of ``num_threads`` threads, which hides the
+    latency of network file systems and overlaps reading with hashing.
+
+    Parameters
+    ----------
+    fnames : iterable
+        file names to hash, non-existing files are allowed
+    hash_method : str
+        ``timestamp`` or ``content``
+    num_threads : int
+        number of threads, files are hashed serially if 1
+    settings : dict
+        content hash configuration (see :func:`content_hash_settings`),
+        default to the global execution options
+
+    Returns
+    -------
+    hashes : dict
+        maps each file name to its hash, or to None if it is not a file
+    """
+    if hash_method.lower() == 'timestamp':
+        hashfn = hash_timestamp
+    elif hash_method.lower() == 'content':
+        if settings is None:
+            settings = content_hash_settings()
+
+        def hashfn(fname):
+            return hash_infile(fname, settings=settings)
+    else:
+        raise Exception("Unknown hash method: %s" % hash_method)
+    fnames = list(set(fnames))
+    num_threads = min(num_threads, len(fnames))
+    if num_threads <= 1:
+        return dict((fname, hashfn(fname)) for fname in fnames)
+    pool = ThreadPool(num_threads)
+    try:
+        hashes = pool.map(hashfn, fnames)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(fnames, hashes))
+
+
 def copyfile(originalfile, newfile, copy=False, create_new=False,
              hashmethod=None, use_hardlink=False):
     """Copy or link ``originalfile`` to ``newfile``.
@@ -435,23 +842,108 @@ def loadcrash(infile, *args):
         raise ValueError('Only pickled crashfiles are supported')
 
 
-def loadpkl(infile):
-    """Load a zipped or plain cPickled file
-    """
-    if infile.endswith('pklz'):
-        pkl_file = gzip.open(infile, 'rb')
-    else:
-        pkl_file = open(infile)
-    return pickle.load(pkl_file)
+# Leading bytes of the sectioned pickle files written by :func:`savepkl`
+PKL_MAGIC = b'\x89NIPKL\r\n'
+PKL_VERSION = 1
 
 
-def savepkl(filename, record):
-    if filename.endswith('pklz'):
-        pkl_file = gzip.open(filename, 'wb')
-    else:
-        pkl_file = open(filename, 'wb')
-    pickle.dump(record, pkl_file)
-    pkl_file.close()
+def _read_pkl_section(pkl_file, start, entry, compression):
+    offset, length = entry
+    pkl_file.seek(start + offset)
+    data = pkl_file.read(length)
+    if compression == 'zlib':
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+
+def loadpkl(infile, section=None):
+    """Load a zipped or plain cPickled file
+
+    ``.pklz`` files are either gzip compressed pickles or sectioned files
+    written by :func:`savepkl`. If ``section`` is given, only that attribute
+    of the stored record is returned; attributes stored in their own section
+    are then read without unpickling the rest of the record.
+    """
+    with open(infile, 'rb') as pkl_file:
+        magic = pkl_file.read(len(PKL_MAGIC))
+        if magic != PKL_MAGIC:
+            pkl_file.seek(0)
+            if magic[:2] == b'\x1f\x8b':
+                record = pickle.load(gzip.GzipFile(fileobj=pkl_file,
+                                                   mode='rb'))
+            else:
+                record = pickle.load(pkl_file)
+            if section is None:
+                return record
+            return getattr(record, section)
+
+        size, = struct.unpack('<I', pkl_file.read(4))
+        header = simplejson.loads(pkl_file.read(size).decode('utf-8'))
+        if header['version'] > PKL_VERSION:
+            raise IOError('Unsupported pickle file version %s: %s' %
+                          (header['version'], infile))
+        start = pkl_file.tell()
+        sections = dict((name, (offset, length)) for name, offset, length
+                        in header['sections'])
+        compression = header['compression']
+        if section is not None and section in sections:
+            return _read_pkl_section(pkl_file, start, sections[section],
+                                     compression)
+        record = _read_pkl_section(pkl_file, start, sections[None],
+                                   compression)
+        if section is not None:
+            return getattr(record, section)
+        for name, entry in list(sections.items()):
+            if name is not None:
+                setattr(record, name, _read_pkl_section(pkl_file, start,
+                                                        entry, compression))
+    return record
+
+
+def savepkl(filename, record, sections=None, compresslevel=1):
+    """Pickle a record to a file
+
+    Files ending with ``pklz`` are written in a sectioned format: a small
+    uncompressed JSON header followed by zlib compressed pickles (``compresslevel``
+    0 stores them uncompressed). The attributes of ``record`` listed in
+    ``sections`` are pickled on their own and can be loaded separately with
+    ``loadpkl(filename, section=name)``.
+    """
+    if not filename.endswith('pklz'):
+        with open(filename, 'wb') as pkl_file:
+            pickle.dump(record, pkl_file, pickle.HIGHEST_PROTOCOL)
+        return
+
+    blobs = []
+    main = record
+    if sections:
+        main = copy(record)
+        for name in sections:
+            blobs.append((name, getattr(record, name)))
+            setattr(main, name, None)
+    blobs.insert(0, (None, main))
+
+    index = []
+    offset = 0
+    for i, (name, value) in enumerate(blobs):
+        buf = BytesIO()
+        pickle.dump(value, buf, pickle.HIGHEST_PROTOCOL)
+        data = buf.getvalue()
+        if compresslevel:
+            data = zlib.compress(data, compresslevel)
+        index.append((name, offset, len(data)))
+        offset += len(data)
+        blobs[i] = data
+
+    header = simplejson.dumps(dict(
+        version=PKL_VERSION, sections=index,
+        compression='zlib' if compresslevel else None)).encode('utf-8')
+    with open(filename, 'wb') as pkl_file:
+        pkl_file.write(PKL_MAGIC)
+        pkl_file.write(struct.pack('<I', len(header)))
+        pkl_file.write(header)
+        for data in blobs:
+            pkl_file.write(data)
 
 rst_levels = ['=', '-', '~', '+']
 
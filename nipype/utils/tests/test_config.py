@@ -0,0 +1,50 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from copy import deepcopy
+import pickle
+
+from ...testing import assert_equal, assert_true, assert_false, assert_raises
+from ... import config
+from ..config import ConfigSnapshot, freeze_config
+
+
+def test_config_snapshot():
+    snapshot = config.snapshot()
+    yield assert_true, isinstance(snapshot, ConfigSnapshot)
+    # equal configurations share the same snapshot
+    yield assert_true, snapshot is config.snapshot()
+    yield assert_true, freeze_config(deepcopy(config._sections)) is snapshot
+    yield assert_equal, hash(snapshot), hash(config.snapshot())
+    yield assert_equal, snapshot['execution']['hash_method'], \
+        config.get('execution', 'hash_method')
+    yield assert_true, deepcopy(snapshot) is snapshot
+    yield assert_raises, TypeError, snapshot.__setitem__, 'execution', {}
+    yield assert_raises, TypeError, snapshot['execution'].__setitem__, \
+        'hash_method', 'content'
+
+
+def test_config_snapshot_override():
+    snapshot = config.snapshot()
+    yield assert_true, snapshot.override(None) is snapshot
+    overrides = {'execution': {'keep_inputs': 'unlikely'},
+                 'custom': {'option': 1}}
+    custom = snapshot.override(overrides)
+    yield assert_equal, custom['execution']['keep_inputs'], 'unlikely'
+    yield assert_equal, custom['custom'], {'option': 1}
+    yield assert_equal, custom['execution']['hash_method'], \
+        snapshot['execution']['hash_method']
+    yield assert_false, snapshot['execution']['keep_inputs'] == 'unlikely'
+    yield assert_true, snapshot.override(overrides) is custom
+
+
+def test_config_snapshot_pickle():
+    snapshot = config.snapshot()
+    custom = snapshot.override({'execution': {'keep_inputs': 'unlikely'}})
+    custom = custom.override({'custom': {'option': 1}})
+    yield assert_true, pickle.loads(pickle.dumps(custom)) is custom
+    # only the options that differ from the defaults are pickled
+    full = dict((name, dict(options)) for name, options in custom.items())
+    yield assert_true, len(pickle.dumps(custom)) < len(pickle.dumps(full)) / 2
+    partial = freeze_config({'execution': {'keep_inputs': 'true'}})
+    yield assert_equal, pickle.loads(pickle.dumps(partial)), \
+        {'execution': {'keep_inputs': 'true'}}
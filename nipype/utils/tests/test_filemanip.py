@@ -2,17 +2,29 @@
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 from builtins import open
 
+import hashlib
 import os
+import sys
+from shutil import rmtree
 from tempfile import mkstemp, mkdtemp
+from time import time
 import warnings
 
+import mock
+
 from ...testing import assert_equal, assert_true, assert_false, TempFATFS
 from ...utils.filemanip import (save_json, load_json,
                                     fname_presuffix, fnames_presuffix,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    split_filename, get_related_files)
+                                    split_filename, get_related_files,
+                                    hash_infile, FileHashCache,
+                                    content_hash_settings, content_hash_tag,
+                                    loadpkl, savepkl)
+from ...interfaces.base import Bunch
+from ...utils import filemanip
+from ... import config
 
 import numpy as np
 
@@ -304,3 +316,165 @@ def test_related_files():
     yield assert_true, '/path/test.HEAD' in afni_files1
     yield assert_true, '/path/test.BRIK' in afni_files2
     yield assert_true, '/path/test.HEAD' in afni_files2
+
+
+class _Record(object):
+    def __init__(self, outputs, runtime):
+        self.outputs = outputs
+        self.runtime = runtime
+
+
+def test_pkl_sections():
+    import gzip
+    import pickle
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'result.pklz')
+    record = _Record(Bunch(out_file='foo.nii'), Bunch(environ={'A': '1'}))
+    savepkl(fname, record, sections=['outputs'])
+    # the record being saved is left untouched
+    yield assert_equal, record.outputs.out_file, 'foo.nii'
+    outputs = loadpkl(fname, section='outputs')
+    yield assert_equal, outputs.out_file, 'foo.nii'
+    loaded = loadpkl(fname)
+    yield assert_equal, loaded.outputs.out_file, 'foo.nii'
+    yield assert_equal, loaded.runtime.environ, {'A': '1'}
+    yield assert_equal, loadpkl(fname, section='runtime').environ, {'A': '1'}
+    savepkl(fname, record, compresslevel=0)
+    yield assert_equal, loadpkl(fname, section='outputs').out_file, 'foo.nii'
+    # gzip compressed pickles of earlier versions can still be loaded
+    with gzip.open(fname, 'wb') as fp:
+        pickle.dump(record, fp)
+    yield assert_equal, loadpkl(fname).runtime.environ, {'A': '1'}
+    yield assert_equal, loadpkl(fname, section='outputs').out_file, 'foo.nii'
+    fname = os.path.join(tmpdir, 'record.pkl')
+    savepkl(fname, dict(a=1))
+    yield assert_equal, loadpkl(fname), dict(a=1)
+    rmtree(tmpdir)
+
+
+def _write_old_file(fname, content):
+    with open(fname, 'wt') as fp:
+        fp.write(content)
+    # make the modification time older than the racy window
+    mtime = time() - 60
+    os.utime(fname, (mtime, mtime))
+
+
+def _count_calls(fname, calls):
+    calls.append(fname)
+    return hash_infile(fname)
+
+
+def test_file_hash_cache():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'data.txt')
+    _write_old_file(fname, 'some data')
+    cache = FileHashCache()
+    calls = []
+    digest = cache.get_digest(fname, 'md5', lambda f: _count_calls(f, calls))
+    yield assert_equal, digest, hash_infile(fname)
+    yield assert_equal, cache.get_digest(fname, 'md5',
+                                         lambda f: _count_calls(f, calls)), digest
+    yield assert_equal, len(calls), 1
+    yield assert_equal, cache.stats()['hits'], 1
+    yield assert_equal, cache.stats()['misses'], 1
+    # the stat signature invalidates the entry
+    _write_old_file(fname, 'other data')
+    newdigest = cache.get_digest(fname, 'md5',
+                                 lambda f: _count_calls(f, calls))
+    yield assert_equal, len(calls), 2
+    yield assert_false, newdigest == digest
+    # recently modified files are not cached
+    with open(fname, 'wt') as fp:
+        fp.write('recent data')
+    cache.get_digest(fname, 'md5', lambda f: _count_calls(f, calls))
+    cache.get_digest(fname, 'md5', lambda f: _count_calls(f, calls))
+    yield assert_equal, len(calls), 4
+    rmtree(tmpdir)
+
+
+def test_file_hash_cache_db():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'data.txt')
+    dbfile = os.path.join(tmpdir, 'hashes', 'filehash.db')
+    _write_old_file(fname, 'some data')
+    calls = []
+    cache = FileHashCache(dbfile=dbfile)
+    digest = cache.get_digest(fname, 'md5', lambda f: _count_calls(f, calls))
+    yield assert_true, os.path.exists(dbfile)
+    # a new cache (e.g., in another process) reuses the stored digest
+    cache = FileHashCache(dbfile=dbfile)
+    yield assert_equal, cache.get_digest(
+        fname, 'md5', lambda f: _count_calls(f, calls)), digest
+    yield assert_equal, cache.stats()['dbhits'], 1
+    yield assert_equal, len(calls), 1
+    # digests of different algorithms are not mixed up
+    cache.get_digest(fname, 'sha1', lambda f: _count_calls(f, calls))
+    yield assert_equal, len(calls), 2
+    rmtree(tmpdir)
+
+
+def test_content_hash_settings():
+    tmpdir = mkdtemp()
+    fname = os.path.join(tmpdir, 'data.bin')
+    data = np.arange(100000, dtype=np.int32)
+    data.tofile(fname)
+    default = hash_infile(fname)
+    old_config = dict((key, config.get('execution', key)) for key in
+                      ['content_hash_algorithm', 'content_hash_chunk_size',
+                       'content_hash_mmap_size', 'content_hash_sampling',
+                       'file_hash_cache'])
+    config.set('execution', 'file_hash_cache', 'false')
+    try:
+        # the reading strategy does not change the digest
+        config.set('execution', 'content_hash_chunk_size', '1000')
+        yield assert_equal, hash_infile(fname), default
+        config.set('execution', 'content_hash_mmap_size', '1')
+        yield assert_equal, hash_infile(fname), default
+        config.set('execution', 'content_hash_algorithm', 'sha1')
+        yield assert_equal, content_hash_tag(), 'sha1'
+        yield assert_equal, len(hash_infile(fname)), 40
+        # sampled hashes only see the sampled chunks
+        config.set('execution', 'content_hash_algorithm', 'md5')
+        config.set('execution', 'content_hash_sampling', '4')
+        yield assert_equal, content_hash_tag(), 'md5s4c1000'
+        sampled = hash_infile(fname)
+        yield assert_false, sampled == default
+        # sampled hashes of different chunk sizes are cached separately
+        config.set('execution', 'file_hash_cache', 'true')
+        cached = hash_infile(fname)
+        config.set('execution', 'content_hash_chunk_size', '2000')
+        yield assert_equal, content_hash_tag(), 'md5s4c2000'
+        yield assert_false, hash_infile(fname) == cached
+        config.set('execution', 'content_hash_chunk_size', '1000')
+        config.set('execution', 'file_hash_cache', 'false')
+        config.set('execution', 'content_hash_mmap_size', '0')
+        yield assert_equal, hash_infile(fname), sampled
+        data[1500] = -1
+        data.tofile(fname)
+        yield assert_equal, hash_infile(fname), sampled
+        data[0] = -1
+        data.tofile(fname)
+        yield assert_false, hash_infile(fname) == sampled
+        # options given explicitly take precedence
+        settings = content_hash_settings(dict(content_hash_sampling=0))
+        yield assert_equal, settings['sampling'], 0
+        yield assert_equal, settings['chunk_len'], 1000
+        yield assert_equal, hash_infile(fname, settings=settings), \
+            hash_infile(fname, crypto=hashlib.md5)
+    finally:
+        for key, value in list(old_config.items()):
+            config.set('execution', key, value)
+    rmtree(tmpdir)
+
+
+def test_xxhash_missing():
+    with mock.patch.dict(sys.modules, xxhash=None), \
+            mock.patch.object(filemanip, '_xxhash_warned', False), \
+            mock.patch.object(filemanip.fmlogger, 'warn') as warn:
+        for _ in range(3):
+            settings = content_hash_settings(
+                dict(content_hash_algorithm='xxhash'))
+            yield assert_equal, settings['algorithm'], 'md5'
+        # warned once, not for every file hashed
+        yield assert_equal, warn.call_count, 1